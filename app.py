@@ -4,99 +4,55 @@ import uuid
 import time
 import base64
 import sys
-import inspect
 import secrets
-from loguru import logger
+import signal
 from pathlib import Path
 import cf_util
+import diagnostics_util
+import log_util
+import metrics_util
+import json_util
+import stream_util
+import image_util
+import lifecycle_util
+import probe_util
+import snapshot_util
 import pickle
 import threading
+from collections import deque
+from concurrent import futures
 
-import requests
-from flask import Flask, request, Response, jsonify, stream_with_context, render_template, redirect, session
+from flask import Flask, request, Response, jsonify, stream_with_context, render_template, redirect, session, send_file, has_request_context
+from flask.json.provider import DefaultJSONProvider
 from curl_cffi import requests as curl_requests
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from fastapi import FastAPI, HTTPException, Depends, Query, Body
-from typing import List, Optional, Dict, Any
-from faker import Faker
-from pydantic import BaseModel
-
-
-class Logger:
-    def __init__(self, level="INFO", colorize=True, format=None):
-        logger.remove()
-
-        if format is None:
-            format = (
-                "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | "
-                "<level>{level: <8}</level> | "
-                "<cyan>{extra[filename]}</cyan>:<cyan>{extra[function]}</cyan>:<cyan>{extra[lineno]}</cyan> | "
-                "<level>{message}</level>"
-            )
-
-        logger.add(
-            sys.stderr,
-            level=level,
-            format=format,
-            colorize=colorize,
-            backtrace=True,
-            diagnose=True
-        )
-
-        self.logger = logger
-
-    def _get_caller_info(self):
-        frame = inspect.currentframe()
-        try:
-            caller_frame = frame.f_back.f_back
-            full_path = caller_frame.f_code.co_filename
-            function = caller_frame.f_code.co_name
-            lineno = caller_frame.f_lineno
-
-            filename = os.path.basename(full_path)
-
-            return {
-                'filename': filename,
-                'function': function,
-                'lineno': lineno
-            }
-        finally:
-            del frame
-
-    def info(self, message, source="API"):
-        caller_info = self._get_caller_info()
-        self.logger.bind(**caller_info).info(f"[{source}] {message}")
-
-    def error(self, message, source="API"):
-        caller_info = self._get_caller_info()
-
-        if isinstance(message, Exception):
-            self.logger.bind(**caller_info).exception(f"[{source}] {str(message)}")
-        else:
-            self.logger.bind(**caller_info).error(f"[{source}] {message}")
-
-    def warning(self, message, source="API"):
-        caller_info = self._get_caller_info()
-        self.logger.bind(**caller_info).warning(f"[{source}] {message}")
-
-    def debug(self, message, source="API"):
-        caller_info = self._get_caller_info()
-        self.logger.bind(**caller_info).debug(f"[{source}] {message}")
-
-    async def request_logger(self, request):
-        caller_info = self._get_caller_info()
-        self.logger.bind(**caller_info).info(f"请求: {request.method} {request.path}", "Request")
 
 # 禁用标准 logging 模块以避免与 loguru 冲突
 import logging
 logging.disable(logging.CRITICAL)
 
-logger = Logger(level="INFO")
+# LOG_LEVEL 控制输出级别；流式热循环中的逐块调试日志每 LOG_SAMPLE_EVERY 条输出一次
+logger = log_util.Logger(
+    level=os.environ.get("LOG_LEVEL", "INFO"),
+    sample_every=int(os.environ.get("LOG_SAMPLE_EVERY", 100))
+)
+# 数据目录在 bootstrap 时创建，导入模块本身不读写文件
 DATA_DIR = Path("./data")
 
-if not DATA_DIR.exists():
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
+
+def load_json_env(name):
+    """读取值为JSON对象的环境变量，未设置时为空字典，格式错误时指明是哪个变量"""
+    raw = os.environ.get(name) or "{}"
+    try:
+        value = json_util.loads(raw)
+    except ValueError as error:
+        raise ValueError(f"环境变量 {name} 不是合法的JSON: {error}") from None
+    if not isinstance(value, dict):
+        raise ValueError(f"环境变量 {name} 必须是JSON对象，当前为 {type(value).__name__}")
+    return value
+
+
 CONFIG = {
     "MODELS": {
         "grok-3": "grok-3",
@@ -113,32 +69,85 @@ CONFIG = {
     "API": {
         "IS_TEMP_CONVERSATION": os.environ.get("IS_TEMP_CONVERSATION", "true").lower() == "true",
         "IS_CUSTOM_SSO": os.environ.get("IS_CUSTOM_SSO", "false").lower() == "true",
-        "BASE_URL": "https://grok.com",
+        # 上游地址，压测时可指向本地模拟服务（benchmarks/mock_grok.py）
+        "BASE_URL": (os.environ.get("GROK_BASE_URL") or "https://grok.com").rstrip("/"),
+        "ASSETS_URL": (os.environ.get("GROK_ASSETS_URL") or "https://assets.grok.com").rstrip("/"),
         "API_KEY": os.environ.get("API_KEY", "sk-123456"),
         "SIGNATURE_COOKIE": None,
         "PICGO_KEY": os.environ.get("PICGO_KEY") or None,
         "TUMY_KEY": os.environ.get("TUMY_KEY") or None,
         "RETRY_TIME": 1000,
-        "PROXY": os.environ.get("PROXY") or None
+        "PROXY": os.environ.get("PROXY") or None,
+        # 客户端在收到任何内容前断开时，是否回退本次请求占用的令牌次数
+        "REFUND_ON_DISCONNECT": os.environ.get("REFUND_ON_DISCONNECT", "false").lower() == "true",
+        # 按API_KEY覆盖的配置，如 {"sk-xxx": {"STREAM": {"COALESCE_MS": 50}}}
+        "KEY_OPTIONS": load_json_env("API_KEY_OPTIONS")
     },
     "ADMIN": {
         "MANAGER_SWITCH": os.environ.get("MANAGER_SWITCH") or None,
-        "PASSWORD": os.environ.get("ADMINPASSWORD") or None
+        "PASSWORD": os.environ.get("ADMINPASSWORD") or None,
+        # 令牌状态查询接口检查过期令牌的最小间隔（秒），间隔内的轮询直接返回缓存的快照
+        "STATUS_REFRESH_SECONDS": float(os.environ.get("TOKEN_STATUS_REFRESH_SECONDS", 5))
+    },
+    "TOKEN_PROBE": {
+        # 后台定期探测令牌是否仍可用，默认关闭；多进程部署时每个worker各自探测
+        "ENABLED": os.environ.get("TOKEN_PROBE", "false").lower() == "true",
+        "INTERVAL_SECONDS": float(os.environ.get("TOKEN_PROBE_INTERVAL", 1800)),
+        "INITIAL_DELAY_SECONDS": float(os.environ.get("TOKEN_PROBE_INITIAL_DELAY", 60)),
+        "CONCURRENCY": int(os.environ.get("TOKEN_PROBE_CONCURRENCY", 4)),
+        # 每秒最多发起的探测数，0为不限速
+        "RATE": float(os.environ.get("TOKEN_PROBE_RATE", 2)),
+        "TIMEOUT": float(os.environ.get("TOKEN_PROBE_TIMEOUT", 15)),
+        # 连续多少次被上游拒绝后把令牌标为 invalid 并移出轮换
+        "FAIL_THRESHOLD": int(os.environ.get("TOKEN_PROBE_FAIL_THRESHOLD", 2))
     },
     "SERVER": {
         "COOKIE": None,
         "CF_CLEARANCE":os.environ.get("CF_CLEARANCE") or None,
-        "PORT": int(os.environ.get("PORT", 5200))
+        "PORT": int(os.environ.get("PORT", 5200)),
+        # 收到退出信号后等待在途请求的秒数，超过后流式响应主动收尾；应小于 gunicorn 的 graceful_timeout
+        "SHUTDOWN_DRAIN_SECONDS": float(os.environ.get("SHUTDOWN_DRAIN_SECONDS", 20))
     },
     "RETRY": {
         "RETRYSWITCH": False,
         "MAX_ATTEMPTS": 2
     },
+    "STREAM": {
+        # SSE分片合并，两个阈值都为0时关闭
+        "COALESCE_MS": int(os.environ.get("STREAM_COALESCE_MS", 0)),
+        "COALESCE_BYTES": int(os.environ.get("STREAM_COALESCE_BYTES", 0)),
+        # 上游静默超过该秒数时发送SSE注释保活
+        "KEEPALIVE_SECONDS": float(os.environ.get("STREAM_KEEPALIVE_SECONDS", 15)),
+        # 设置后把上游原始NDJSON脱敏录制到该目录，用于回放测试，默认关闭
+        "RECORD_DIR": os.environ.get("RECORD_UPSTREAM_DIR") or None
+    },
+    "IMAGE": {
+        # 生图下载与图床上传的后台线程数
+        "WORKERS": int(os.environ.get("IMAGE_WORKERS", 4)),
+        # 未配置图床时生成的图片缓存在本地，通过 /images/<id> 访问
+        "CACHE_DIR": str(DATA_DIR / "images"),
+        "CACHE_MAX_MB": int(os.environ.get("IMAGE_CACHE_MAX_MB", 512)),
+        # 图片链接的公网前缀，不填时使用请求的Host
+        "PUBLIC_BASE_URL": (os.environ.get("IMAGE_BASE_URL") or "").rstrip("/") or None,
+        # 图床上传：并发上限、单次超时（秒）、失败重试次数，上传地址可替换为自建或本地替身服务
+        "UPLOAD_CONCURRENCY": int(os.environ.get("IMAGE_UPLOAD_CONCURRENCY", 4)),
+        "UPLOAD_TIMEOUT": float(os.environ.get("IMAGE_UPLOAD_TIMEOUT", 30)),
+        "UPLOAD_RETRIES": int(os.environ.get("IMAGE_UPLOAD_RETRIES", 2)),
+        "PICGO_UPLOAD_URL": os.environ.get("PICGO_UPLOAD_URL") or None,
+        "TUMY_UPLOAD_URL": os.environ.get("TUMY_UPLOAD_URL") or None,
+        # 按模型覆盖转码配置，如 {"grok-3-imageGen": {"MAX_DIMENSION": 1024}}
+        "TRANSCODE_BY_MODEL": load_json_env("IMAGE_TRANSCODE_MODELS")
+    },
+    "IMAGE_TRANSCODE": {
+        # 生成图片与用户上传图片的缩放和转码，需要安装Pillow
+        "ENABLED": os.environ.get("IMAGE_TRANSCODE", "false").lower() == "true",
+        "MAX_DIMENSION": int(os.environ.get("IMAGE_MAX_DIMENSION", 0)),
+        "FORMAT": os.environ.get("IMAGE_FORMAT", "webp"),
+        "QUALITY": int(os.environ.get("IMAGE_QUALITY", 85)),
+        "WORKERS": int(os.environ.get("IMAGE_TRANSCODE_WORKERS", 2))
+    },
     "TOKEN_STATUS_FILE": str(DATA_DIR / "token_status.json"),
     "SHOW_THINKING": os.environ.get("SHOW_THINKING", "false").lower() == "true",
-    "IS_THINKING": False,
-    "IS_IMG_GEN": False,
-    "IS_IMG_GEN2": False,
     "ISSHOW_SEARCH_RESULTS": os.environ.get("ISSHOW_SEARCH_RESULTS", "true").lower() == "true",
     "IS_SUPER_GROK": os.environ.get("IS_SUPER_GROK", "false").lower() == "true"
 }
@@ -163,6 +172,11 @@ DEFAULT_HEADERS = {
     'x-statsig-id': 'ZTpUeXBlRXJyb3I6IENhbm5vdCByZWFkIHByb3BlcnRpZXMgb2YgdW5kZWZpbmVkIChyZWFkaW5nICdjaGlsZE5vZGVzJyk='
 }
 
+# 令牌变化记录保留的条数，订阅方落后超过这么多次变化时需要整页刷新
+TOKEN_CHANGE_LOG_SIZE = 10000
+# 令牌状态修改后等待该秒数再写盘，期间的多次修改合并为一次写入
+TOKEN_STATUS_FLUSH_SECONDS = 1.0
+
 class AuthTokenManager:
     def __init__(self):
         self.token_model_map = {}
@@ -213,13 +227,75 @@ class AuthTokenManager:
         self.token_reset_switch = False
         self.token_reset_timer = None
         self.usage_records_file = str(DATA_DIR / "token_usage_records.json")
+        # 令牌状态或使用记录每次变化时递增，管理接口据此判断快照是否需要重建
+        self.state_version = 0
+        self.last_expiry_check = 0.0
+        # 最近的变化记录 (版本, 变化的sso元组或None)，供管理界面增量订阅
+        self.change_log = deque(maxlen=TOKEN_CHANGE_LOG_SIZE)
+        # 后台探测得到的健康状态 {sso: {...}}，以及因探测失效暂时移出轮换的令牌
+        self.token_health = {}
+        self.quarantined_tokens = {}
+        self._init_runtime_state()
+
+    def _init_runtime_state(self):
+        """锁和定时器不能序列化，pickle 时丢弃，加载后重新创建"""
+        # 令牌池的轮换队列由请求线程、定时重置线程和健康探测线程共同修改，租用、移除和探测结果都在此锁内进行
+        self._lock = threading.RLock()
+        self._status_dirty = False
+        self._status_flush_timer = None
+        self._status_lock = threading.Lock()
+        self._status_write_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("_lock", "_status_dirty", "_status_flush_timer", "_status_lock", "_status_write_lock"):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_runtime_state()
+
+    def mark_changed(self, *ssos):
+        """
+        修改令牌池、状态或使用记录后调用
+
+        ssos 为状态发生变化的令牌；不传表示变化范围未知（如批量重置），增量订阅方需要整页刷新。
+        """
+        self.state_version += 1
+        self.change_log.append((self.state_version, ssos or None))
     def save_token_status(self):
-        try:
-            with open(CONFIG["TOKEN_STATUS_FILE"], 'w', encoding='utf-8') as f:
-                json.dump(self.token_status_map, f, indent=2, ensure_ascii=False)
-            logger.info("令牌状态已保存到配置文件", "TokenManager")
-        except Exception as error:
-            logger.error(f"保存令牌状态失败: {str(error)}", "TokenManager")
+        """
+        标记令牌状态需要保存，TOKEN_STATUS_FLUSH_SECONDS 内的多次修改由后台定时器合并为一次写入
+
+        每次租用令牌都会调用，不能在请求线程中同步写盘；需要立即落盘时调用 flush_token_status。
+        """
+        with self._status_lock:
+            self._status_dirty = True
+            if self._status_flush_timer is None:
+                timer = threading.Timer(TOKEN_STATUS_FLUSH_SECONDS, self.flush_token_status)
+                timer.daemon = True
+                self._status_flush_timer = timer
+                timer.start()
+
+    def flush_token_status(self):
+        """立即原子写入尚未保存的令牌状态，退出前和定期持久化时调用"""
+        with self._status_write_lock:
+            with self._status_lock:
+                if self._status_flush_timer is not None:
+                    self._status_flush_timer.cancel()
+                    self._status_flush_timer = None
+                if not self._status_dirty:
+                    return
+                self._status_dirty = False
+            try:
+                with self._lock:
+                    data = json.dumps(self.token_status_map, indent=2, ensure_ascii=False)
+                lifecycle_util.atomic_write(CONFIG["TOKEN_STATUS_FILE"], data)
+                logger.debug("令牌状态已保存到配置文件", "TokenManager")
+            except Exception as error:
+                logger.error(f"保存令牌状态失败: {str(error)}", "TokenManager")
+                self.save_token_status()
 
     def load_token_status(self):
         try:
@@ -234,8 +310,8 @@ class AuthTokenManager:
     def save_usage_records(self):
         """保存token使用记录"""
         try:
-            with open(self.usage_records_file, 'w', encoding='utf-8') as f:
-                json.dump(self.token_usage_records, f, indent=2, ensure_ascii=False)
+            lifecycle_util.atomic_write(
+                self.usage_records_file, json.dumps(self.token_usage_records, indent=2, ensure_ascii=False))
             logger.info("token使用记录已保存", "TokenManager")
         except Exception as error:
             logger.error(f"保存token使用记录失败: {str(error)}", "TokenManager")
@@ -287,6 +363,7 @@ class AuthTokenManager:
             })
             if len(record["call_history"]) > 100:
                 record["call_history"] = record["call_history"][-100:]
+            self.mark_changed(sso)
             
             # 定期保存记录
             if record["total_calls"] % 10 == 0:  # 每10次调用保存一次
@@ -310,41 +387,110 @@ class AuthTokenManager:
             logger.error(f"获取使用统计失败: {str(error)}", "TokenManager")
             return {}
     def add_token(self, tokens, isinitialization=False):
-        tokenType = tokens.get("type")
-        tokenSso = tokens.get("token")
-        if tokenType == "normal":
-            self.model_config = self.model_normal_config
-        else:
-            self.model_config = self.model_super_config
-        sso = tokenSso.split("sso=")[1].split(";")[0]
+        with self._lock:
+            tokenType = tokens.get("type")
+            tokenSso = tokens.get("token")
+            if tokenType == "normal":
+                self.model_config = self.model_normal_config
+            else:
+                self.model_config = self.model_super_config
+            sso = tokenSso.split("sso=")[1].split(";")[0]
 
-        for model in self.model_config.keys():
-            if model not in self.token_model_map:
-                self.token_model_map[model] = []
-            if sso not in self.token_status_map:
-                self.token_status_map[sso] = {}
-
-            existing_token_entry = next((entry for entry in self.token_model_map[model] if entry["token"] == tokenSso), None)
-
-            if not existing_token_entry:
-                self.token_model_map[model].append({
-                    "token": tokenSso,
-                    "MaxRequestCount": self.model_config[model]["RequestFrequency"],
-                    "RequestCount": 0,
-                    "AddedTime": int(time.time() * 1000),
-                    "StartCallTime": None,
-                    "type": tokenType
-                })
-
-                if model not in self.token_status_map[sso]:
-                    self.token_status_map[sso][model] = {
-                        "isValid": True,
-                        "invalidatedTime": None,
-                        "totalRequestCount": 0,
-                        "isSuper":tokenType == "super"
-                    }
-        if not isinitialization:
-            self.save_token_status()
+            for model in self.model_config.keys():
+                if model not in self.token_model_map:
+                    self.token_model_map[model] = []
+                if sso not in self.token_status_map:
+                    self.token_status_map[sso] = {}
+
+                existing_token_entry = next((entry for entry in self.token_model_map[model] if entry["token"] == tokenSso), None)
+
+                if not existing_token_entry:
+                    self.token_model_map[model].append({
+                        "token": tokenSso,
+                        "MaxRequestCount": self.model_config[model]["RequestFrequency"],
+                        "RequestCount": 0,
+                        "AddedTime": int(time.time() * 1000),
+                        "StartCallTime": None,
+                        "type": tokenType
+                    })
+
+                    if model not in self.token_status_map[sso]:
+                        self.token_status_map[sso][model] = {
+                            "isValid": True,
+                            "invalidatedTime": None,
+                            "totalRequestCount": 0,
+                            "isSuper":tokenType == "super"
+                        }
+            self.mark_changed(sso)
+            if not isinitialization:
+                self.save_token_status()
+
+    def add_tokens(self, ssos, token_type="normal", isinitialization=False):
+        """
+        批量添加令牌：每个模型只建一次已有令牌集合用于去重，全部添加后只保存一次状态文件
+
+        Args:
+            ssos: sso 值列表，也接受 "sso=xxx" 或完整Cookie形式
+            token_type: normal / super
+
+        Returns:
+            list: 与输入一一对应的 {"sso", "result"}，result 为 added 已添加 / exists 已在令牌池中 /
+            duplicate 与本批前面的重复 / invalid 格式错误
+        """
+        with self._lock:
+            model_config = self.model_normal_config if token_type == "normal" else self.model_super_config
+            existing = {}
+            for model in model_config:
+                model_tokens = self.token_model_map.setdefault(model, [])
+                existing[model] = {entry["token"] for entry in model_tokens}
+
+            now = int(time.time() * 1000)
+            seen = set()
+            added = []
+            results = []
+            for value in ssos:
+                sso = value.split("sso=")[1].split(";")[0] if isinstance(value, str) and "sso=" in value else value
+                sso = sso.strip() if isinstance(sso, str) else ""
+                if not sso or any(char in sso for char in " \t\r\n;,="):
+                    results.append({"sso": value, "result": "invalid"})
+                    continue
+                if sso in seen:
+                    results.append({"sso": sso, "result": "duplicate"})
+                    continue
+                seen.add(sso)
+
+                token_sso = f"sso-rw={sso};sso={sso}"
+                model_status = self.token_status_map.setdefault(sso, {})
+                is_added = False
+                for model, config in model_config.items():
+                    if token_sso in existing[model]:
+                        continue
+                    self.token_model_map[model].append({
+                        "token": token_sso,
+                        "MaxRequestCount": config["RequestFrequency"],
+                        "RequestCount": 0,
+                        "AddedTime": now,
+                        "StartCallTime": None,
+                        "type": token_type
+                    })
+                    existing[model].add(token_sso)
+                    if model not in model_status:
+                        model_status[model] = {
+                            "isValid": True,
+                            "invalidatedTime": None,
+                            "totalRequestCount": 0,
+                            "isSuper": token_type == "super"
+                        }
+                    is_added = True
+                if is_added:
+                    added.append(sso)
+                results.append({"sso": sso, "result": "added" if is_added else "exists"})
+
+            if added:
+                self.mark_changed(*added)
+                if not isinitialization:
+                    self.save_token_status()
+            return results
 
     def set_token(self, tokens):
         tokenType = tokens.get("type")
@@ -371,137 +517,155 @@ class AuthTokenManager:
             "totalRequestCount": 0,
             "isSuper":tokenType == "super"
         } for model in models}
+        self.mark_changed(sso)
 
     def delete_token(self, token):
-        try:
-            sso = token.split("sso=")[1].split(";")[0]
-            for model in self.token_model_map:
-                self.token_model_map[model] = [entry for entry in self.token_model_map[model] if entry["token"] != token]
-
-            if sso in self.token_status_map:
-                del self.token_status_map[sso]
-
-            self.save_token_status()
+        with self._lock:
+            try:
+                sso = token.split("sso=")[1].split(";")[0]
+                for model in self.token_model_map:
+                    self.token_model_map[model] = [entry for entry in self.token_model_map[model] if entry["token"] != token]
 
-            logger.info(f"令牌已成功移除: {token}", "TokenManager")
-            return True
-        except Exception as error:
-            logger.error(f"令牌删除失败: {str(error)}")
-            return False
-    def reduce_token_request_count(self, model_id, count):
-        try:
-            normalized_model = self.normalize_model_name(model_id)
+                if sso in self.token_status_map:
+                    del self.token_status_map[sso]
+                self.token_health.pop(sso, None)
+                self.quarantined_tokens.pop(sso, None)
 
-            if normalized_model not in self.token_model_map:
-                logger.error(f"模型 {normalized_model} 不存在", "TokenManager")
-                return False
+                self.mark_changed(sso)
+                self.save_token_status()
 
-            if not self.token_model_map[normalized_model]:
-                logger.error(f"模型 {normalized_model} 没有可用的token", "TokenManager")
+                logger.info(f"令牌已成功移除: {Utils.mask_secret(token)}", "TokenManager")
+                return True
+            except Exception as error:
+                logger.error(f"令牌删除失败: {str(error)}")
                 return False
+    def reduce_token_request_count(self, model_id, count, token=None):
+        with self._lock:
+            try:
+                normalized_model = self.normalize_model_name(model_id)
+
+                if normalized_model not in self.token_model_map:
+                    logger.error(f"模型 {normalized_model} 不存在", "TokenManager")
+                    return False
+
+                if not self.token_model_map[normalized_model]:
+                    logger.error(f"模型 {normalized_model} 没有可用的token", "TokenManager")
+                    return False
+
+                if token:
+                    # 指定token时只回退该token的计数，它可能已不在队首
+                    token_entry = next((entry for entry in self.token_model_map[normalized_model] if entry["token"] == token), None)
+                    if not token_entry:
+                        logger.warning(f"模型 {normalized_model} 中未找到待回退的token", "TokenManager")
+                        return False
+                else:
+                    token_entry = self.token_model_map[normalized_model][0]
 
-            token_entry = self.token_model_map[normalized_model][0]
+                # 确保RequestCount不会小于0
+                new_count = max(0, token_entry["RequestCount"] - count)
+                reduction = token_entry["RequestCount"] - new_count
 
-            # 确保RequestCount不会小于0
-            new_count = max(0, token_entry["RequestCount"] - count)
-            reduction = token_entry["RequestCount"] - new_count
+                token_entry["RequestCount"] = new_count
 
-            token_entry["RequestCount"] = new_count
+                # 更新token状态
+                if token_entry["token"]:
+                    sso = token_entry["token"].split("sso=")[1].split(";")[0]
+                    if sso in self.token_status_map and normalized_model in self.token_status_map[sso]:
+                        self.token_status_map[sso][normalized_model]["totalRequestCount"] = max(
+                            0,
+                            self.token_status_map[sso][normalized_model]["totalRequestCount"] - reduction
+                        )
+                    self.mark_changed(sso)
+                return True
 
-            # 更新token状态
-            if token_entry["token"]:
-                sso = token_entry["token"].split("sso=")[1].split(";")[0]
-                if sso in self.token_status_map and normalized_model in self.token_status_map[sso]:
-                    self.token_status_map[sso][normalized_model]["totalRequestCount"] = max(
-                        0,
-                        self.token_status_map[sso][normalized_model]["totalRequestCount"] - reduction
-                    )
-            return True
-
-        except Exception as error:
-            logger.error(f"重置校对token请求次数时发生错误: {str(error)}", "TokenManager")
-            return False
+            except Exception as error:
+                logger.error(f"重置校对token请求次数时发生错误: {str(error)}", "TokenManager")
+                return False
     def get_next_token_for_model(self, model_id, is_return=False):
-        normalized_model = self.normalize_model_name(model_id)
+        with self._lock:
+            normalized_model = self.normalize_model_name(model_id)
 
-        if normalized_model not in self.token_model_map or not self.token_model_map[normalized_model]:
-            return None
+            if normalized_model not in self.token_model_map or not self.token_model_map[normalized_model]:
+                return None
 
-        token_entry = self.token_model_map[normalized_model][0]
-        logger.info(f"token_entry: {token_entry}", "TokenManager")
-        if is_return:
-            return token_entry["token"]
+            token_entry = self.token_model_map[normalized_model][0]
+            logger.debug(lambda: f"token_entry: {Utils.mask_secret(token_entry['token'])}, 请求次数: {token_entry['RequestCount']}", "TokenManager")
+            if is_return:
+                return token_entry["token"]
 
-        if token_entry:
-            if token_entry["type"] == "super":
-                self.model_config = self.model_super_config
-            else:
-                self.model_config = self.model_normal_config
-            if token_entry["StartCallTime"] is None:
-                token_entry["StartCallTime"] = int(time.time() * 1000)
+            if token_entry:
+                if token_entry["type"] == "super":
+                    self.model_config = self.model_super_config
+                else:
+                    self.model_config = self.model_normal_config
+                if token_entry["StartCallTime"] is None:
+                    token_entry["StartCallTime"] = int(time.time() * 1000)
 
-            if not self.token_reset_switch:
-                self.start_token_reset_process()
-                self.token_reset_switch = True
+                if not self.token_reset_switch:
+                    self.start_token_reset_process()
+                    self.token_reset_switch = True
 
-            token_entry["RequestCount"] += 1
+                token_entry["RequestCount"] += 1
 
-            # 记录token使用
-            self.record_token_usage(normalized_model, token_entry["token"], True)
+                # 记录token使用
+                self.record_token_usage(normalized_model, token_entry["token"], True)
 
-            if token_entry["RequestCount"] > token_entry["MaxRequestCount"]:
-                self.remove_token_from_model(normalized_model, token_entry["token"])
-                next_token_entry = self.token_model_map[normalized_model][0] if self.token_model_map[normalized_model] else None
-                return next_token_entry["token"] if next_token_entry else None
+                if token_entry["RequestCount"] > token_entry["MaxRequestCount"]:
+                    self.remove_token_from_model(normalized_model, token_entry["token"])
+                    next_token_entry = self.token_model_map[normalized_model][0] if self.token_model_map[normalized_model] else None
+                    return next_token_entry["token"] if next_token_entry else None
 
-            sso = token_entry["token"].split("sso=")[1].split(";")[0]
+                sso = token_entry["token"].split("sso=")[1].split(";")[0]
 
-            if sso in self.token_status_map and normalized_model in self.token_status_map[sso]:
-                if token_entry["RequestCount"] == self.model_config[normalized_model]["RequestFrequency"]:
-                    self.token_status_map[sso][normalized_model]["isValid"] = False
-                    self.token_status_map[sso][normalized_model]["invalidatedTime"] = int(time.time() * 1000)
+                if sso in self.token_status_map and normalized_model in self.token_status_map[sso]:
+                    if token_entry["RequestCount"] == self.model_config[normalized_model]["RequestFrequency"]:
+                        self.token_status_map[sso][normalized_model]["isValid"] = False
+                        self.token_status_map[sso][normalized_model]["invalidatedTime"] = int(time.time() * 1000)
                 
-                # 确保与usage_records保持一致
-                usage_record = self.token_usage_records.get(sso, {}).get(normalized_model, {})
-                if usage_record:
-                    self.token_status_map[sso][normalized_model]["totalRequestCount"] = usage_record.get("total_calls", 0)
-                else:
-                    self.token_status_map[sso][normalized_model]["totalRequestCount"] += 1
+                    # 确保与usage_records保持一致
+                    usage_record = self.token_usage_records.get(sso, {}).get(normalized_model, {})
+                    if usage_record:
+                        self.token_status_map[sso][normalized_model]["totalRequestCount"] = usage_record.get("total_calls", 0)
+                    else:
+                        self.token_status_map[sso][normalized_model]["totalRequestCount"] += 1
 
-                self.save_token_status()
+                    self.mark_changed(sso)
+                    self.save_token_status()
 
-            return token_entry["token"]
+                return token_entry["token"]
 
-        return None
+            return None
 
     def remove_token_from_model(self, model_id, token):
-        normalized_model = self.normalize_model_name(model_id)
+        with self._lock:
+            normalized_model = self.normalize_model_name(model_id)
 
-        if normalized_model not in self.token_model_map:
-            logger.error(f"模型 {normalized_model} 不存在", "TokenManager")
-            return False
+            if normalized_model not in self.token_model_map:
+                logger.error(f"模型 {normalized_model} 不存在", "TokenManager")
+                return False
 
-        model_tokens = self.token_model_map[normalized_model]
-        token_index = next((i for i, entry in enumerate(model_tokens) if entry["token"] == token), -1)
+            model_tokens = self.token_model_map[normalized_model]
+            token_index = next((i for i, entry in enumerate(model_tokens) if entry["token"] == token), -1)
 
-        if token_index != -1:
-            removed_token_entry = model_tokens.pop(token_index)
-            self.expired_tokens.add((
-                removed_token_entry["token"],
-                normalized_model,
-                int(time.time() * 1000),
-                removed_token_entry["type"]
-            ))
+            if token_index != -1:
+                removed_token_entry = model_tokens.pop(token_index)
+                self.expired_tokens.add((
+                    removed_token_entry["token"],
+                    normalized_model,
+                    int(time.time() * 1000),
+                    removed_token_entry["type"]
+                ))
+                self.mark_changed(removed_token_entry["token"].split("sso=")[1].split(";")[0])
 
-            if not self.token_reset_switch:
-                self.start_token_reset_process()
-                self.token_reset_switch = True
+                if not self.token_reset_switch:
+                    self.start_token_reset_process()
+                    self.token_reset_switch = True
 
-            logger.info(f"模型{model_id}的令牌已失效，已成功移除令牌: {token}", "TokenManager")
-            return True
+                logger.info(f"模型{model_id}的令牌已失效，已成功移除令牌: {Utils.mask_secret(token)}", "TokenManager")
+                return True
 
-        logger.error(f"在模型 {normalized_model} 中未找到 token: {token}", "TokenManager")
-        return False
+            logger.error(f"在模型 {normalized_model} 中未找到 token: {Utils.mask_secret(token)}", "TokenManager")
+            return False
 
     def get_expired_tokens(self):
         return list(self.expired_tokens)
@@ -595,11 +759,14 @@ class AuthTokenManager:
                         # 记录token重置
                         logger.info(f"Token定时重置: {model}, sso: {sso[:8]}..., 类型: {token_entry['type']}", "TokenManager")
 
+            self.mark_changed()
+
         import threading
         # 启动一个线程执行定时任务，每30分钟执行一次（更频繁检查2小时重置）
         def run_timer():
             while True:
-                reset_expired_tokens()
+                with self._lock:
+                    reset_expired_tokens()
                 time.sleep(1800)  # 30分钟检查一次
 
         timer_thread = threading.Thread(target=run_timer)
@@ -624,95 +791,399 @@ class AuthTokenManager:
     def get_token_status_map(self):
         return self.token_status_map
 
-    def check_and_reset_expired_tokens(self):
-        """检查并重置过期的token状态"""
+    def get_token_tier(self, token):
+        """根据令牌状态判断会员类型，返回 super / normal"""
         try:
-            now = int(time.time() * 1000)
-            
-            # 检查expired_tokens中的token是否可以重置
-            tokens_to_remove = set()
-            for token_info in self.expired_tokens:
-                token, model, expired_time, type = token_info
-                model_config = self.model_super_config if type == "super" else self.model_normal_config
-                expiration_time = model_config[model]["ExpirationTime"]
-
-                if now - expired_time >= expiration_time:
-                    # 重新激活token
-                    if not any(entry["token"] == token for entry in self.token_model_map.get(model, [])):
-                        if model not in self.token_model_map:
-                            self.token_model_map[model] = []
+            sso = token.split("sso=")[1].split(";")[0]
+        except (AttributeError, IndexError):
+            return "unknown"
+        model_status = self.token_status_map.get(sso, {})
+        return "super" if any(status.get("isSuper") for status in model_status.values()) else "normal"
+
+    def get_token_pool_stats(self):
+        """
+        按模型和会员类型统计可用与已过期（等待重置）的令牌数
+
+        Returns:
+            dict: {(模型, 类型, 状态): 数量}，状态为 ready / expired
+        """
+        stats = {}
+        for model, model_tokens in list(self.token_model_map.items()):
+            for entry in list(model_tokens):
+                key = (model, entry.get("type") or "normal", "ready")
+                stats[key] = stats.get(key, 0) + 1
+        for _, model, _, token_type in list(self.expired_tokens):
+            key = (model, token_type or "normal", "expired")
+            stats[key] = stats.get(key, 0) + 1
+        return stats
 
-                        self.token_model_map[model].append({
-                            "token": token,
-                            "MaxRequestCount": model_config[model]["RequestFrequency"],
-                            "RequestCount": 0,
-                            "AddedTime": now,
-                            "StartCallTime": None,
-                            "type": type
-                        })
+    def check_and_reset_expired_tokens(self):
+        """
+        检查并重置过期的token状态，只有确实重置了令牌时才保存
 
-                    sso = token.split("sso=")[1].split(";")[0] if "sso=" in token else "unknown"
-                    if sso in self.token_status_map and model in self.token_status_map[sso]:
-                        self.token_status_map[sso][model]["isValid"] = True
-                        self.token_status_map[sso][model]["invalidatedTime"] = None
-                        self.token_status_map[sso][model]["totalRequestCount"] = 0
-                        self.token_status_map[sso][model]["isSuper"] = type == "super"
+        Returns:
+            bool: 是否有令牌被重置
+        """
+        with self._lock:
+            try:
+                now = int(time.time() * 1000)
+            
+                # 检查expired_tokens中的token是否可以重置
+                tokens_to_remove = set()
+                for token_info in self.expired_tokens:
+                    token, model, expired_time, type = token_info
+                    model_config = self.model_super_config if type == "super" else self.model_normal_config
+                    expiration_time = model_config[model]["ExpirationTime"]
 
-                    logger.info(f"Token已重置: {model}, sso: {sso[:8]}..., 类型: {type}", "TokenManager")
-                    tokens_to_remove.add(token_info)
+                    if now - expired_time >= expiration_time:
+                        # 重新激活token
+                        if not any(entry["token"] == token for entry in self.token_model_map.get(model, [])):
+                            if model not in self.token_model_map:
+                                self.token_model_map[model] = []
+
+                            self.token_model_map[model].append({
+                                "token": token,
+                                "MaxRequestCount": model_config[model]["RequestFrequency"],
+                                "RequestCount": 0,
+                                "AddedTime": now,
+                                "StartCallTime": None,
+                                "type": type
+                            })
+
+                        sso = token.split("sso=")[1].split(";")[0] if "sso=" in token else "unknown"
+                        if sso in self.token_status_map and model in self.token_status_map[sso]:
+                            self.token_status_map[sso][model]["isValid"] = True
+                            self.token_status_map[sso][model]["invalidatedTime"] = None
+                            self.token_status_map[sso][model]["totalRequestCount"] = 0
+                            self.token_status_map[sso][model]["isSuper"] = type == "super"
 
-            self.expired_tokens -= tokens_to_remove
+                        logger.info(f"Token已重置: {model}, sso: {sso[:8]}..., 类型: {type}", "TokenManager")
+                        tokens_to_remove.add(token_info)
 
-            # 检查当前活跃token是否需要重置
-            for model in list(self.token_model_map.keys()):
-                if model not in self.token_model_map:
-                    continue
+                self.expired_tokens -= tokens_to_remove
+                changed = bool(tokens_to_remove)
 
-                for token_entry in self.token_model_map[model]:
-                    if not token_entry.get("StartCallTime"):
+                # 检查当前活跃token是否需要重置
+                for model in list(self.token_model_map.keys()):
+                    if model not in self.token_model_map:
                         continue
 
-                    model_config = self.model_super_config if token_entry["type"] == "super" else self.model_normal_config
-                    expiration_time = model_config[model]["ExpirationTime"]
+                    for token_entry in self.token_model_map[model]:
+                        if not token_entry.get("StartCallTime"):
+                            continue
+
+                        model_config = self.model_super_config if token_entry["type"] == "super" else self.model_normal_config
+                        expiration_time = model_config[model]["ExpirationTime"]
                     
-                    if now - token_entry["StartCallTime"] >= expiration_time:
-                        sso = token_entry["token"].split("sso=")[1].split(";")[0] if "sso=" in token_entry["token"] else "unknown"
+                        if now - token_entry["StartCallTime"] >= expiration_time:
+                            sso = token_entry["token"].split("sso=")[1].split(";")[0] if "sso=" in token_entry["token"] else "unknown"
                         
-                        if sso in self.token_status_map and model in self.token_status_map[sso]:
-                            self.token_status_map[sso][model]["isValid"] = True
-                            self.token_status_map[sso][model]["invalidatedTime"] = None
-                            self.token_status_map[sso][model]["totalRequestCount"] = 0
-                            self.token_status_map[sso][model]["isSuper"] = token_entry["type"] == "super"
-
-                        token_entry["RequestCount"] = 0
-                        token_entry["StartCallTime"] = None
+                            if sso in self.token_status_map and model in self.token_status_map[sso]:
+                                self.token_status_map[sso][model]["isValid"] = True
+                                self.token_status_map[sso][model]["invalidatedTime"] = None
+                                self.token_status_map[sso][model]["totalRequestCount"] = 0
+                                self.token_status_map[sso][model]["isSuper"] = token_entry["type"] == "super"
+
+                            token_entry["RequestCount"] = 0
+                            token_entry["StartCallTime"] = None
+                            changed = True
                         
-                        logger.info(f"Token实时重置: {model}, sso: {sso[:8]}..., 类型: {token_entry['type']}", "TokenManager")
+                            logger.info(f"Token实时重置: {model}, sso: {sso[:8]}..., 类型: {token_entry['type']}", "TokenManager")
 
-            # 保存更新后的状态
-            self.save_token_status()
+                # 有变化时才保存更新后的状态
+                if changed:
+                    self.mark_changed()
+                    self.save_token_status()
+                return changed
             
-        except Exception as error:
-            logger.error(f"检查和重置过期token时发生错误: {str(error)}", "TokenManager")
+            except Exception as error:
+                logger.error(f"检查和重置过期token时发生错误: {str(error)}", "TokenManager")
+                return False
+
+    def refresh_expired_tokens(self, min_interval):
+        """
+        供状态查询接口调用的过期检查，距上次检查不足 min_interval 秒时直接跳过，
+        避免每次轮询都扫描全部令牌
+        """
+        now = time.monotonic()
+        if now - self.last_expiry_check < min_interval:
+            return False
+        self.last_expiry_check = now
+        return self.check_and_reset_expired_tokens()
+
+    def get_token_changes(self, since):
+        """
+        查询 since 版本之后状态发生变化的令牌
+
+        Returns:
+            tuple: (当前版本, sso集合)；变化记录已无法覆盖 since 之后的全部变化，
+            或其中有范围未知的变化时 sso集合为 None，调用方应整体刷新。
+            since 大于当前版本（服务重启或请求落到另一个worker）时同样返回 None
+        """
+        version = self.state_version
+        if since > version:
+            return version, None
+        if since == version:
+            return version, set()
+        log = list(self.change_log)
+        if not log or log[0][0] > since + 1:
+            return version, None
+        changed = set()
+        for entry_version, ssos in reversed(log):
+            if entry_version <= since:
+                break
+            if ssos is None:
+                return version, None
+            changed.update(ssos)
+        return version, changed
+
+    def query_token_status(self, page=1, page_size=30, search=None, status=None, model=None, tier=None, sort=None,
+                           health=None):
+        """
+        分页查询令牌状态
+
+        Args:
+            search: sso 包含的子串（不区分大小写）
+            status: active 有可用模型 / expired 有失效模型，指定 model 时只看该模型
+            model: 只返回包含该模型的令牌
+            tier: super / normal
+            health: ok / suspect / invalid / unchecked（尚未探测）
+            sort: added 添加顺序（默认）/ token / usage 已用次数降序 / invalidated 最近失效在前
+
+        Returns:
+            dict: {"total", "page", "page_size", "pages", "items": [{"sso", "models", "health"}]}
+        """
+        search = search.lower() if search else None
+        rows = []
+        for sso, models in list(self.token_status_map.items()):
+            if search and search not in sso.lower():
+                continue
+            if model:
+                if model not in models:
+                    continue
+                entries = [models[model]]
+            else:
+                entries = list(models.values())
+            if status == "active" and not any(entry.get("isValid") for entry in entries):
+                continue
+            if status == "expired" and all(entry.get("isValid") for entry in entries):
+                continue
+            if tier and (tier == "super") != any(entry.get("isSuper") for entry in models.values()):
+                continue
+            if health and self.token_health.get(sso, {}).get("status", "unchecked") != health:
+                continue
+            rows.append((sso, models, entries))
+
+        if sort == "token":
+            rows.sort(key=lambda row: row[0])
+        elif sort == "usage":
+            rows.sort(key=lambda row: sum(entry.get("totalRequestCount", 0) for entry in row[2]), reverse=True)
+        elif sort == "invalidated":
+            rows.sort(key=lambda row: max((entry.get("invalidatedTime") or 0 for entry in row[2]), default=0), reverse=True)
+
+        total = len(rows)
+        pages = max(1, -(-total // page_size))
+        page = min(max(1, page), pages)
+        start = (page - 1) * page_size
+        return {
+            "total": total,
+            "page": page,
+            "page_size": page_size,
+            "pages": pages,
+            "items": [{"sso": sso, "models": models, "health": self.token_health.get(sso)}
+                      for sso, models, _ in rows[start:start + page_size]]
+        }
+
+    def get_token_status_summary(self):
+        """令牌总数、各模型剩余可用次数与探测健康状态计数，供管理界面概览使用"""
+        remaining = {}
+        items = list(self.token_status_map.items())
+        for _, models in items:
+            for model, entry in list(models.items()):
+                if not entry.get("isValid"):
+                    continue
+                model_config = self.model_super_config if entry.get("isSuper") else self.model_normal_config
+                limit = model_config.get(model, {}).get("RequestFrequency", 0)
+                remaining[model] = remaining.get(model, 0) + max(0, limit - entry.get("totalRequestCount", 0))
+        return {"total_tokens": len(items), "remaining": remaining, "health": self.get_token_health_counts()}
+
+    def get_token_health_counts(self):
+        """各健康状态的令牌数，unchecked 包括从未探测和探测结果都无法判断的令牌"""
+        counts = {"ok": 0, "suspect": 0, "invalid": 0}
+        for health in list(self.token_health.values()):
+            if health["status"] in counts:
+                counts[health["status"]] += 1
+        counts["unchecked"] = max(0, len(self.token_status_map) - sum(counts.values()))
+        return counts
+
+    def get_probe_targets(self):
+        return list(self.token_status_map.keys())
+
+    def record_probe_result(self, sso, outcome, fail_threshold=2):
+        """
+        应用一次健康探测的结果
+
+        上游接受令牌（2xx）时记为 ok；明确拒绝时记为 suspect 并移到各模型轮换队列末尾，连续 fail_threshold 次后
+        记为 invalid 并移出轮换；invalid 的令牌再次探测成功时恢复。无法判断的探测结果（网络错误、风控、429）
+        不改变状态，从未得到过确定结果的令牌保持 unchecked。
+
+        Returns:
+            bool: 健康状态是否发生变化
+        """
+        with self._lock:
+            if sso not in self.token_status_map:
+                return False
+            health = self.token_health.get(sso) or {"status": None, "failures": 0}
+            previous = health["status"]
+            result = outcome["result"]
+            if result == probe_util.PROBE_OK:
+                health["failures"] = 0
+                status = "ok"
+            elif result == probe_util.PROBE_UNAUTHORIZED:
+                health["failures"] += 1
+                status = "invalid" if health["failures"] >= fail_threshold else "suspect"
+            else:
+                status = previous or "unchecked"
+            health.update({
+                "status": status,
+                "checkedAt": int(time.time() * 1000),
+                "result": result,
+                "httpStatus": outcome.get("httpStatus"),
+                "detail": outcome.get("detail")
+            })
+            self.token_health[sso] = health
+
+            if status == (previous or "unchecked"):
+                return False
+            if status == "invalid":
+                self._quarantine_token(sso)
+            elif previous == "invalid":
+                self._restore_token(sso)
+            if status == "suspect":
+                self._demote_token(sso)
+            logger.info(f"令牌健康状态变化: {Utils.mask_secret(sso)} {previous or 'unchecked'} -> {status}", "TokenManager")
+            self.mark_changed(sso)
+            return True
+
+    def _demote_token(self, sso):
+        token = f"sso-rw={sso};sso={sso}"
+        for model_tokens in self.token_model_map.values():
+            index = next((i for i, entry in enumerate(model_tokens) if entry["token"] == token), -1)
+            if index != -1:
+                model_tokens.append(model_tokens.pop(index))
+
+    def _quarantine_token(self, sso):
+        """把令牌从所有模型的轮换和待重置集合中移出，保留原记录以便恢复"""
+        token = f"sso-rw={sso};sso={sso}"
+        entries = []
+        for model, model_tokens in self.token_model_map.items():
+            for entry in model_tokens:
+                if entry["token"] == token:
+                    entries.append((model, entry))
+            self.token_model_map[model] = [entry for entry in model_tokens if entry["token"] != token]
+        expired = {token_info for token_info in self.expired_tokens if token_info[0] == token}
+        self.expired_tokens -= expired
+
+        now = int(time.time() * 1000)
+        status_backup = {}
+        for model, model_status in self.token_status_map.get(sso, {}).items():
+            status_backup[model] = (model_status.get("isValid"), model_status.get("invalidatedTime"))
+            model_status["isValid"] = False
+            model_status["invalidatedTime"] = now
+        self.quarantined_tokens[sso] = {"entries": entries, "expired": expired, "status": status_backup}
+
+    def _restore_token(self, sso):
+        quarantined = self.quarantined_tokens.pop(sso, None)
+        if not quarantined:
+            return
+        for model, entry in quarantined["entries"]:
+            model_tokens = self.token_model_map.setdefault(model, [])
+            # 隔离期间令牌可能被重新导入过
+            if not any(existing["token"] == entry["token"] for existing in model_tokens):
+                model_tokens.append(entry)
+        self.expired_tokens |= quarantined["expired"]
+        for model, (is_valid, invalidated_time) in quarantined["status"].items():
+            model_status = self.token_status_map.get(sso, {}).get(model)
+            if model_status is not None:
+                model_status["isValid"] = is_valid
+                model_status["invalidatedTime"] = invalidated_time
 
 class Utils:
+    @staticmethod
+    def mask_secret(value, visible=8):
+        """日志中只保留令牌/Cookie的前几位"""
+        if not value:
+            return "None"
+        value = str(value)
+        return value[:visible] + "..." if len(value) > visible else "***"
+
+    @staticmethod
+    def snapshot_response(snapshot, prefix=None):
+        """
+        返回缓存的JSON快照，If-None-Match 命中时返回304，较大的响应按 Accept-Encoding 使用gzip
+
+        prefix 为拼接在对象开头的字段（如 b'"current_time":123'），此时响应体每次不同，
+        ETag 标为弱校验，gzip 按次压缩。
+        """
+        headers = {
+            "ETag": snapshot.etag if prefix is None else "W/" + snapshot.etag,
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding"
+        }
+        if snapshot.matches(request.headers.get("If-None-Match")):
+            return Response(status=304, headers=headers)
+
+        if prefix is None:
+            body = snapshot.body
+        else:
+            body = b"{" + prefix + (b"," + snapshot.body[1:] if len(snapshot.body) > 2 else b"}")
+        if len(body) >= snapshot_util.GZIP_MIN_BYTES and "gzip" in request.headers.get("Accept-Encoding", ""):
+            body = snapshot.gzip_body() if prefix is None else snapshot_util.gzip_bytes(body)
+            headers["Content-Encoding"] = "gzip"
+        return Response(body, mimetype="application/json", headers=headers)
+
     @staticmethod
     def organize_search_results(search_results):
-        if not search_results or 'results' not in search_results:
-            return ''
+        return stream_util.organize_search_results(search_results)
 
-        results = search_results['results']
-        formatted_results = []
+    @staticmethod
+    def get_option(section, name, api_key=None, request_value=None):
+        """按 请求参数 > API_KEY专属配置 > 全局CONFIG 的优先级取配置项"""
+        if request_value is not None:
+            return request_value
+        key_options = CONFIG["API"]["KEY_OPTIONS"].get(api_key or "", {}).get(section, {})
+        if name in key_options:
+            return key_options[name]
+        return CONFIG[section][name]
 
-        for index, result in enumerate(results):
-            title = result.get('title', '未知标题')
-            url = result.get('url', '#')
-            preview = result.get('preview', '无预览内容')
+    @staticmethod
+    def create_coalescer(data, api_key):
+        """按请求体的 stream_options 与 API_KEY专属配置创建分片合并器，参数不合法时抛出 ValueError"""
+        stream_options = data.get("stream_options") or {}
+        if not isinstance(stream_options, dict):
+            raise ValueError("stream_options 必须是对象")
+        try:
+            return stream_util.ChunkCoalescer(
+                int(Utils.get_option("STREAM", "COALESCE_MS", api_key, stream_options.get("coalesce_ms"))),
+                int(Utils.get_option("STREAM", "COALESCE_BYTES", api_key, stream_options.get("coalesce_bytes")))
+            )
+        except (TypeError, ValueError):
+            raise ValueError("stream_options.coalesce_ms 和 coalesce_bytes 必须是整数") from None
 
-            formatted_result = f"\r\n<details><summary>资料[{index}]: {title}</summary>\r\n{preview}\r\n\n[Link]({url})\r\n</details>"
-            formatted_results.append(formatted_result)
+    @staticmethod
+    def get_transcode_options(model, api_key=None):
+        """图片转码配置，按 API_KEY专属配置 > 模型配置 > 全局CONFIG 的优先级合并"""
+        options = dict(CONFIG["IMAGE_TRANSCODE"])
+        options.update(CONFIG["IMAGE"]["TRANSCODE_BY_MODEL"].get(model, {}))
+        options.update(CONFIG["API"]["KEY_OPTIONS"].get(api_key or "", {}).get("IMAGE_TRANSCODE", {}))
+        return options
 
-        return '\n\n'.join(formatted_results)
+    @staticmethod
+    def get_public_base_url():
+        """本地图片链接的前缀，没有配置且不在请求上下文中时返回空串（相对链接）"""
+        if CONFIG["IMAGE"]["PUBLIC_BASE_URL"]:
+            return CONFIG["IMAGE"]["PUBLIC_BASE_URL"]
+        return request.host_url.rstrip("/") if has_request_context() else ""
 
     @staticmethod
     def create_auth_headers(model, is_return=False):
@@ -739,10 +1210,11 @@ class Utils:
         return proxy_options
 
 class GrokApiClient:
-    def __init__(self, model_id):
+    def __init__(self, model_id, image_options=None):
         if model_id not in CONFIG["MODELS"]:
             raise ValueError(f"不支持的模型: {model_id}")
         self.model_id = CONFIG["MODELS"][model_id]
+        self.image_options = image_options
 
     def process_message_content(self, content):
         if isinstance(content, str):
@@ -781,12 +1253,13 @@ class GrokApiClient:
             cookie = f"{Utils.create_auth_headers(model, True)};{CONFIG['SERVER']['CF_CLEARANCE']}"
             proxy_options = Utils.get_proxy_options()
             response = curl_requests.post(
-                "https://grok.com/rest/app-chat/upload-file",
+                f"{CONFIG['API']['BASE_URL']}/rest/app-chat/upload-file",
                 headers={
                     **DEFAULT_HEADERS,
+                    "Content-Type": "application/json",
                     "Cookie":cookie
                 },
-                json=upload_data,
+                data=json_util.dumps_bytes(upload_data),
                 impersonate="chrome133a",
                 **proxy_options
             )
@@ -813,6 +1286,15 @@ class GrokApiClient:
             mime_type = image_info["mimeType"]
             file_name = image_info["fileName"]
 
+            if self.image_options and self.image_options.get("ENABLED"):
+                raw_image = base64.b64decode(image_buffer)
+                transcoded, transcoded_type = IMAGE_TRANSCODER.transcode(raw_image, mime_type, self.image_options)
+                if transcoded is not raw_image:
+                    logger.debug(f"用户图片已转码: {len(raw_image)} -> {len(transcoded)} 字节", "Server")
+                    image_buffer = base64.b64encode(transcoded).decode('utf-8')
+                    mime_type = transcoded_type
+                    file_name = f"image.{mime_type.split('/')[1]}"
+
             upload_data = {
                 "rpc": "uploadFile",
                 "req": {
@@ -829,9 +1311,10 @@ class GrokApiClient:
                 url,
                 headers={
                     **DEFAULT_HEADERS,
+                    "Content-Type": "application/json",
                     "Cookie":CONFIG["SERVER"]['COOKIE']
                 },
-                json=upload_data,
+                data=json_util.dumps_bytes(upload_data),
                 impersonate="chrome133a",
                 **proxy_options
             )
@@ -868,11 +1351,6 @@ class GrokApiClient:
     #         logger.error(str(error), "Server")
     #         raise ValueError(error)
     def prepare_chat_request(self, request):
-        if ((request["model"] == 'grok-4-imageGen' or request["model"] == 'grok-3-imageGen') and
-            not CONFIG["API"]["PICGO_KEY"] and not CONFIG["API"]["TUMY_KEY"] and
-            request.get("stream", False)):
-            raise ValueError("该模型流式输出需要配置PICGO或者TUMY图床密钥!")
-
         # system_message, todo_messages = self.convert_system_messages(request["messages"]).values()
         todo_messages = request["messages"]
         if request["model"] in ['grok-4-imageGen', 'grok-3-imageGen', 'grok-3-deepsearch']:
@@ -996,25 +1474,14 @@ class GrokApiClient:
 
 class MessageProcessor:
     @staticmethod
-    def create_chat_response(message, model, is_stream=False):
+    def create_chat_response(message, model):
+        # 流式分片由 stream_util.SSEChunkEncoder 编码，这里只构造非流式响应
         base_response = {
             "id": f"chatcmpl-{uuid.uuid4()}",
             "created": int(time.time()),
             "model": model
         }
 
-        if is_stream:
-            return {
-                **base_response,
-                "object": "chat.completion.chunk",
-                "choices": [{
-                    "index": 0,
-                    "delta": {
-                        "content": message
-                    }
-                }]
-            }
-
         return {
             **base_response,
             "object": "chat.completion",
@@ -1029,82 +1496,16 @@ class MessageProcessor:
             "usage": None
         }
 
-def process_model_response(response, model):
-    result = {"token": None, "imageUrl": None}
-
-    if CONFIG["IS_IMG_GEN"]:
-        if response.get("cachedImageGenerationResponse") and not CONFIG["IS_IMG_GEN2"]:
-            result["imageUrl"] = response["cachedImageGenerationResponse"]["imageUrl"]
-        return result
-    if model == 'grok-3':
-        result["token"] = response.get("token")
-    elif model in ['grok-3-search']:
-        if response.get("webSearchResults") and CONFIG["ISSHOW_SEARCH_RESULTS"]:
-            result["token"] = f"\r\n<think>{Utils.organize_search_results(response['webSearchResults'])}</think>\r\n"
-        else:
-            result["token"] = response.get("token")
-    elif model in ['grok-3-deepsearch', 'grok-3-deepersearch','grok-4-deepsearch']:
-        if response.get("messageStepId") and not CONFIG["SHOW_THINKING"]:
-            return result
-        if response.get("messageStepId") and not CONFIG["IS_THINKING"]:
-            result["token"] = "<think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = True
-        elif not response.get("messageStepId") and CONFIG["IS_THINKING"] and response.get("messageTag") == "final":
-            result["token"] = "</think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = False
-        elif (response.get("messageStepId") and CONFIG["IS_THINKING"] and response.get("messageTag") == "assistant") or response.get("messageTag") == "final":
-            result["token"] = response.get("token","")
-        elif (CONFIG["IS_THINKING"] and response.get("token","").get("action","") == "webSearch"):
-            result["token"] = response.get("token","").get("action_input","").get("query","")
-        elif (CONFIG["IS_THINKING"] and response.get("webSearchResults")):
-            result["token"] = Utils.organize_search_results(response['webSearchResults'])
-    elif model == 'grok-3-reasoning':
-        if response.get("isThinking") and not CONFIG["SHOW_THINKING"]:
-            return result
-
-        if response.get("isThinking") and not CONFIG["IS_THINKING"]:
-            result["token"] = "<think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = True
-        elif not response.get("isThinking") and CONFIG["IS_THINKING"]:
-            result["token"] = "</think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = False
-        else:
-            result["token"] = response.get("token")
-
-    elif model == 'grok-4':
-        if response.get("isThinking"):
-            return result
-        result["token"] = response.get("token")
-    elif model == 'grok-4-reasoning':
-        if response.get("isThinking") and not CONFIG["SHOW_THINKING"]:
-            return result
-        if response.get("isThinking") and not CONFIG["IS_THINKING"] and response.get("messageTag") == "assistant":
-            result["token"] = "<think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = True
-        elif not response.get("isThinking") and CONFIG["IS_THINKING"] and response.get("messageTag") == "final":
-            result["token"] = "</think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = False
-        else:
-            result["token"] = response.get("token")
-    elif model in ['grok-4-deepsearch']:
-        if response.get("messageStepId") and not CONFIG["SHOW_THINKING"]:
-            return result
-        if response.get("messageStepId") and not CONFIG["IS_THINKING"] and response.get("messageTag") == "assistant":
-            result["token"] = "<think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = True
-        elif not response.get("messageStepId") and CONFIG["IS_THINKING"] and response.get("messageTag") == "final":
-            result["token"] = "</think>" + response.get("token", "")
-            CONFIG["IS_THINKING"] = False
-        elif (response.get("messageStepId") and CONFIG["IS_THINKING"] and response.get("messageTag") == "assistant") or response.get("messageTag") == "final":
-            result["token"] = response.get("token","")
-        elif (CONFIG["IS_THINKING"] and response.get("token","").get("action","") == "webSearch"):
-            result["token"] = response.get("token","").get("action_input","").get("query","")
-        elif (CONFIG["IS_THINKING"] and response.get("webSearchResults")):
-            result["token"] = Utils.organize_search_results(response['webSearchResults'])
-
-    return result
-
-def handle_image_response(image_url):
+def create_response_transformer(model):
+    """为单次请求创建独立的响应转换器，流式状态不再放在全局CONFIG中"""
+    return stream_util.create_response_transformer(
+        model,
+        show_thinking=CONFIG["SHOW_THINKING"],
+        show_search_results=CONFIG["ISSHOW_SEARCH_RESULTS"]
+    )
+
+def handle_image_response(image_url, cookie, base_url=None, transcode_options=None):
+    """下载生成的图片，cookie 为发起本次对话时使用的Cookie"""
     max_retries = 2
     retry_count = 0
     image_base64_response = None
@@ -1113,10 +1514,10 @@ def handle_image_response(image_url):
         try:
             proxy_options = Utils.get_proxy_options()
             image_base64_response = curl_requests.get(
-                f"https://assets.grok.com/{image_url}",
+                f"{CONFIG['API']['ASSETS_URL']}/{image_url}",
                 headers={
                     **DEFAULT_HEADERS,
-                    "Cookie":CONFIG["SERVER"]['COOKIE']
+                    "Cookie":cookie
                 },
                 impersonate="chrome133a",
                 **proxy_options
@@ -1140,86 +1541,127 @@ def handle_image_response(image_url):
             time.sleep(CONFIG["API"]["RETRY_TIME"] / 1000 * retry_count)
 
     image_buffer = image_base64_response.content
-
-    if not CONFIG["API"]["PICGO_KEY"] and not CONFIG["API"]["TUMY_KEY"]:
-        base64_image = base64.b64encode(image_buffer).decode('utf-8')
-        image_content_type = image_base64_response.headers.get('content-type', 'image/jpeg')
-        return f"![image](data:{image_content_type};base64,{base64_image})"
+    image_content_type = image_base64_response.headers.get('content-type', 'image/jpeg')
+    if transcode_options and transcode_options.get("ENABLED"):
+        original_buffer = image_buffer
+        image_buffer, image_content_type = IMAGE_TRANSCODER.transcode(image_buffer, image_content_type, transcode_options)
+        # 未启用Pillow、GIF、无收益或失败时返回原图，不记录
+        if image_buffer is not original_buffer:
+            logger.debug(f"生成图片已转码: {len(original_buffer)} -> {len(image_buffer)} 字节", "Server")
+
+    if not IMAGE_UPLOADER:
+        image_id = IMAGE_CACHE.put(image_buffer, image_content_type)
+        return f"![image]({base_url or CONFIG['IMAGE']['PUBLIC_BASE_URL'] or ''}/images/{image_id})"
 
     logger.info("开始上传图床", "Server")
 
-    if CONFIG["API"]["PICGO_KEY"]:
-        files = {'source': ('image.jpg', image_buffer, 'image/jpeg')}
-        headers = {
-            "X-API-Key": CONFIG["API"]["PICGO_KEY"]
-        }
-
-        response_url = requests.post(
-            "https://www.picgo.net/api/1/upload",
-            files=files,
-            headers=headers
-        )
-
-        if response_url.status_code != 200:
-            return "生图失败，请查看PICGO图床密钥是否设置正确"
-        else:
-            logger.info("生图成功", "Server")
-            result = response_url.json()
-            return f"![image]({result['image']['url']})"
-
-
-    elif CONFIG["API"]["TUMY_KEY"]:
-        files = {'file': ('image.jpg', image_buffer, 'image/jpeg')}
-        headers = {
-            "Accept": "application/json",
-            'Authorization': f"Bearer {CONFIG['API']['TUMY_KEY']}"
-        }
-
-        response_url = requests.post(
-            "https://tu.my/api/v1/upload",
-            files=files,
-            headers=headers
-        )
-
-        if response_url.status_code != 200:
-            return "生图失败，请查看TUMY图床密钥是否设置正确"
-        else:
-            try:
-                result = response_url.json()
-                logger.info("生图成功", "Server")
-                return f"![image]({result['data']['links']['url']})"
-            except Exception as error:
-                logger.error(str(error), "Server")
-                return "生图失败，请查看TUMY图床密钥是否设置正确"
-
-def handle_non_stream_response(response, model):
+    try:
+        image_url = IMAGE_UPLOADER.upload(image_buffer, image_content_type)
+        logger.info("生图成功", "Server")
+        return f"![image]({image_url})"
+    except image_util.ImageUploadError as error:
+        logger.error(str(error), "Server")
+        return f"生图失败，请查看{IMAGE_UPLOADER.provider.name}图床密钥是否设置正确"
+
+IMAGE_TRANSCODER = image_util.ImageTranscoder(CONFIG["IMAGE_TRANSCODE"]["WORKERS"])
+
+IMAGE_CACHE = image_util.ImageCache(CONFIG["IMAGE"]["CACHE_DIR"], CONFIG["IMAGE"]["CACHE_MAX_MB"] * 1024 * 1024)
+
+# 配置了PICGO或TUMY密钥时，生成的图片通过带连接池的上传器转存到图床
+IMAGE_UPLOADER = image_util.create_image_uploader(
+    picgo_key=CONFIG["API"]["PICGO_KEY"],
+    tumy_key=CONFIG["API"]["TUMY_KEY"],
+    picgo_url=CONFIG["IMAGE"]["PICGO_UPLOAD_URL"],
+    tumy_url=CONFIG["IMAGE"]["TUMY_UPLOAD_URL"],
+    max_concurrency=CONFIG["IMAGE"]["UPLOAD_CONCURRENCY"],
+    timeout=CONFIG["IMAGE"]["UPLOAD_TIMEOUT"],
+    max_retries=CONFIG["IMAGE"]["UPLOAD_RETRIES"]
+)
+
+# 图片下载与转存在后台线程池中进行，流式响应不必等待
+IMAGE_EXECUTOR = futures.ThreadPoolExecutor(max_workers=CONFIG["IMAGE"]["WORKERS"], thread_name_prefix="image-worker")
+
+def collect_token_pool_metrics():
+    return [
+        ({"model": model, "tier": tier, "state": state}, count)
+        for (model, tier, state), count in token_manager.get_token_pool_stats().items()
+    ]
+
+def collect_image_cache_metrics():
+    stats = IMAGE_CACHE.stats()
+    return [({"unit": "count"}, stats["count"]), ({"unit": "bytes"}, stats["bytes"])]
+
+# 热路径上只做加锁计数，令牌池等已有结构在 /metrics 抓取时才统计
+METRICS = metrics_util.MetricsRegistry()
+REQUESTS_TOTAL = METRICS.counter(
+    "grok2api_requests_total", "聊天请求数", ("model", "stream", "status"))
+REQUEST_DURATION = METRICS.histogram(
+    "grok2api_request_duration_seconds", "聊天请求总耗时，流式请求计到流结束", ("model", "stream"))
+UPSTREAM_TTFB = METRICS.histogram(
+    "grok2api_upstream_ttfb_seconds", "上游返回响应头的耗时", ("model",))
+FIRST_CHUNK_SECONDS = METRICS.histogram(
+    "grok2api_first_chunk_seconds", "从收到请求到输出第一个SSE内容帧的耗时", ("model",))
+UPSTREAM_RESPONSES = METRICS.counter(
+    "grok2api_upstream_responses_total", "上游响应状态码", ("model", "status"))
+UPSTREAM_IN_FLIGHT = METRICS.gauge(
+    "grok2api_upstream_in_flight", "进行中的上游请求", ("model", "tier"))
+UPSTREAM_LINES = METRICS.counter(
+    "grok2api_upstream_lines_total", "流式响应收到的上游NDJSON行数", ("model",))
+STREAM_CHUNKS = METRICS.counter(
+    "grok2api_stream_chunks_total", "输出的SSE内容帧数", ("model",))
+METRICS.gauge(
+    "grok2api_token_pool_tokens", "令牌池中的令牌数", ("model", "tier", "state"), collect=collect_token_pool_metrics)
+METRICS.gauge(
+    "grok2api_cf_clearance_pool_size", "可用的cf_clearance数量",
+    collect=lambda: [({}, len(cf_util.get_cf_clearance_value()))])
+METRICS.gauge(
+    "grok2api_image_cache", "本地图片缓存占用", ("unit",), collect=collect_image_cache_metrics)
+TOKEN_PROBES = METRICS.counter(
+    "grok2api_token_probes_total", "令牌健康探测的上游状态码", ("status",))
+METRICS.gauge(
+    "grok2api_token_health", "按探测健康状态统计的令牌数", ("status",),
+    collect=lambda: [({"status": status}, count) for status, count in token_manager.get_token_health_counts().items()])
+
+def record_chat_request(model, stream, status, timer):
+    """请求结束时记录指标，并输出一条包含各阶段耗时的结构化日志"""
+    REQUESTS_TOTAL.inc(model=model, stream=stream, status=status)
+    REQUEST_DURATION.observe(timer.elapsed(), model=model, stream=stream)
+    logger.info(lambda: "请求耗时 " + json_util.dumps({
+        "model": model,
+        "stream": stream == "true",
+        "status": status,
+        "phases_ms": timer.as_dict()
+    }), "Timing")
+
+def handle_non_stream_response(response, model, image_options=None, timer=None, cookie=None):
+    base_url = Utils.get_public_base_url()
+    timer = timer or metrics_util.RequestTimer()
     try:
         logger.info("开始处理非流式响应", "Server")
 
         stream = response.iter_lines()
         full_response = ""
-        
-        CONFIG["IS_THINKING"] = False
-        CONFIG["IS_IMG_GEN"] = False
-        CONFIG["IS_IMG_GEN2"] = False
-        
+        transformer = create_response_transformer(model)
+
         chunk_count = 0
         error_count = 0
 
         for chunk in stream:
+            timer.mark("first_byte")
             if not chunk:
                 continue
                 
             chunk_count += 1
-            logger.debug(f"处理非流式响应第 {chunk_count} 个数据块", "Server")
+            logger.debug_sampled(chunk_count, lambda: f"处理非流式响应第 {chunk_count} 个数据块", "Server")
             
             try:
-                chunk_str = chunk.decode("utf-8").strip()
+                chunk_str = chunk.strip()
                 if not chunk_str:
                     continue
-                    
-                line_json = json.loads(chunk_str)
-                logger.debug(f"非流式响应JSON解析成功: {json.dumps(line_json, ensure_ascii=False)}", "Server")
+
+                # 直接解析bytes，省去一次decode；调试日志复用原始行而不再重新序列化
+                line_json = json_util.loads(chunk_str)
+                logger.debug_sampled(chunk_count, lambda: f"非流式响应JSON解析成功: {chunk_str.decode('utf-8', 'replace')}", "Server")
                 
                 # 检查是否有错误
                 if line_json.get("error"):
@@ -1227,7 +1669,7 @@ def handle_non_stream_response(response, model):
                     error_code = error_info.get("code", "unknown")
                     error_message = error_info.get("message", "Unknown error")
                     
-                    logger.error(f"非流式响应中收到错误 - 代码: {error_code}, 消息: {error_message}, 详细信息: {json.dumps(line_json, indent=2, ensure_ascii=False)}", "Server")
+                    logger.error(f"非流式响应中收到错误 - 代码: {error_code}, 消息: {error_message}, 详细信息: {json_util.dumps(line_json, indent=True)}", "Server")
                     
                     # 根据错误类型决定如何处理
                     if error_code == 13:  # "Failed to respond" 错误
@@ -1246,11 +1688,7 @@ def handle_non_stream_response(response, model):
                     logger.debug("非流式响应数据为空，跳过此块", "Server")
                     continue
 
-                if response_data.get("doImgGen") or response_data.get("imageAttachmentInfo"):
-                    CONFIG["IS_IMG_GEN"] = True
-                    logger.debug("非流式响应检测到图片生成请求", "Server")
-
-                result = process_model_response(response_data, model)
+                result = transformer.process(response_data)
 
                 if result and result.get("token"):
                     token_content = result["token"]
@@ -1258,17 +1696,16 @@ def handle_non_stream_response(response, model):
                         full_response += token_content
 
                 if result and result.get("imageUrl"):
-                    CONFIG["IS_IMG_GEN2"] = True
                     logger.info("非流式响应开始处理图片", "Server")
                     try:
-                        return handle_image_response(result["imageUrl"])
+                        return timer.call("image", handle_image_response, result["imageUrl"], cookie, base_url, image_options)
                     except Exception as img_error:
                         logger.error(f"非流式响应处理图片时出错: {str(img_error)}", "Server")
                         return "[图片处理失败]"
 
-            except json.JSONDecodeError as json_error:
+            except json_util.JSONDecodeError as json_error:
                 error_count += 1
-                logger.warning(f"非流式响应JSON解析失败 (第{error_count}次): {str(json_error)}, 原始数据: {chunk_str[:200]}...", "Server")
+                logger.warning(f"非流式响应JSON解析失败 (第{error_count}次): {str(json_error)}, 原始数据: {chunk_str[:200].decode('utf-8', 'replace')}...", "Server")
                 if error_count > 10:  # 如果连续解析失败太多次，返回已有内容
                     logger.error("非流式响应JSON解析失败次数过多，返回已收集内容", "Server")
                     return full_response if full_response else "[数据解析错误]"
@@ -1288,33 +1725,108 @@ def handle_non_stream_response(response, model):
     except Exception as error:
         logger.error(f"非流式响应处理发生严重错误: {str(error)}", "Server")
         raise Exception(f"非流式响应处理失败: {str(error)}")
-def handle_stream_response(response, model):
+def handle_stream_response(response, model, coalescer=None, on_disconnect=None, image_options=None, timer=None, sse_encoder=None,
+                           cookie=None):
+    """
+    把上游响应转换为SSE生成器
+
+    timer 为本次请求的 RequestTimer，流正常结束时在 [DONE] 前以SSE注释输出各阶段耗时。
+    sse_encoder 默认每个请求新建，回放测试可传入固定 id 和时间戳的编码器以便逐字节对比。
+    cookie 为本次请求发往上游的Cookie，下载生成的图片时使用。
+
+    客户端断开时 WSGI 服务器会关闭生成器（抛出 GeneratorExit），此时立即关闭上游响应
+    并调用 on_disconnect(delivered)，delivered 表示客户端是否已收到过内容。
+    生成的图片交给 IMAGE_EXECUTOR 处理，期间继续转发文字和保活帧，图片就绪后再输出。
+    """
+    # 生成器稍后才执行，先固定图片链接前缀，离开请求上下文后无法再读取Host
+    base_url = Utils.get_public_base_url()
+    timer = timer or metrics_util.RequestTimer()
+
     def generate():
         logger.info("开始处理流式响应", "Server")
-        
+        encoder = sse_encoder or stream_util.SSEChunkEncoder(model)
+        chunk_coalescer = coalescer or stream_util.ChunkCoalescer()
+        delivered = False
+        sse_chunks = 0
+        chunk_count = 0
+        pending_images = []
+        keepalive_seconds = CONFIG["STREAM"]["KEEPALIVE_SECONDS"]
+        idle_tick = min(chunk_coalescer.flush_interval or 1.0, 1.0)
+        last_activity = time.monotonic()
+        reader = None
+
+        def mark_delivered():
+            nonlocal delivered, sse_chunks
+            if not delivered:
+                delivered = True
+                timer.mark("first_chunk")
+                FIRST_CHUNK_SECONDS.observe(timer.elapsed(), model=model)
+            sse_chunks += 1
+
+        def flush_pending():
+            pending = chunk_coalescer.flush()
+            if pending:
+                yield encoder.content(pending)
+                mark_delivered()
+
+        def emit_ready_images():
+            for future in [f for f in pending_images if f.done()]:
+                pending_images.remove(future)
+                try:
+                    image_data = future.result()
+                except Exception as img_error:
+                    logger.error(f"处理图片响应时出错: {str(img_error)}", "Server")
+                    image_data = '[图片处理失败]'
+                yield from flush_pending()
+                yield encoder.content(image_data)
+                mark_delivered()
+
+        def idle_frames():
+            nonlocal last_activity
+            yield from emit_ready_images()
+            due = chunk_coalescer.flush_due()
+            if due:
+                yield encoder.content(due)
+                mark_delivered()
+            if time.monotonic() - last_activity >= keepalive_seconds:
+                last_activity = time.monotonic()
+                yield stream_util.SSEChunkEncoder.KEEPALIVE
+
         try:
-            stream = response.iter_lines()
-            CONFIG["IS_THINKING"] = False
-            CONFIG["IS_IMG_GEN"] = False
-            CONFIG["IS_IMG_GEN2"] = False
-            
-            chunk_count = 0
+            reader = stream_util.UpstreamLineReader(response)
+            transformer = create_response_transformer(model)
+            yield encoder.role()
+
             error_count = 0
-            
-            for chunk in stream:
+
+            for chunk in reader.iter_lines(idle_tick):
+                if SHUTDOWN.deadline_passed():
+                    logger.warning(f"服务退出等待超时，结束流式响应 - 模型: {model}", "Server")
+                    yield from flush_pending()
+                    yield encoder.content('[服务正在重启，响应已中断，请重试]')
+                    yield encoder.finish()
+                    yield encoder.DONE
+                    return
+                if chunk is None:
+                    yield from idle_frames()
+                    continue
+                timer.mark("first_byte")
+                last_activity = time.monotonic()
+                if pending_images:
+                    yield from emit_ready_images()
                 if not chunk:
                     continue
                     
                 chunk_count += 1
-                logger.debug(f"处理第 {chunk_count} 个数据块", "Server")
+                logger.debug_sampled(chunk_count, lambda: f"处理第 {chunk_count} 个数据块", "Server")
                 
                 try:
-                    chunk_str = chunk.decode("utf-8").strip()
+                    chunk_str = chunk.strip()
                     if not chunk_str:
                         continue
-                        
-                    line_json = json.loads(chunk_str)
-                    logger.debug(f"解析JSON成功: {json.dumps(line_json, ensure_ascii=False)}", "Server")
+
+                    line_json = json_util.loads(chunk_str)
+                    logger.debug_sampled(chunk_count, lambda: f"解析JSON成功: {chunk_str.decode('utf-8', 'replace')}", "Server")
                     
                     # 检查是否有错误
                     if line_json.get("error"):
@@ -1322,13 +1834,15 @@ def handle_stream_response(response, model):
                         error_code = error_info.get("code", "unknown")
                         error_message = error_info.get("message", "Unknown error")
                         
-                        logger.error(f"流式响应中收到错误 - 代码: {error_code}, 消息: {error_message}, 详细信息: {json.dumps(line_json, indent=2, ensure_ascii=False)}", "Server")
+                        logger.error(f"流式响应中收到错误 - 代码: {error_code}, 消息: {error_message}, 详细信息: {json_util.dumps(line_json, indent=True)}", "Server")
                         
                         # 根据错误类型决定如何处理
                         if error_code == 13:  # "Failed to respond" 错误
                             logger.warning("检测到 'Failed to respond' 错误，尝试优雅结束流式响应", "Server")
-                            yield f"data: {json.dumps(MessageProcessor.create_chat_response('[响应被中断，请重试]', model, True))}\n\n"
-                            yield "data: [DONE]\n\n"
+                            yield from flush_pending()
+                            yield encoder.content('[响应被中断，请重试]')
+                            yield encoder.finish()
+                            yield encoder.DONE
                             return
                         else:
                             # 其他错误类型
@@ -1339,8 +1853,9 @@ def handle_stream_response(response, model):
                                     "code": error_code
                                 }
                             }
-                            yield f"data: {json.dumps(error_response)}\n\n"
-                            yield "data: [DONE]\n\n"
+                            yield from flush_pending()
+                            yield encoder.event(error_response)
+                            yield encoder.DONE
                             return
 
                     # 处理正常响应数据
@@ -1349,34 +1864,30 @@ def handle_stream_response(response, model):
                         logger.debug("响应数据为空，跳过此块", "Server")
                         continue
 
-                    if response_data.get("doImgGen") or response_data.get("imageAttachmentInfo"):
-                        CONFIG["IS_IMG_GEN"] = True
-                        logger.debug("检测到图片生成请求", "Server")
-
-                    result = process_model_response(response_data, model)
+                    result = transformer.process(response_data)
 
                     if result and result.get("token"):
                         token_content = result["token"]
                         if token_content:  # 确保token不为空
-                            yield f"data: {json.dumps(MessageProcessor.create_chat_response(token_content, model, True))}\n\n"
+                            for text in chunk_coalescer.add(token_content):
+                                yield encoder.content(text)
+                                mark_delivered()
 
                     if result and result.get("imageUrl"):
-                        CONFIG["IS_IMG_GEN2"] = True
                         logger.info("开始处理图片响应", "Server")
-                        try:
-                            image_data = handle_image_response(result["imageUrl"])
-                            yield f"data: {json.dumps(MessageProcessor.create_chat_response(image_data, model, True))}\n\n"
-                        except Exception as img_error:
-                            logger.error(f"处理图片响应时出错: {str(img_error)}", "Server")
-                            yield f"data: {json.dumps(MessageProcessor.create_chat_response('[图片处理失败]', model, True))}\n\n"
-
-                except json.JSONDecodeError as json_error:
+                        yield from flush_pending()
+                        pending_images.append(IMAGE_EXECUTOR.submit(
+                            timer.call, "image", handle_image_response, result["imageUrl"], cookie, base_url, image_options))
+
+                except json_util.JSONDecodeError as json_error:
                     error_count += 1
-                    logger.warning(f"JSON解析失败 (第{error_count}次): {str(json_error)}, 原始数据: {chunk_str[:200]}...", "Server")
+                    logger.warning(f"JSON解析失败 (第{error_count}次): {str(json_error)}, 原始数据: {chunk_str[:200].decode('utf-8', 'replace')}...", "Server")
                     if error_count > 10:  # 如果连续解析失败太多次，终止流
                         logger.error("JSON解析失败次数过多，终止流式响应", "Server")
-                        yield f"data: {json.dumps(MessageProcessor.create_chat_response('[数据解析错误，响应终止]', model, True))}\n\n"
-                        yield "data: [DONE]\n\n"
+                        yield from flush_pending()
+                        yield encoder.content('[数据解析错误，响应终止]')
+                        yield encoder.finish()
+                        yield encoder.DONE
                         return
                     continue
                     
@@ -1385,22 +1896,52 @@ def handle_stream_response(response, model):
                     logger.error(f"处理数据块时出错 (第{error_count}次): {str(chunk_error)}", "Server")
                     if error_count > 5:  # 如果错误太多，终止流
                         logger.error("处理错误次数过多，终止流式响应", "Server")
-                        yield f"data: {json.dumps(MessageProcessor.create_chat_response('[处理错误过多，响应终止]', model, True))}\n\n"
-                        yield "data: [DONE]\n\n"
+                        yield from flush_pending()
+                        yield encoder.content('[处理错误过多，响应终止]')
+                        yield encoder.finish()
+                        yield encoder.DONE
                         return
                     continue
 
             logger.info(f"流式响应处理完成，共处理 {chunk_count} 个数据块，错误 {error_count} 次", "Server")
-            yield "data: [DONE]\n\n"
-            
+            while pending_images and not SHUTDOWN.deadline_passed():
+                futures.wait(pending_images, timeout=idle_tick, return_when=futures.FIRST_COMPLETED)
+                yield from idle_frames()
+            yield from flush_pending()
+            yield encoder.finish()
+            yield encoder.comment(f"server-timing {timer.server_timing()}")
+            yield encoder.DONE
+
+        except GeneratorExit:
+            logger.warning(f"客户端已断开连接，取消上游请求 - 模型: {model}, 已输出内容: {delivered}", "Server")
+            if on_disconnect:
+                try:
+                    on_disconnect(delivered)
+                except Exception as callback_error:
+                    logger.error(f"处理客户端断开回调失败: {str(callback_error)}", "Server")
+            raise
+
         except Exception as stream_error:
             logger.error(f"流式响应处理发生严重错误: {str(stream_error)}", "Server")
             try:
-                yield f"data: {json.dumps(MessageProcessor.create_chat_response('[流式响应处理失败]', model, True))}\n\n"
-                yield "data: [DONE]\n\n"
+                yield from flush_pending()
+                yield encoder.content('[流式响应处理失败]')
+                yield encoder.finish()
+                yield encoder.DONE
             except:
                 pass  # 如果连yield都失败了，就静默处理
-                
+
+        finally:
+            # 无论正常结束、出错还是客户端断开，都立即释放上游连接
+            if reader:
+                reader.close()
+            response.close()
+            for future in pending_images:
+                future.cancel()
+            # 每个流结束时汇总一次，不在逐块循环里更新共享计数
+            UPSTREAM_LINES.inc(chunk_count, model=model)
+            STREAM_CHUNKS.inc(sse_chunks, model=model)
+
     return generate()
 
 def save_token_manager(token_manager_obj, file_path="token_manager.pickle"):
@@ -1418,8 +1959,7 @@ def save_token_manager(token_manager_obj, file_path="token_manager.pickle"):
 
         full_path = data_dir / file_path
 
-        with open(full_path, 'wb') as f:
-            pickle.dump(token_manager_obj, f)
+        lifecycle_util.atomic_write(full_path, pickle.dumps(token_manager_obj))
 
         logger.info(f"成功保存token_manager对象到: {full_path}", "TokenPersistence")
     except Exception as error:
@@ -1455,6 +1995,16 @@ def load_token_manager(file_path="token_manager.pickle"):
             logger.info("为旧版本token_manager对象添加usage_records_file属性", "TokenPersistence")
             token_manager_obj.usage_records_file = str(DATA_DIR / "token_usage_records.json")
 
+        if not hasattr(token_manager_obj, 'state_version'):
+            token_manager_obj.state_version = 0
+        if not hasattr(token_manager_obj, 'change_log'):
+            token_manager_obj.change_log = deque(maxlen=TOKEN_CHANGE_LOG_SIZE)
+        if not hasattr(token_manager_obj, 'token_health'):
+            token_manager_obj.token_health = {}
+            token_manager_obj.quarantined_tokens = {}
+        # 检查时间基于 monotonic，不能沿用上一个进程的值
+        token_manager_obj.last_expiry_check = 0.0
+
         logger.info(f"成功从{full_path}加载token_manager对象", "TokenPersistence")
         return token_manager_obj
     except Exception as error:
@@ -1471,7 +2021,8 @@ def start_token_manager_persistence(token_manager_obj, interval_minutes=10):
     """
     def persistence_task():
         while True:
-            # 保存token_manager对象
+            # 保存token_manager对象，顺带落盘尚未写入的令牌状态
+            token_manager_obj.flush_token_status()
             save_token_manager(token_manager_obj)
             # 等待指定时间
             time.sleep(interval_minutes * 60)
@@ -1525,30 +2076,18 @@ def initialization():
         sso_array = os.environ.get("SSO", "").split(',')
         sso_array_super = os.environ.get("SSO_SUPER", "").split(',')
 
-        combined_dict = []
-        for value in sso_array_super:
-            combined_dict.append({
-                "token": f"sso-rw={value};sso={value}",
-                "type": "super"
-            })
-        for value in sso_array:
-            combined_dict.append({
-                "token": f"sso-rw={value};sso={value}",
-                "type": "normal"
-            })
-
         logger.info("开始加载令牌", "Server")
         token_manager.load_token_status()
         token_manager.load_usage_records()  # 加载使用记录
-        for tokens in combined_dict:
-            if tokens:
-                token_manager.add_token(tokens, True)
+        token_manager.add_tokens(sso_array_super, "super", True)
+        token_manager.add_tokens(sso_array, "normal", True)
         token_manager.save_token_status()
+        token_manager.flush_token_status()
 
     # 启动token_manager持久化定时任务
     start_token_manager_persistence(token_manager, 10)  # 每10分钟保存一次
 
-    logger.info(f"成功加载令牌: {json.dumps(token_manager.get_all_tokens(), indent=2)}", "Server")
+    logger.debug(lambda: f"成功加载令牌: {[Utils.mask_secret(token) for token in token_manager.get_all_tokens()]}", "Server")
     logger.info(f"令牌加载完成，共加载: {len(sso_array)+len(sso_array_super)}个令牌", "Server")
     logger.info(f"其中共加载: {len(sso_array_super)}个super会员令牌", "Server")
 
@@ -1558,9 +2097,121 @@ def initialization():
     logger.info("初始化完成", "Server")
 
 
+def probe_token(sso):
+    """
+    用上游的额度查询接口探测令牌，不消耗对话次数
+
+    2xx 说明令牌仍然有效，401 说明已退出登录或被封禁，其余状态码（如CF风控的403、限流的429）无法判断令牌本身的状态。
+    """
+    cookie = f"sso-rw={sso};sso={sso}"
+    cf_clearance = CONFIG['SERVER']['CF_CLEARANCE'] or next(iter(cf_util.get_cf_clearance_value()), None)
+    if cf_clearance:
+        cookie = f"{cookie};{cf_clearance}"
+    response = curl_requests.post(
+        f"{CONFIG['API']['BASE_URL']}/rest/rate-limits",
+        headers={
+            **DEFAULT_HEADERS,
+            "Cookie": cookie
+        },
+        data=b'{"requestKind":"DEFAULT","modelName":"grok-3"}',
+        impersonate="chrome133a",
+        timeout=CONFIG["TOKEN_PROBE"]["TIMEOUT"],
+        **Utils.get_proxy_options())
+    TOKEN_PROBES.inc(status=response.status_code)
+    if 200 <= response.status_code < 300:
+        return {"result": probe_util.PROBE_OK, "httpStatus": response.status_code}
+    result = probe_util.PROBE_UNAUTHORIZED if response.status_code == 401 else probe_util.PROBE_ERROR
+    return {"result": result, "httpStatus": response.status_code, "detail": response.text[:200]}
+
+def on_probe_round_end(summary):
+    token_manager.save_token_status()
+    logger.info(f"令牌健康探测完成: {summary['targets']}个令牌，耗时{summary['durationMs']}ms，结果: {summary['counts']}，"
+                f"当前状态: {token_manager.get_token_health_counts()}", "TokenProbe")
+
+# 令牌健康探测，TOKEN_PROBE 开启时在 bootstrap 中启动定时任务，也可从管理接口手动触发一轮
+TOKEN_PROBER = probe_util.TokenProber(
+    list_targets=lambda: token_manager.get_probe_targets(),
+    probe=probe_token,
+    on_result=lambda sso, outcome: token_manager.record_probe_result(
+        sso, outcome, CONFIG["TOKEN_PROBE"]["FAIL_THRESHOLD"]),
+    on_round_end=on_probe_round_end,
+    interval=CONFIG["TOKEN_PROBE"]["INTERVAL_SECONDS"],
+    concurrency=CONFIG["TOKEN_PROBE"]["CONCURRENCY"],
+    rate=CONFIG["TOKEN_PROBE"]["RATE"],
+    initial_delay=CONFIG["TOKEN_PROBE"]["INITIAL_DELAY_SECONDS"]
+)
+
+
+_BOOTSTRAP_LOCK = threading.Lock()
+_bootstrapped = False
+
+
+def bootstrap():
+    """
+    创建令牌管理器并完成初始化，同一进程内只执行一次
+
+    python app.py 直接启动和 gunicorn 每个 worker 导入 wsgi.py 时都会调用。
+    令牌状态与持久化线程都在当前进程内，因此不能在 fork 前的主进程中调用（不要开启 preload_app）。
+    """
+    global token_manager, _bootstrapped
+    with _BOOTSTRAP_LOCK:
+        if _bootstrapped:
+            return
+        logger.info(f"管理员密码来源: {'环境变量' if ADMIN_PASSWORD != DEFAULT_ADMIN_PASSWORD else '默认值'}")
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        migrate_cf_files()
+        token_manager = AuthTokenManager()
+        initialization()
+        if CONFIG["TOKEN_PROBE"]["ENABLED"] and not CONFIG["API"]["IS_CUSTOM_SSO"]:
+            TOKEN_PROBER.start()
+            logger.info(f"令牌健康探测已启动，间隔: {CONFIG['TOKEN_PROBE']['INTERVAL_SECONDS']}秒，"
+                        f"并发: {CONFIG['TOKEN_PROBE']['CONCURRENCY']}，速率: {CONFIG['TOKEN_PROBE']['RATE']}次/秒", "TokenProbe")
+        _bootstrapped = True
+
+
+def flush_state():
+    """把令牌状态、使用记录和 token_manager 对象写入磁盘，退出前调用"""
+    manager = globals().get("token_manager")
+    if manager is None:
+        return
+    manager.flush_token_status()
+    manager.save_usage_records()
+    save_token_manager(manager)
+    cf_util.COOKIE_STORE.flush()
+    logger.info("退出前状态已保存", "Server")
+
+
+def shutdown(drain_seconds=None):
+    """
+    优雅退出：停止接收新请求，等待在途请求（含流式响应）结束，最后保存状态
+
+    超过排空期限仍未结束的流会输出中断提示后收尾，这里再多等几秒让它们关闭。
+    """
+    SHUTDOWN.begin(drain_seconds)
+    TOKEN_PROBER.stop()
+    logger.info(f"开始优雅退出，在途请求: {SHUTDOWN.active}", "Server")
+    if not SHUTDOWN.wait_idle((SHUTDOWN.drain_seconds if drain_seconds is None else drain_seconds) + 5):
+        logger.warning(f"等待超时，仍有 {SHUTDOWN.active} 个请求未结束", "Server")
+    flush_state()
+
+
+class CodecJSONProvider(DefaultJSONProvider):
+    """让 request.json 与 jsonify 走 json_util（orjson 可用时使用 orjson），Decimal、日期等类型仍按Flask的默认规则转换"""
+
+    def dumps(self, obj, **kwargs):
+        return json_util.dumps(obj, indent=bool(kwargs.get("indent")), sort_keys=kwargs.get("sort_keys", False),
+                               default=kwargs.get("default", self.default))
+
+    def loads(self, s, **kwargs):
+        return json_util.loads(s)
+
+
 app = Flask(__name__)
-app.wsgi_app = ProxyFix(app.wsgi_app)
+# 退出排空期间拒绝新请求（指标接口除外），并统计在途请求直到响应体关闭
+SHUTDOWN = lifecycle_util.GracefulShutdown(CONFIG["SERVER"]["SHUTDOWN_DRAIN_SECONDS"], exempt_paths=("/metrics",))
+app.wsgi_app = SHUTDOWN.wrap(ProxyFix(app.wsgi_app))
 app.secret_key = os.environ.get('FLASK_SECRET_KEY') or secrets.token_hex(16)
+app.json = CodecJSONProvider(app)
 app.json.sort_keys = False
 
 @app.route('/manager/login', methods=['GET', 'POST'])
@@ -1579,6 +2230,20 @@ def manager_login():
 def check_auth():
     return session.get('is_logged_in', False)
 
+def check_admin_auth():
+    """管理接口鉴权：已登录管理界面，或携带 Authorization: Bearer <ADMINPASSWORD>"""
+    if check_auth():
+        return True
+    admin_password = CONFIG["ADMIN"]["PASSWORD"]
+    auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    return bool(admin_password) and secrets.compare_digest(auth_token.encode('utf-8'), admin_password.encode('utf-8'))
+
+# 一次增量响应最多返回的令牌行数，超过时让客户端整页刷新
+TOKEN_CHANGES_MAX_ROWS = 500
+
+# 令牌状态的只读快照，令牌池变化（state_version 递增）后的第一次查询才重新序列化
+TOKEN_STATUS_SNAPSHOT = snapshot_util.VersionedSnapshot(lambda: token_manager.get_token_status_map())
+
 @app.route('/manager')
 def manager():
     if not check_auth():
@@ -1589,10 +2254,90 @@ def manager():
 def get_manager_tokens():
     if not check_auth():
         return jsonify({"error": "Unauthorized"}), 401
-    
-    # 在返回状态前，先检查并更新过期的token状态
-    token_manager.check_and_reset_expired_tokens()
-    return jsonify(token_manager.get_token_status_map())
+
+    # 在返回状态前，先检查并更新过期的token状态（按间隔限流）
+    token_manager.refresh_expired_tokens(CONFIG["ADMIN"]["STATUS_REFRESH_SECONDS"])
+    return Utils.snapshot_response(TOKEN_STATUS_SNAPSHOT.get(token_manager.state_version))
+
+def parse_int_arg(name, default, minimum=1, maximum=None):
+    try:
+        value = int(request.args.get(name, default))
+    except (TypeError, ValueError):
+        value = default
+    value = max(minimum, value)
+    return min(value, maximum) if maximum else value
+
+@app.route('/manager/api/tokens')
+def query_manager_tokens():
+    """分页、筛选、排序后的令牌状态，version 用于之后订阅增量变化"""
+    if not check_admin_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+
+    token_manager.refresh_expired_tokens(CONFIG["ADMIN"]["STATUS_REFRESH_SECONDS"])
+    version = token_manager.state_version
+    result = token_manager.query_token_status(
+        page=parse_int_arg('page', 1),
+        page_size=parse_int_arg('page_size', 30, maximum=200),
+        search=request.args.get('search'),
+        status=request.args.get('status'),
+        model=request.args.get('model'),
+        tier=request.args.get('tier'),
+        sort=request.args.get('sort'),
+        health=request.args.get('health')
+    )
+    result["version"] = version
+    result["summary"] = token_manager.get_token_status_summary()
+    return jsonify(result)
+
+@app.route('/manager/api/tokens/changes')
+def get_manager_token_changes():
+    """
+    长轮询 since 版本之后变化的令牌行，没有变化时最多等待 timeout 秒
+
+    reset 为 true 表示变化过多、范围未知或 since 超过服务端版本，客户端应重新拉取当前页。
+    """
+    if not check_admin_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+
+    since = parse_int_arg('since', 0, minimum=0)
+    deadline = time.monotonic() + parse_int_arg('timeout', 25, minimum=0, maximum=30)
+    token_manager.refresh_expired_tokens(CONFIG["ADMIN"]["STATUS_REFRESH_SECONDS"])
+    while True:
+        version, changed = token_manager.get_token_changes(since)
+        if changed is None or changed or time.monotonic() >= deadline or SHUTDOWN.draining:
+            break
+        time.sleep(0.5)
+
+    if changed is not None and len(changed) > TOKEN_CHANGES_MAX_ROWS:
+        changed = None
+    rows = None
+    if changed is not None:
+        status_map = token_manager.get_token_status_map()
+        rows = [{"sso": sso, "models": status_map.get(sso), "health": token_manager.token_health.get(sso),
+                 "deleted": sso not in status_map} for sso in changed]
+    return jsonify({
+        "version": version,
+        "reset": changed is None,
+        "rows": rows,
+        "summary": token_manager.get_token_status_summary()
+    })
+
+@app.route('/manager/api/tokens/probe', methods=['GET', 'POST'])
+def manager_token_probe():
+    """GET 返回探测任务状态与各健康状态的令牌数，POST 在后台立即执行一轮探测"""
+    if not check_admin_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+
+    started = False
+    if request.method == 'POST' and not TOKEN_PROBER.running:
+        threading.Thread(target=TOKEN_PROBER.run_round, name="token-probe-manual", daemon=True).start()
+        started = True
+    return jsonify({
+        "enabled": CONFIG["TOKEN_PROBE"]["ENABLED"],
+        "started": started,
+        **TOKEN_PROBER.status(),
+        "health": token_manager.get_token_health_counts()
+    }), 202 if started else 200
 
 @app.route('/manager/api/add', methods=['POST'])
 def add_manager_token():
@@ -1607,6 +2352,47 @@ def add_manager_token():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def import_tokens_from_request():
+    """
+    批量导入请求中的令牌，返回逐个令牌的结果
+
+    支持 JSON 数组、{"ssos": [...], "type": "super"}、上传的文本文件（file 字段）或纯文本请求体，
+    文本中的令牌按换行或逗号分隔。会员类型也可通过 type 查询参数或表单字段指定，默认 normal。
+    """
+    token_type = request.args.get('type') or request.form.get('type')
+    uploaded = request.files.get('file')
+    if uploaded:
+        ssos = uploaded.read().decode('utf-8', 'replace')
+    elif request.is_json:
+        ssos = request.get_json(silent=True)
+        if isinstance(ssos, dict):
+            token_type = ssos.get('type') or token_type
+            ssos = ssos.get('ssos')
+    else:
+        ssos = request.get_data(as_text=True)
+    if isinstance(ssos, str):
+        ssos = [value for value in ssos.replace(',', '\n').splitlines() if value.strip()]
+
+    token_type = token_type or "normal"
+    if token_type not in ("normal", "super"):
+        return jsonify({"error": "type 只能是 normal 或 super"}), 400
+    if not isinstance(ssos, list) or not ssos:
+        return jsonify({"error": "请提供要导入的SSO令牌"}), 400
+
+    results = token_manager.add_tokens(ssos, token_type)
+    summary = {"added": 0, "exists": 0, "duplicate": 0, "invalid": 0}
+    for item in results:
+        summary[item["result"]] += 1
+    logger.info(f"批量导入{len(ssos)}个{token_type}令牌: 新增{summary['added']}个，已存在{summary['exists']}个，"
+                f"重复{summary['duplicate']}个，无效{summary['invalid']}个", "Server")
+    return jsonify({"type": token_type, "summary": summary, "results": results})
+
+@app.route('/manager/api/add_batch', methods=['POST'])
+def add_manager_tokens():
+    if not check_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    return import_tokens_from_request()
+
 @app.route('/manager/api/delete', methods=['POST'])
 def delete_manager_token():
     if not check_auth():
@@ -1641,10 +2427,10 @@ def get_tokens():
         return jsonify({"error": '自定义的SSO令牌模式无法获取轮询sso令牌状态'}), 403
     elif auth_token != CONFIG["API"]["API_KEY"]:
         return jsonify({"error": 'Unauthorized'}), 401
-    
-    # 在返回状态前，先检查并更新过期的token状态
-    token_manager.check_and_reset_expired_tokens()
-    return jsonify(token_manager.get_token_status_map())
+
+    # 在返回状态前，先检查并更新过期的token状态（按间隔限流）
+    token_manager.refresh_expired_tokens(CONFIG["ADMIN"]["STATUS_REFRESH_SECONDS"])
+    return Utils.snapshot_response(TOKEN_STATUS_SNAPSHOT.get(token_manager.state_version))
 
 @app.route('/add/token', methods=['POST'])
 def add_token():
@@ -1662,6 +2448,15 @@ def add_token():
         logger.error(str(error), "Server")
         return jsonify({"error": '添加sso令牌失败'}), 500
 
+@app.route('/add/tokens', methods=['POST'])
+def add_tokens():
+    auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if CONFIG["API"]["IS_CUSTOM_SSO"]:
+        return jsonify({"error": '自定义的SSO令牌模式无法添加sso令牌'}), 403
+    elif auth_token != CONFIG["API"]["API_KEY"]:
+        return jsonify({"error": 'Unauthorized'}), 401
+    return import_tokens_from_request()
+
 @app.route('/set/cf_clearance', methods=['POST'])
 def setCf_clearance():
     auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
@@ -1691,6 +2486,28 @@ def delete_token():
         logger.error(str(error), "Server")
         return jsonify({"error": '删除sso令牌失败'}), 500
 
+# 各模型的次数限制说明，随使用统计一起返回
+MODEL_LIMITS = {
+    "grok-3": {
+        "normal": {"limit": 20, "reset_hours": 2},
+        "super": {"limit": 100, "reset_hours": 2}
+    },
+    "grok-3-deepsearch": {
+        "normal": {"limit": 10, "reset_hours": 2},
+        "super": {"limit": 30, "reset_hours": 2}
+    },
+    "grok-3-reasoning": {
+        "normal": {"limit": 10, "reset_hours": 2},
+        "super": {"limit": 30, "reset_hours": 2}
+    }
+}
+
+USAGE_STATISTICS_SNAPSHOT = snapshot_util.VersionedSnapshot(lambda: {
+    "statistics": token_manager.get_usage_statistics(),
+    "token_status": token_manager.get_token_status_map(),
+    "model_limits": MODEL_LIMITS
+})
+
 @app.route('/get/usage_statistics', methods=['GET'])
 def get_usage_statistics():
     """获取token使用统计"""
@@ -1699,34 +2516,26 @@ def get_usage_statistics():
         return jsonify({"error": 'Unauthorized'}), 401
     
     try:
-        # 在返回统计前，先检查并更新过期的token状态
-        token_manager.check_and_reset_expired_tokens()
+        # 在返回统计前，先检查并更新过期的token状态（按间隔限流）
+        token_manager.refresh_expired_tokens(CONFIG["ADMIN"]["STATUS_REFRESH_SECONDS"])
         
         sso = request.args.get('sso')
         model_id = request.args.get('model')
-        
-        statistics = token_manager.get_usage_statistics(sso, model_id)
-        
         # 添加当前时间和重置信息
         current_time = int(time.time() * 1000)
+
+        if not sso and not model_id:
+            # 全量统计走快照，只有 current_time 每次更新
+            snapshot = USAGE_STATISTICS_SNAPSHOT.get(token_manager.state_version)
+            return Utils.snapshot_response(snapshot, prefix=f'"current_time":{current_time}'.encode("ascii"))
+
+        statistics = token_manager.get_usage_statistics(sso, model_id)
+        
         response_data = {
             "current_time": current_time,
             "statistics": statistics,
             "token_status": token_manager.get_token_status_map(),  # 添加实时token状态
-            "model_limits": {
-                "grok-3": {
-                    "normal": {"limit": 20, "reset_hours": 2},
-                    "super": {"limit": 100, "reset_hours": 2}
-                },
-                "grok-3-deepsearch": {
-                    "normal": {"limit": 10, "reset_hours": 2},
-                    "super": {"limit": 30, "reset_hours": 2}
-                },
-                "grok-3-reasoning": {
-                    "normal": {"limit": 10, "reset_hours": 2},
-                    "super": {"limit": 30, "reset_hours": 2}
-                }
-            }
+            "model_limits": MODEL_LIMITS
         }
         
         return jsonify(response_data), 200
@@ -1752,6 +2561,7 @@ def get_models():
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
     response_status_code = 500
+    timer = metrics_util.RequestTimer()
     try:
         auth_token = request.headers.get('Authorization',
                                          '').replace('Bearer ', '')
@@ -1769,47 +2579,71 @@ def chat_completions():
         stream = data.get("stream", False)
 
         retry_count = 0
-        grok_client = GrokApiClient(model)
-        request_payload = grok_client.prepare_chat_request(data)
+        image_options = Utils.get_transcode_options(model, auth_token)
+        # 在占用令牌之前校验，参数错误不应计入令牌失败
+        try:
+            coalescer = Utils.create_coalescer(data, auth_token)
+        except ValueError as error:
+            return jsonify({"error": str(error)}), 400
+        with timer.span("prepare"):
+            grok_client = GrokApiClient(model, image_options)
+            request_payload = grok_client.prepare_chat_request(data)
 
-        logger.info(json.dumps(request_payload,indent=2))
+            # 上游请求体只序列化一次，重试和日志都复用这份bytes
+            request_body = json_util.dumps_bytes(request_payload)
+        logger.debug(lambda: f"请求负载: {request_body.decode('utf-8')}", "Server")
 
         while retry_count < CONFIG["RETRY"]["MAX_ATTEMPTS"]:
             retry_count += 1
-            CONFIG["API"]["SIGNATURE_COOKIE"] = Utils.create_auth_headers(model)
+            with timer.span("token"):
+                signature_cookie = Utils.create_auth_headers(model)
+                CONFIG["API"]["SIGNATURE_COOKIE"] = signature_cookie
 
-            if not CONFIG["API"]["SIGNATURE_COOKIE"]:
+            if not signature_cookie:
                 raise ValueError('该模型无可用令牌')
 
-            logger.info(
-                f"当前令牌: {json.dumps(CONFIG['API']['SIGNATURE_COOKIE'], indent=2)}","Server")
-            logger.info(
-                f"当前可用模型的全部可用数量: {json.dumps(token_manager.get_remaining_token_request_capacity(), indent=2)}","Server")
+            logger.info(f"当前令牌: {Utils.mask_secret(signature_cookie)}", "Server")
+            logger.debug(
+                lambda: f"当前可用模型的全部可用数量: {json_util.dumps(token_manager.get_remaining_token_request_capacity())}", "Server")
 
             # 获取cf_clearance值，如果已配置的为空则从文件获取
             cf_clearance_values = cf_util.get_cf_clearance_value()
             if not CONFIG['SERVER']['CF_CLEARANCE'] and cf_clearance_values:
                 CONFIG['SERVER']['CF_CLEARANCE'] = cf_clearance_values[0]  # 使用第一个找到的值
+            # 本轮使用的令牌和Cookie保存在局部变量中，全局配置可能在上游请求期间被并发请求改写
             if CONFIG['SERVER']['CF_CLEARANCE']:
-                CONFIG["SERVER"]['COOKIE'] = f"{CONFIG['API']['SIGNATURE_COOKIE']};{CONFIG['SERVER']['CF_CLEARANCE']}"
+                request_cookie = f"{signature_cookie};{CONFIG['SERVER']['CF_CLEARANCE']}"
             else:
-                CONFIG["SERVER"]['COOKIE'] = CONFIG['API']['SIGNATURE_COOKIE']
-            logger.info(json.dumps(request_payload,indent=2),"Server")
+                request_cookie = signature_cookie
+            CONFIG["SERVER"]['COOKIE'] = request_cookie
+            # 流式响应交给生成器后由关闭回调释放，其余情况在本轮结束时释放
+            release_in_flight = UPSTREAM_IN_FLIGHT.track(
+                model=model, tier=token_manager.get_token_tier(signature_cookie))
+            stream_started = False
             try:
                 proxy_options = Utils.get_proxy_options()
+                upstream_started_at = time.perf_counter()
                 response = curl_requests.post(
                     f"{CONFIG['API']['BASE_URL']}/rest/app-chat/conversations/new",
                     headers={
                         **DEFAULT_HEADERS,
-                        "Cookie":CONFIG["SERVER"]['COOKIE']
+                        "Cookie":request_cookie
                     },
-                    data=json.dumps(request_payload),
+                    data=request_body,
                     impersonate="chrome133a",
                     stream=True,
                     **proxy_options)
-                logger.info(CONFIG["SERVER"]['COOKIE'],"Server")
+                upstream_seconds = time.perf_counter() - upstream_started_at
+                timer.add("upstream_connect", upstream_seconds)
+                UPSTREAM_TTFB.observe(upstream_seconds, model=model)
+                UPSTREAM_RESPONSES.inc(model=model, status=response.status_code)
                 if response.status_code == 200:
                     response_status_code = 200
+                    if CONFIG["STREAM"]["RECORD_DIR"]:
+                        response = stream_util.RecordingResponse(response, stream_util.UpstreamRecorder(
+                            CONFIG["STREAM"]["RECORD_DIR"], model, stream,
+                            show_thinking=CONFIG["SHOW_THINKING"],
+                            show_search_results=CONFIG["ISSHOW_SEARCH_RESULTS"]))
                     logger.info("请求成功", "Server")
                     logger.info(f"当前{model}剩余可用令牌数: {token_manager.get_token_count_for_model(model)}","Server")
 
@@ -1817,14 +2651,34 @@ def chat_completions():
                         logger.info(f"开始处理响应 - 模型: {model}, 流式: {stream}", "Server")
                         if stream:
                             logger.info("返回流式响应", "Server")
-                            return Response(stream_with_context(
-                                handle_stream_response(response, model)),content_type='text/event-stream')
+                            def on_disconnect(delivered):
+                                if not delivered and CONFIG["API"]["REFUND_ON_DISCONNECT"]:
+                                    logger.info(f"客户端未收到内容即断开，回退令牌次数 - 模型: {model}", "Server")
+                                    token_manager.reduce_token_request_count(model, 1, signature_cookie)
+
+                            def on_close():
+                                release_in_flight()
+                                record_chat_request(model, "true", 200, timer)
+
+                            stream_response = Response(stream_with_context(
+                                handle_stream_response(response, model, coalescer, on_disconnect, image_options, timer,
+                                                       cookie=request_cookie)),content_type='text/event-stream')
+                            # 响应头发出时只有准备、取令牌和上游握手的耗时，完整耗时见流末尾的注释
+                            stream_response.headers["Server-Timing"] = timer.server_timing(total=False)
+                            stream_response.call_on_close(on_close)
+                            stream_started = True
+                            return stream_response
                         else:
                             logger.info("开始处理非流式响应", "Server")
-                            content = handle_non_stream_response(response, model)
+                            try:
+                                content = handle_non_stream_response(response, model, image_options, timer, cookie=request_cookie)
+                            finally:
+                                response.close()
                             logger.info(f"非流式响应处理完成，内容长度: {len(str(content))}", "Server")
-                            return jsonify(
-                                MessageProcessor.create_chat_response(content, model))
+                            record_chat_request(model, "false", 200, timer)
+                            chat_response = jsonify(MessageProcessor.create_chat_response(content, model))
+                            chat_response.headers["Server-Timing"] = timer.server_timing()
+                            return chat_response
 
                     except Exception as error:
                         logger.error(f"响应处理异常 - 模型: {model}, 流式: {stream}, 错误: {str(error)}", "Server")
@@ -1834,8 +2688,8 @@ def chat_completions():
                             logger.warning(f"自定义SSO模式下的响应处理失败", "Server")
                             raise ValueError(f"自定义SSO令牌当前模型{model}的请求次数已失效")
                         
-                        logger.info(f"移除失效令牌: {CONFIG['API']['SIGNATURE_COOKIE']}", "Server")
-                        token_manager.remove_token_from_model(model, CONFIG["API"]["SIGNATURE_COOKIE"])
+                        logger.info(f"移除失效令牌: {Utils.mask_secret(signature_cookie)}", "Server")
+                        token_manager.remove_token_from_model(model, signature_cookie)
                         remaining_tokens = token_manager.get_token_count_for_model(model)
                         logger.info(f"移除令牌后，{model}剩余令牌数: {remaining_tokens}", "Server")
                         
@@ -1845,17 +2699,17 @@ def chat_completions():
                 elif response.status_code == 403:
                     response_status_code = 403
                     # 记录失败的调用
-                    token_manager.record_token_usage(model, CONFIG["API"]["SIGNATURE_COOKIE"], False)
-                    token_manager.reduce_token_request_count(model,1)#重置去除当前因为错误未成功请求的次数，确保不会因为错误未成功请求的次数导致次数上限
+                    token_manager.record_token_usage(model, signature_cookie, False)
+                    token_manager.reduce_token_request_count(model, 1, signature_cookie)#重置去除当前因为错误未成功请求的次数，确保不会因为错误未成功请求的次数导致次数上限
                     if token_manager.get_token_count_for_model(model) == 0:
                         raise ValueError(f"{model} 次数已达上限，请切换其他模型或者重新对话")
-                    print("状态码:", response.status_code)
-                    print("响应头:", response.headers)
-                    print("响应内容:", response.text)
+                    logger.warning(f"上游返回403 - 模型: {model}", "Server")
+                    logger.debug(lambda: f"403响应头: {dict(response.headers)}", "Server")
+                    logger.debug(lambda: f"403响应内容: {response.text[:2000]}", "Server")
 
                     # 删除当前使用的cf_clearance值
                     if CONFIG['SERVER']['CF_CLEARANCE']:
-                        logger.info(f"检测到CF验证失败，正在删除无效的CF_CLEARANCE值: {CONFIG['SERVER']['CF_CLEARANCE']}", "Server")
+                        logger.info(f"检测到CF验证失败，正在删除无效的CF_CLEARANCE值: {Utils.mask_secret(CONFIG['SERVER']['CF_CLEARANCE'])}", "Server")
                         cf_util.delete_data_by_cf_clearance(CONFIG['SERVER']['CF_CLEARANCE'])
                         # 清空当前使用的CF_CLEARANCE
                         CONFIG['SERVER']['CF_CLEARANCE'] = None
@@ -1864,31 +2718,31 @@ def chat_completions():
                 elif response.status_code == 429:
                     response_status_code = 429
                     # 记录失败的调用
-                    token_manager.record_token_usage(model, CONFIG["API"]["SIGNATURE_COOKIE"], False)
-                    token_manager.reduce_token_request_count(model,1)
+                    token_manager.record_token_usage(model, signature_cookie, False)
+                    token_manager.reduce_token_request_count(model, 1, signature_cookie)
                     if CONFIG["API"]["IS_CUSTOM_SSO"]:
                         raise ValueError(f"自定义SSO令牌当前模型{model}的请求次数已失效")
 
                     token_manager.remove_token_from_model(
-                        model, CONFIG["API"]["SIGNATURE_COOKIE"])
+                        model, signature_cookie)
                     if token_manager.get_token_count_for_model(model) == 0:
                         raise ValueError(f"{model} 次数已达上限，请切换其他模型或者重新对话")
 
                 else:
                     # 记录失败的调用
-                    token_manager.record_token_usage(model, CONFIG["API"]["SIGNATURE_COOKIE"], False)
+                    token_manager.record_token_usage(model, signature_cookie, False)
                     if CONFIG["API"]["IS_CUSTOM_SSO"]:
                         raise ValueError(f"自定义SSO令牌当前模型{model}的请求次数已失效")
 
                     logger.error(f"令牌异常错误状态!status: {response.status_code}","Server")
-                    token_manager.remove_token_from_model(model, CONFIG["API"]["SIGNATURE_COOKIE"])
+                    token_manager.remove_token_from_model(model, signature_cookie)
                     logger.info(
                         f"当前{model}剩余可用令牌数: {token_manager.get_token_count_for_model(model)}",
                         "Server")
 
             except Exception as e:
                 logger.error(f"请求处理异常 - 重试次数: {retry_count}, 模型: {model}, 异常类型: {type(e).__name__}, 异常信息: {str(e)}", "Server")
-                logger.debug(f"异常发生时的配置状态 - 令牌: {CONFIG['API']['SIGNATURE_COOKIE'][:50] if CONFIG['API']['SIGNATURE_COOKIE'] else 'None'}..., CF_CLEARANCE: {CONFIG['SERVER']['CF_CLEARANCE'][:50] if CONFIG['SERVER']['CF_CLEARANCE'] else 'None'}...", "Server")
+                logger.debug(lambda: f"异常发生时的配置状态 - 令牌: {Utils.mask_secret(signature_cookie)}, CF_CLEARANCE: {Utils.mask_secret(CONFIG['SERVER']['CF_CLEARANCE'])}", "Server")
                 
                 if CONFIG["API"]["IS_CUSTOM_SSO"]:
                     logger.error("自定义SSO模式下发生异常，直接抛出", "Server")
@@ -1896,6 +2750,9 @@ def chat_completions():
                     
                 logger.info(f"继续重试，当前重试次数: {retry_count}/{CONFIG['RETRY']['MAX_ATTEMPTS']}", "Server")
                 continue
+            finally:
+                if not stream_started:
+                    release_in_flight()
         if response_status_code == 403:
             raise ValueError('IP暂时被封无法破盾，请稍后重试或者更换ip')
         elif response_status_code == 500:
@@ -1903,6 +2760,8 @@ def chat_completions():
 
     except Exception as error:
         logger.error(f"聊天API最终异常 - 模型: {data.get('model', 'unknown') if 'data' in locals() else 'unknown'}, 状态码: {response_status_code}, 异常类型: {type(error).__name__}, 异常信息: {str(error)}", "ChatAPI")
+        if 'model' in locals():
+            record_chat_request(model, str(bool(stream)).lower(), response_status_code, timer)
         
         # 记录请求的基本信息用于调试
         try:
@@ -1910,7 +2769,7 @@ def chat_completions():
                 logger.debug(f"请求详情 - 模型: {data.get('model')}, 消息数量: {len(data.get('messages', []))}, 流式: {data.get('stream', False)}", "ChatAPI")
             if 'model' in locals():
                 remaining_capacity = token_manager.get_remaining_token_request_capacity()
-                logger.debug(f"当前令牌容量状态: {json.dumps(remaining_capacity, indent=2)}", "ChatAPI")
+                logger.debug(lambda: f"当前令牌容量状态: {json_util.dumps(remaining_capacity)}", "ChatAPI")
         except Exception as debug_error:
             logger.warning(f"记录调试信息时出错: {str(debug_error)}", "ChatAPI")
         
@@ -1921,6 +2780,140 @@ def chat_completions():
                 "timestamp": int(time.time())
             }}), response_status_code
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 文本格式的运行指标"""
+    auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if auth_token != CONFIG["API"]["API_KEY"]:
+        return jsonify({"error": 'Unauthorized'}), 401
+    try:
+        return Response(METRICS.render(), content_type=metrics_util.MetricsRegistry.CONTENT_TYPE)
+    except Exception as error:
+        logger.error(str(error), "Server")
+        return jsonify({"error": '获取运行指标失败'}), 500
+
+PROFILER = diagnostics_util.SamplingProfiler()
+
+@app.route('/admin/profile', methods=['GET'])
+def profile_server():
+    """
+    对运行中的服务进行采样性能分析
+
+    参数: seconds 采样时长（默认10，最长60）、interval_ms 采样间隔（默认5）、
+    idle 是否包含等待中的线程、format 为 collapsed（折叠栈文件）或 json（按栈顶函数汇总）
+    """
+    if not check_admin_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        seconds = min(max(float(request.args.get('seconds', 10)), 0.1), 60)
+        interval = min(max(float(request.args.get('interval_ms', 5)), 1), 1000) / 1000
+    except ValueError:
+        return jsonify({"error": "seconds 和 interval_ms 必须是数字"}), 400
+    include_idle = request.args.get('idle', 'false').lower() == 'true'
+
+    try:
+        result = PROFILER.profile(seconds, interval, include_idle)
+    except diagnostics_util.ProfilerBusyError as error:
+        return jsonify({"error": str(error)}), 409
+    logger.info(f"性能采样完成: {result['seconds']}秒, {result['samples']}轮, {len(result['stacks'])}个不同调用栈", "Diagnostics")
+
+    if request.args.get('format', 'collapsed') == 'json':
+        return jsonify({
+            "seconds": result["seconds"],
+            "samples": result["samples"],
+            "top_functions": diagnostics_util.summarize_stacks(result["stacks"])
+        })
+    return Response(
+        diagnostics_util.format_collapsed(result["stacks"]),
+        content_type='text/plain; charset=utf-8',
+        headers={"Content-Disposition": f"attachment; filename=profile-{int(time.time())}.collapsed"}
+    )
+
+MEMORY_TRACKER = diagnostics_util.MemoryTracker()
+
+def get_file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+@app.route('/admin/memory', methods=['GET'])
+def get_memory_report():
+    """进程内存与主要数据结构的大小；tracemalloc 开启时附带分配最多的位置（参数 top）"""
+    if not check_admin_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        limit = min(max(int(request.args.get('top', 20)), 1), 200)
+        report = {
+            "process": diagnostics_util.get_process_memory(),
+            "structures": {
+                "token_pool": diagnostics_util.deep_sizeof(
+                    token_manager.token_model_map, token_manager.token_status_map, token_manager.expired_tokens),
+                "usage_records": diagnostics_util.deep_sizeof(token_manager.token_usage_records),
+                "image_cache_index": diagnostics_util.deep_sizeof(IMAGE_CACHE),
+                "image_uploader": diagnostics_util.deep_sizeof(IMAGE_UPLOADER) if IMAGE_UPLOADER else None
+            },
+            "files": {
+                "token_manager_pickle": get_file_size(DATA_DIR / "token_manager.pickle"),
+                "token_status": get_file_size(CONFIG["TOKEN_STATUS_FILE"]),
+                "usage_records": get_file_size(token_manager.usage_records_file),
+                "image_cache": IMAGE_CACHE.stats()
+            },
+            "tracemalloc": MEMORY_TRACKER.status()
+        }
+        if report["tracemalloc"]["tracing"]:
+            report["tracemalloc"]["top"] = MEMORY_TRACKER.top(limit)
+        return jsonify(report)
+    except Exception as error:
+        logger.error(str(error), "Diagnostics")
+        return jsonify({"error": '获取内存信息失败'}), 500
+
+@app.route('/admin/memory/tracemalloc', methods=['POST'])
+def control_tracemalloc():
+    """
+    控制 tracemalloc
+
+    请求体: {"action": "start" | "stop" | "snapshot" | "diff" | "top", "frames": 1, "limit": 20, "key_type": "lineno"}
+    snapshot 记录基线，diff 返回与基线相比增长最多的分配位置
+    """
+    if not check_admin_auth():
+        return jsonify({"error": "Unauthorized"}), 401
+    body = request.get_json(silent=True) or {}
+    action = body.get('action')
+    key_type = body.get('key_type', 'lineno')
+    if key_type not in ('lineno', 'filename', 'traceback'):
+        return jsonify({"error": "key_type 只能是 lineno / filename / traceback"}), 400
+    try:
+        limit = min(max(int(body.get('limit', 20)), 1), 200)
+        if action == 'start':
+            result = MEMORY_TRACKER.start(int(body.get('frames', 1)))
+        elif action == 'stop':
+            result = MEMORY_TRACKER.stop()
+        elif action == 'snapshot':
+            result = MEMORY_TRACKER.snapshot()
+        elif action == 'diff':
+            result = {**MEMORY_TRACKER.status(), "diff": MEMORY_TRACKER.diff(limit, key_type)}
+        elif action == 'top':
+            result = {**MEMORY_TRACKER.status(), "top": MEMORY_TRACKER.top(limit, key_type)}
+        else:
+            return jsonify({"error": "action 只能是 start / stop / snapshot / diff / top"}), 400
+    except (RuntimeError, ValueError) as error:
+        return jsonify({"error": str(error)}), 400
+    logger.info(f"tracemalloc 操作: {action}", "Diagnostics")
+    return jsonify(result)
+
+@app.route('/images/<image_id>', methods=['GET'])
+def get_cached_image(image_id):
+    """返回本地缓存的生成图片，支持 ETag 与 Range 请求"""
+    entry = IMAGE_CACHE.get(image_id)
+    if not entry:
+        return jsonify({"error": "Not Found"}), 404
+    path, mimetype = entry
+    # 图片按内容寻址，内容不会变化，可以长期缓存
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=image_id.split(".")[0], max_age=31536000)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def catch_all(path):
@@ -1937,8 +2930,8 @@ def catch_all(path):
 
 
 
-# 初始化Faker
-fake = Faker()
+# Faker 导入较慢，只在需要生成User-Agent时创建
+_faker = None
 
 # 默认管理员密码，如果环境变量未设置则使用此密码
 DEFAULT_ADMIN_PASSWORD = "123456"
@@ -1953,113 +2946,57 @@ CF_CLEARANCE_SIZE = os.environ.get("CF_CLEARANCE_SIZE", DEFAULT_CF_CLEARANCE_SIZ
 logger.info(
     f"当前配置中需要生成CF值的数量: {'环境变量' if CF_CLEARANCE_SIZE != DEFAULT_CF_CLEARANCE_SIZE else '默认值'}")
 
-# 存储配置和数据的文件路径
-CONFIG_FILE = "data/cf_config.json"
-COOKIES_FILE = "data/cf_cookies.json"  # 保留用于兼容性，实际数据会同时存储在CONFIG_FILE中
+# 存储配置和数据的文件路径，读写都经过 cf_util.COOKIE_STORE 的内存索引
+CONFIG_FILE = cf_util.CONFIG_FILE
+COOKIES_FILE = cf_util.COOKIES_FILE  # 保留用于兼容性，实际数据会同时存储在CONFIG_FILE中
 
 # 默认配置
-DEFAULT_CONFIG = {
-    "url": "https://grok.com",
-    "need_update": {
-        "proxy_url_pool": [],
-        "user_agent_list": [],
-        "user_agent": None
-    },
-    "exist_data_list": []
-}
-
-# 确保配置文件存在
-if not os.path.exists(CONFIG_FILE):
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(DEFAULT_CONFIG, f, indent=4)
-    logger.info(f"创建配置文件: {CONFIG_FILE}")
-
-# 历史兼容性：如果cookies文件存在但配置文件的exist_data_list为空，则导入cookies
-if os.path.exists(COOKIES_FILE):
-    try:
-        with open(COOKIES_FILE, "r") as f:
-            cookies = json.load(f)
-
-        if cookies:
-            # 将cookies导入到配置文件中
-            config = DEFAULT_CONFIG
-            if os.path.exists(CONFIG_FILE):
-                with open(CONFIG_FILE, "r") as f:
-                    config = json.load(f)
-
-            if not config.get("exist_data_list"):
-                config["exist_data_list"] = cookies
-                with open(CONFIG_FILE, "w") as f:
-                    json.dump(config, f, indent=4)
-                logger.info(f"已将历史Cookie数据导入到配置文件中")
-    except Exception as e:
-        logger.error(f"导入历史Cookie数据失败: {str(e)}")
-else:
-    # 创建一个空的cookies文件用于兼容性
-    with open(COOKIES_FILE, "w") as f:
-        json.dump([], f, indent=4)
-    logger.info(f"创建空的Cookie文件用于兼容性: {COOKIES_FILE}")
-
-
-class CookieData(BaseModel):
-    user_agent: str
-    cookies: List[Dict[str, Any]]
-    proxy_url: Optional[str] = None
-    update_time: int
-    expire_time: int
-
-    def to_dict(self):
-        """兼容不同版本的Pydantic，返回模型的字典表示"""
-        # 尝试使用 model_dump (Pydantic v2+)
-        if hasattr(self, "model_dump"):
-            return self.model_dump()
-        # 回退到 dict (Pydantic v1)
-        return self.dict()
-
-
-def load_config():
-    """加载配置文件"""
-    try:
-        with open(CONFIG_FILE, "r") as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"加载配置文件失败: {str(e)}")
-        return DEFAULT_CONFIG
+DEFAULT_CONFIG = cf_util.DEFAULT_CONFIG
 
-
-def save_config(config):
-    """保存配置文件"""
-    try:
+def migrate_cf_files():
+    """创建 cf 配置文件，并把历史的 cf_cookies.json 导入配置文件，在 bootstrap 时执行一次"""
+    # 确保配置文件存在
+    if not os.path.exists(CONFIG_FILE):
         with open(CONFIG_FILE, "w") as f:
-            json.dump(config, f, indent=4)
-    except Exception as e:
-        logger.error(f"保存配置文件失败: {str(e)}")
-
-
-def load_cookies():
-    """加载Cookie文件（仅用于兼容性）"""
-    try:
-        with open(COOKIES_FILE, "r") as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"加载Cookie文件失败: {str(e)}")
-        return []
+            json.dump(DEFAULT_CONFIG, f, indent=4)
+        logger.info(f"创建配置文件: {CONFIG_FILE}")
 
-
-def save_cookies(cookies):
-    """保存Cookie文件（仅用于兼容性）"""
-    try:
+    # 历史兼容性：如果cookies文件存在但配置文件的exist_data_list为空，则导入cookies
+    if os.path.exists(COOKIES_FILE):
+        try:
+            with open(COOKIES_FILE, "r") as f:
+                cookies = json.load(f)
+
+            if cookies:
+                # 将cookies导入到配置文件中
+                config = DEFAULT_CONFIG
+                if os.path.exists(CONFIG_FILE):
+                    with open(CONFIG_FILE, "r") as f:
+                        config = json.load(f)
+
+                if not config.get("exist_data_list"):
+                    config["exist_data_list"] = cookies
+                    with open(CONFIG_FILE, "w") as f:
+                        json.dump(config, f, indent=4)
+                    logger.info(f"已将历史Cookie数据导入到配置文件中")
+        except Exception as e:
+            logger.error(f"导入历史Cookie数据失败: {str(e)}")
+    else:
+        # 创建一个空的cookies文件用于兼容性
         with open(COOKIES_FILE, "w") as f:
-            json.dump(cookies, f, indent=4)
-    except Exception as e:
-        logger.error(f"保存Cookie文件失败: {str(e)}")
+            json.dump([], f, indent=4)
+        logger.info(f"创建空的Cookie文件用于兼容性: {COOKIES_FILE}")
 
 
 def generate_random_user_agents(count=1):
     """生成随机的User-Agent字符串"""
+    global _faker
+    if _faker is None:
+        from faker import Faker
+        _faker = Faker()
     user_agents = []
     for _ in range(count):
-        user_agents.append(fake.user_agent())
+        user_agents.append(_faker.user_agent())
     return user_agents
 
 
@@ -2075,19 +3012,6 @@ def is_cookie_expired(cookie, user_agent, proxy_url=None):
                 current_time >= cookie.get("expire_time", 0))
 
 
-def verify_admin_password(admin_password: str = Query(None)):
-    """验证管理员密码"""
-    if not admin_password:
-        logger.warning("请求缺少admin_password参数")
-        raise HTTPException(status_code=403, detail="Missing admin password")
-
-    if admin_password != ADMIN_PASSWORD:
-        logger.warning(f"管理员密码验证失败: 提供的密码与系统密码不匹配")
-        raise HTTPException(status_code=403, detail="Invalid admin password")
-
-    return True
-
-
 @app.route("/api/get-cf-list", methods=['GET'])
 def get_cf_list():
     """获取需要更新的代理和用户代理列表"""
@@ -2104,68 +3028,38 @@ def get_cf_list():
     # 验证密码
     if admin_password != DEFAULT_ADMIN_PASSWORD:
         logger.warning(f"管理员密码验证失败: 接收到的密码与默认密码不匹配")
-        logger.info(f"接收到的密码: {admin_password}, 默认密码: {DEFAULT_ADMIN_PASSWORD}")
+        logger.info(f"接收到的密码: {Utils.mask_secret(admin_password, 2)}")
         return jsonify({"error": "Invalid admin password"}), 403
 
-    # 加载配置
-    config = load_config()
-
-    # 验证和清理exist_data_list中的数据
-    valid_cookies = []
-    for cookie in config.get("exist_data_list", []):
-        # 检查必要字段是否存在
-        if "user_agent" in cookie and "cookies" in cookie and "expire_time" in cookie:
-            valid_cookies.append(cookie)
-        else:
-            logger.warning(f"发现无效的cookie格式，已忽略: {cookie}")
-
-    # 更新配置中的有效cookie
-    config["exist_data_list"] = valid_cookies
+    store = cf_util.COOKIE_STORE
+    settings = store.get_settings()
+    need_update_config = settings["need_update"]
 
     # 检查哪些配置需要更新
     need_update = {
         "proxy_url_pool": [],
         "user_agent_list": [],
-        "user_agent": config["need_update"].get("user_agent")
+        "user_agent": need_update_config.get("user_agent")
     }
 
     # 如果user_agent_list为空，使用faker生成10个随机user-agent
-    if not config["need_update"].get("user_agent_list"):
+    if not need_update_config.get("user_agent_list"):
         logger.info("User-Agent列表为空，自动生成10个随机User-Agent")
         need_update["user_agent_list"] = generate_random_user_agents(10)
-        # 保存生成的User-Agent到配置中
-        config["need_update"]["user_agent_list"] = need_update["user_agent_list"]
-        save_config(config)
     else:
-        need_update["user_agent_list"] = config["need_update"].get("user_agent_list", [])
+        need_update["user_agent_list"] = need_update_config.get("user_agent_list", [])
+
+    # 未过期的 (proxy_url, user_agent) 组合由过期堆维护，每个组合只需一次集合查找
+    fresh_keys = store.get_fresh_keys()
+    user_agents = list(dict.fromkeys(need_update["user_agent_list"]))
 
     # 检查代理池中的代理是否需要更新
-    for proxy_url in config["need_update"].get("proxy_url_pool", []):
-        for user_agent in need_update["user_agent_list"]:
-            need_update_for_this_pair = True
-            for cookie in valid_cookies:
-                if (cookie.get("proxy_url") == proxy_url and
-                        cookie.get("user_agent") == user_agent and
-                        int(time.time()) < cookie.get("expire_time", 0)):
-                    need_update_for_this_pair = False
-                    break
-
-            if need_update_for_this_pair and proxy_url not in need_update["proxy_url_pool"]:
-                need_update["proxy_url_pool"].append(proxy_url)
+    for proxy_url in dict.fromkeys(need_update_config.get("proxy_url_pool", [])):
+        if any((proxy_url, user_agent) not in fresh_keys for user_agent in user_agents):
+            need_update["proxy_url_pool"].append(proxy_url)
 
     # 检查用户代理是否需要更新
-    user_agents_to_update = []
-    for user_agent in need_update["user_agent_list"]:
-        need_update_for_this_ua = True
-        for cookie in valid_cookies:
-            if (cookie.get("proxy_url") is None and
-                    cookie.get("user_agent") == user_agent and
-                    int(time.time()) < cookie.get("expire_time", 0)):
-                need_update_for_this_ua = False
-                break
-
-        if need_update_for_this_ua and user_agent not in user_agents_to_update:
-            user_agents_to_update.append(user_agent)
+    user_agents_to_update = [user_agent for user_agent in user_agents if (None, user_agent) not in fresh_keys]
 
     # 为了兼容客户端，我们保留原来的完整user_agent_list
     user_agent_list_full = need_update["user_agent_list"].copy()
@@ -2173,16 +3067,15 @@ def get_cf_list():
     # 只更新需要更新的user_agent，但保留完整列表的引用
     need_update["user_agent_list"] = user_agents_to_update
 
-    # 更新配置
-    config["need_update"] = need_update
-    save_config(config)
-
-    # 为了兼容，将数据也同步到cookies文件
-    save_cookies(valid_cookies)
+    # 更新配置，内容没有变化时不写盘
+    store.update_settings(need_update=need_update)
 
     # 构建响应数据
-    response_data = dict(config)
-    response_data["need_update"]["user_agent_list_full"] = user_agent_list_full
+    response_data = {
+        **settings,
+        "need_update": {**need_update, "user_agent_list_full": user_agent_list_full},
+        "exist_data_list": store.get_entries()
+    }
 
     logger.info(
         f"返回配置信息: url={response_data['url']}, need_update.proxy_url_pool数量={len(need_update['proxy_url_pool'])}, need_update.user_agent_list数量={len(need_update['user_agent_list'])}")
@@ -2206,52 +3099,18 @@ def set_cf_cookie():
     # 验证密码
     if admin_password != DEFAULT_ADMIN_PASSWORD:
         logger.warning(f"管理员密码验证失败: 接收到的密码与默认密码不匹配")
-        logger.info(f"接收到的密码: {admin_password}, 默认密码: {DEFAULT_ADMIN_PASSWORD}")
+        logger.info(f"接收到的密码: {Utils.mask_secret(admin_password, 2)}")
         return jsonify({"error": "Invalid admin password"}), 403
         
     # 从请求中获取cookie数据
     try:
         cookie_data = request.get_json()
-        
-        # 加载当前配置和Cookie列表
-        config = load_config()
-        cookies = config.get("exist_data_list", [])
-        
-        # 检查是否已存在相同条件的cookie
-        found = False
-        for i, cookie in enumerate(cookies):
-            need_update = False
-        
-            # 检查是否是相同条件的cookie
-            if cookie_data.get("proxy_url") is not None:
-                if (cookie.get("proxy_url") == cookie_data.get("proxy_url") and
-                        cookie.get("user_agent") == cookie_data.get("user_agent")):
-                    found = True
-                    need_update = True
-            else:
-                if (cookie.get("proxy_url") is None and
-                        cookie.get("user_agent") == cookie_data.get("user_agent")):
-                    found = True
-                    need_update = True
-        
-            if need_update:
-                # 更新cookie
-                cookies[i] = cookie_data
-                break
-        
-        if not found:
-            # 添加新cookie
-            cookies.append(cookie_data)
-        
-        # 更新配置文件中的exist_data_list
-        config["exist_data_list"] = cookies
-        save_config(config)
-        
-        # 为了兼容性，也保存到cookies文件
-        save_cookies(cookies)
+
+        # 相同 (proxy_url, user_agent) 的cookie直接替换，否则新增；格式不合法时抛出 ValueError
+        cf_util.COOKIE_STORE.set_cookie(cookie_data)
         
         logger.info(
-            f"成功保存Cookie: user_agent={cookie_data.get('user_agent')[:50]}...")
+            f"成功保存Cookie: user_agent={(cookie_data.get('user_agent') or '')[:50]}...")
         
         return jsonify({"status": "success", "message": "Cookie saved successfully"})
     except Exception as e:
@@ -2275,28 +3134,19 @@ def update_config():
     # 验证密码
     if admin_password != DEFAULT_ADMIN_PASSWORD:
         logger.warning(f"管理员密码验证失败: 接收到的密码与默认密码不匹配")
-        logger.info(f"接收到的密码: {admin_password}, 默认密码: {DEFAULT_ADMIN_PASSWORD}")
+        logger.info(f"接收到的密码: {Utils.mask_secret(admin_password, 2)}")
         return jsonify({"error": "Invalid admin password"}), 403
 
     try:
         config_data = request.get_json()
-        current_config = load_config()
+        need_update = config_data.get("need_update") or {}
 
         # 更新配置
-        if "url" in config_data:
-            current_config["url"] = config_data["url"]
-
-        if "need_update" in config_data:
-            if "proxy_url_pool" in config_data["need_update"]:
-                current_config["need_update"]["proxy_url_pool"] = config_data["need_update"]["proxy_url_pool"]
-
-            if "user_agent_list" in config_data["need_update"]:
-                current_config["need_update"]["user_agent_list"] = config_data["need_update"]["user_agent_list"]
-
-            if "user_agent" in config_data["need_update"]:
-                current_config["need_update"]["user_agent"] = config_data["need_update"]["user_agent"]
-
-        save_config(current_config)
+        cf_util.COOKIE_STORE.update_settings(
+            url=config_data.get("url"),
+            need_update={key: need_update[key] for key in ("proxy_url_pool", "user_agent_list", "user_agent")
+                         if key in need_update}
+        )
         logger.info(f"成功更新配置")
 
         return jsonify({"status": "success", "message": "Config updated successfully"})
@@ -2329,11 +3179,15 @@ def debug_info():
     }
 
 if __name__ == '__main__':
+    # 开发调试用，生产环境请使用 gunicorn -c gunicorn.conf.py wsgi:app
+    bootstrap()
 
-    logger.info(f"管理员密码来源: {'环境变量' if ADMIN_PASSWORD != DEFAULT_ADMIN_PASSWORD else '默认值'}")
+    def handle_exit_signal(signum, frame):
+        shutdown()
+        raise SystemExit(0)
 
-    token_manager = AuthTokenManager()
-    initialization()
+    signal.signal(signal.SIGTERM, handle_exit_signal)
+    signal.signal(signal.SIGINT, handle_exit_signal)
 
     app.run(
         host='0.0.0.0',
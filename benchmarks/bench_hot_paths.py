@@ -0,0 +1,335 @@
+"""
+纯Python热路径的微基准：令牌租用/回退、逐个/批量添加令牌、过期检查、prepare_chat_request、响应转换、
+cf求解器轮询的 /api/get-cf-list 与 /api/set-cf-cookie
+
+结果可保存为JSON基线，之后用 --compare 对比，任一项吞吐下降超过阈值时以非零状态退出。
+基线与机器相关，请在同一台机器上生成和对比。默认规模（1万个令牌）下运行需要几分钟，
+可用 --tokens 调小快速验证。
+
+为避免写入仓库的 data 目录，脚本在临时目录中运行；prepare_chat_request 的文件/图片上传
+发往进程内启动的 mock_grok 模拟上游。日志级别默认为 WARNING，可用 LOG_LEVEL 覆盖。
+
+用法:
+  python benchmarks/bench_hot_paths.py --save baseline.json
+  python benchmarks/bench_hot_paths.py --compare baseline.json --threshold 0.15
+  python benchmarks/bench_hot_paths.py --only token_lease_release --tokens 10000
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+ORIGINAL_CWD = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="grok2api-bench-"))
+
+import app  # noqa: E402
+import json_util  # noqa: E402
+import mock_grok  # noqa: E402
+
+MODELS = list(app.AuthTokenManager().model_super_config.keys())
+
+RESPONSE_FAMILIES = {
+    "grok-3": {},
+    "grok-3-reasoning": {"isReasoning": True},
+    "grok-3-deepsearch": {"deepsearchPreset": "default"},
+    "grok-4-reasoning": {"isReasoning": True},
+    "grok-3-imageGen": {"toolOverrides": {"imageGen": True}}
+}
+
+
+def create_manager(token_count, token_type="super"):
+    manager = app.AuthTokenManager()
+    # 基准只测调用本身，不启动后台重置定时器
+    manager.token_reset_switch = True
+    for index in range(token_count):
+        manager.add_token({"token": f"sso-rw=bench{index};sso=bench{index}", "type": token_type}, True)
+    return manager
+
+
+def bench_token_lease_release(args):
+    manager = create_manager(args.tokens)
+    operations = args.lease_ops
+
+    def run():
+        for index in range(operations):
+            model = MODELS[index % len(MODELS)]
+            token = manager.get_next_token_for_model(model)
+            manager.reduce_token_request_count(model, 1, token)
+    return operations, run
+
+
+def bench_add_token_bulk(args):
+    def run():
+        manager = app.AuthTokenManager()
+        for index in range(args.tokens):
+            manager.add_token({"token": f"sso-rw=bulk{index};sso=bulk{index}", "type": "super"}, True)
+        manager.save_token_status()
+    return args.tokens, run
+
+
+def bench_add_tokens_import(args):
+    ssos = [f"bulk{index}" for index in range(args.tokens)]
+
+    def run():
+        manager = app.AuthTokenManager()
+        manager.add_tokens(ssos, "super")
+    return args.tokens, run
+
+
+def bench_check_and_reset(args):
+    manager = create_manager(args.tokens)
+    long_ago = int(time.time() * 1000) - 48 * 60 * 60 * 1000
+
+    def setup():
+        # 一半令牌处于已过期待重置，另一半已开始计时且超过重置周期
+        manager.expired_tokens = set()
+        for model, entries in manager.token_model_map.items():
+            for index, entry in enumerate(entries):
+                if index % 2:
+                    manager.expired_tokens.add((entry["token"], model, long_ago, entry["type"]))
+                else:
+                    entry["StartCallTime"] = long_ago
+                    entry["RequestCount"] = 1
+    return args.tokens, manager.check_and_reset_expired_tokens, setup
+
+
+def seed_cf_config(args):
+    """写入 --cf-proxies 个代理 × --cf-user-agents 个UA 的cf配置，每个组合都有一条未过期的Cookie"""
+    proxies = [f"http://proxy{index}.local:8080" for index in range(args.cf_proxies)]
+    user_agents = [f"Mozilla/5.0 bench-agent-{index}" for index in range(args.cf_user_agents)]
+    expire_time = int(time.time()) + 3600
+    cookies = [
+        {"proxy_url": proxy_url, "user_agent": user_agent, "expire_time": expire_time,
+         "cookies": [{"name": "cf_clearance", "value": f"cf-{proxy_index}-{ua_index}"}]}
+        for proxy_index, proxy_url in enumerate([None] + proxies)
+        for ua_index, user_agent in enumerate(user_agents)
+    ]
+    config = {
+        "url": "https://grok.com",
+        "need_update": {"proxy_url_pool": proxies, "user_agent_list": user_agents, "user_agent": None},
+        "exist_data_list": cookies
+    }
+    os.makedirs("data", exist_ok=True)
+    with open(app.CONFIG_FILE, "w") as f:
+        json.dump(config, f, indent=4)
+    return cookies
+
+
+def bench_cf_get_list(args):
+    seed_cf_config(args)
+    client = app.app.test_client()
+    operations = args.cf_ops
+
+    def run():
+        for _ in range(operations):
+            client.get(f"/api/get-cf-list?admin_password={app.DEFAULT_ADMIN_PASSWORD}")
+    return operations, run
+
+
+def bench_cf_set_cookie(args):
+    cookies = seed_cf_config(args)
+    client = app.app.test_client()
+    operations = args.cf_ops
+
+    def run():
+        for index in range(operations):
+            client.post(f"/api/set-cf-cookie?admin_password={app.DEFAULT_ADMIN_PASSWORD}",
+                        json=cookies[(index * 7919) % len(cookies)])
+    return operations, run
+
+
+def start_mock_upstream():
+    options = argparse.Namespace(tokens=50, token_rate=0, latency_ms=0, rate_429=0.0, rate_403=0.0, replay=None)
+    server = mock_grok.MockGrokServer(("127.0.0.1", 0), options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app.CONFIG["API"]["BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+    app.token_manager = create_manager(50)
+    return server
+
+
+def build_history(message_count, message_chars):
+    text = ("历史消息内容 " * (message_chars // 7 + 1))[:message_chars]
+    messages = [{"role": "system", "content": "你是一个助手"}]
+    for index in range(message_count):
+        messages.append({"role": "user" if index % 2 == 0 else "assistant", "content": f"{index}: {text}"})
+    return messages
+
+
+def bench_prepare_long_history(args):
+    messages = build_history(args.history, args.message_chars)
+    messages.append({"role": "user", "content": "继续"})
+    client = app.GrokApiClient("grok-3")
+    request = {"model": "grok-3", "messages": messages}
+    operations = args.prepare_ops
+
+    def run():
+        for _ in range(operations):
+            client.prepare_chat_request(request)
+    return operations, run
+
+
+def bench_prepare_inline_images(args):
+    image_url = "data:image/png;base64," + base64.b64encode(mock_grok.make_png(256, 256)).decode("ascii")
+    messages = build_history(args.history // 4, args.message_chars)
+    messages.append({"role": "user", "content": [
+        {"type": "text", "text": "描述这两张图片"},
+        {"type": "image_url", "image_url": {"url": image_url}},
+        {"type": "image_url", "image_url": {"url": image_url}}
+    ]})
+    client = app.GrokApiClient("grok-3")
+    request = {"model": "grok-3", "messages": messages}
+    operations = args.prepare_ops
+
+    def run():
+        for _ in range(operations):
+            client.prepare_chat_request(request)
+    return operations, run
+
+
+def load_streams(args):
+    """使用录制的NDJSON（--replay），否则使用 mock_grok 按模型特征合成的流"""
+    if args.replay:
+        replays = mock_grok.MockGrokServer._load_replays(args.replay)
+        return {"replay": replays}
+    return {
+        model: [[json.dumps(line, ensure_ascii=False).encode("utf-8")
+                 for line in mock_grok.build_stream({"message": "hi", **payload}, args.stream_tokens)]]
+        for model, payload in RESPONSE_FAMILIES.items()
+    }
+
+
+def make_response_bench(model, streams):
+    transformer_model = "grok-3" if model == "replay" else model
+
+    def factory(args):
+        line_count = sum(len(lines) for lines in streams)
+
+        def run():
+            for lines in streams:
+                transformer = app.create_response_transformer(transformer_model)
+                for line in lines:
+                    response = json_util.loads(line).get("result", {}).get("response")
+                    if response:
+                        transformer.process(response)
+        return line_count, run
+    return factory
+
+
+def run_case(factory, args):
+    """返回每秒操作数的中位数与各轮结果"""
+    prepared = factory(args)
+    operations, func = prepared[0], prepared[1]
+    setup = prepared[2] if len(prepared) > 2 else None
+    rates = []
+    for _ in range(args.repeat):
+        if setup:
+            setup()
+        started_at = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started_at
+        rates.append(operations / elapsed)
+    return {"ops_per_second": statistics.median(rates), "runs": [round(rate, 2) for rate in rates], "operations": operations}
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    print(f"\n{'用例':<34}{'基线 ops/s':>14}{'当前 ops/s':>14}{'变化':>10}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["ops_per_second"]
+        after = result["ops_per_second"]
+        change = after / before - 1
+        flag = ""
+        if change < -threshold:
+            regressions.append(name)
+            flag = "  <- 退化"
+        print(f"{name:<34}{before:>14,.1f}{after:>14,.1f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="热路径微基准")
+    parser.add_argument("--tokens", type=int, default=10000, help="令牌池大小")
+    parser.add_argument("--lease-ops", type=int, default=20, help="每轮租用/回退次数")
+    parser.add_argument("--history", type=int, default=120, help="历史消息条数")
+    parser.add_argument("--message-chars", type=int, default=400, help="每条历史消息的字符数")
+    parser.add_argument("--prepare-ops", type=int, default=20, help="每轮 prepare_chat_request 次数")
+    parser.add_argument("--stream-tokens", type=int, default=2000, help="合成流的token数")
+    parser.add_argument("--cf-proxies", type=int, default=50, help="cf配置中的代理数")
+    parser.add_argument("--cf-user-agents", type=int, default=10, help="cf配置中的UA数")
+    parser.add_argument("--cf-ops", type=int, default=50, help="每轮cf接口调用次数")
+    parser.add_argument("--replay", help="用于响应转换基准的录制 NDJSON 文件或目录")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", action="append", help="只运行指定用例，可重复")
+    parser.add_argument("--save", help="把结果保存为基线JSON")
+    parser.add_argument("--compare", help="与基线JSON对比")
+    parser.add_argument("--threshold", type=float, default=0.15, help="允许的吞吐下降比例")
+    args = parser.parse_args()
+    for name in ("replay", "save", "compare"):
+        if getattr(args, name):
+            setattr(args, name, os.path.join(ORIGINAL_CWD, getattr(args, name)))
+
+    cases = {
+        "token_lease_release": bench_token_lease_release,
+        "add_token_bulk": bench_add_token_bulk,
+        "add_tokens_import": bench_add_tokens_import,
+        "check_and_reset_expired_tokens": bench_check_and_reset,
+        "prepare_chat_request_long_history": bench_prepare_long_history,
+        "prepare_chat_request_inline_images": bench_prepare_inline_images,
+        "cf_get_list": bench_cf_get_list,
+        "cf_set_cookie": bench_cf_set_cookie,
+    }
+    for model, streams in load_streams(args).items():
+        cases[f"process_response[{model}]"] = make_response_bench(model, streams)
+
+    selected = {name: factory for name, factory in cases.items() if not args.only or name in args.only}
+    if any(name.startswith("prepare_chat_request") for name in selected):
+        mock_server = start_mock_upstream()
+    else:
+        mock_server = None
+
+    results = {}
+    print(f"Python {platform.python_version()}，JSON后端: {json_util.BACKEND}，令牌数: {args.tokens}")
+    for name, factory in selected.items():
+        results[name] = run_case(factory, args)
+        print(f"{name:<40}{results[name]['ops_per_second']:>14,.1f} ops/s")
+
+    if mock_server:
+        mock_server.shutdown()
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({
+                "meta": {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "json_backend": json_util.BACKEND,
+                    "created": int(time.time()),
+                    "params": {key: value for key, value in vars(args).items() if key not in ("save", "compare")}
+                },
+                "results": results
+            }, f, ensure_ascii=False, indent=2)
+        print(f"基线已保存: {args.save}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print(f"\n吞吐下降超过 {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+图片转码基准：统计不同缩放/格式配置下节省的字节数与增加的延迟
+
+需要安装 Pillow。默认生成一张 2048x2048 的合成图片，也可以用 --image 指定真实图片。
+用法: python benchmarks/bench_image_transcode.py [--image path] [--rounds 5]
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import image_util  # noqa: E402
+
+CASES = [
+    {"MAX_DIMENSION": 0, "FORMAT": "webp", "QUALITY": 85},
+    {"MAX_DIMENSION": 0, "FORMAT": "jpeg", "QUALITY": 85},
+    {"MAX_DIMENSION": 1024, "FORMAT": "webp", "QUALITY": 85},
+    {"MAX_DIMENSION": 1024, "FORMAT": "jpeg", "QUALITY": 80},
+    {"MAX_DIMENSION": 768, "FORMAT": "webp", "QUALITY": 75},
+]
+
+
+def synthetic_image(size):
+    from PIL import Image, ImageDraw, ImageFilter
+
+    image = Image.effect_noise((size, size), 40).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for i in range(0, size, size // 16):
+        draw.ellipse((i // 2, i // 2, size - i // 2, size - i // 2), outline=(i % 255, 120, 255 - i % 255), width=size // 64)
+    image = image.filter(ImageFilter.GaussianBlur(2))
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue(), "image/png"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image")
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, "rb") as f:
+            data = f.read()
+        content_type = "image/png" if args.image.lower().endswith(".png") else "image/jpeg"
+    else:
+        data, content_type = synthetic_image(args.size)
+
+    transcoder = image_util.ImageTranscoder(max_workers=2)
+    if not transcoder.available:
+        print("未安装 Pillow，无法运行转码基准")
+        return
+    # 预热进程池，避免把进程启动时间计入延迟
+    transcoder.transcode(data, content_type, {"ENABLED": True, **CASES[0]})
+
+    print(f"原图: {len(data) / 1024:.1f}KB ({content_type})")
+    print(f"{'配置':<32}{'输出(KB)':>10}{'节省':>8}{'进程内(ms)':>12}{'进程池(ms)':>12}")
+    for case in CASES:
+        options = {"ENABLED": True, **case}
+        inline, pooled = [], []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            result = image_util.transcode_image(data, case["MAX_DIMENSION"], case["FORMAT"], case["QUALITY"])
+            inline.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            output, _ = transcoder.transcode(data, content_type, options)
+            pooled.append((time.perf_counter() - start) * 1000)
+        size = len(result[0]) if result else len(data)
+        label = f"max={case['MAX_DIMENSION']} {case['FORMAT']} q={case['QUALITY']}"
+        print(f"{label:<32}{size / 1024:>10.1f}{1 - size / len(data):>8.1%}"
+              f"{statistics.median(inline):>12.1f}{statistics.median(pooled):>12.1f}")
+    transcoder.shutdown()
+
+
+if __name__ == "__main__":
+    main()
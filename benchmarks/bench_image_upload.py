@@ -0,0 +1,113 @@
+"""
+图床上传基准：用本地替身图床对比一次性 requests.post 与 image_util.ImageUploader
+
+替身服务按 PICGO 接口返回 {"image": {"url": ...}}，可模拟延迟与失败率。
+用法: python benchmarks/bench_image_upload.py [--images 50] [--concurrency 4] [--fail-rate 0.1]
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import requests  # noqa: E402
+
+import image_util  # noqa: E402
+import json_util  # noqa: E402
+
+
+def start_stand_in_host(latency, fail_rate):
+    stats = {"uploads": 0, "failures": 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency)
+            with lock:
+                stats["uploads"] += 1
+                failed = random.random() < fail_rate
+                stats["failures"] += failed
+            if failed:
+                body = b'{"error":"busy"}'
+                self.send_response(503)
+            else:
+                body = json_util.dumps_bytes({"image": {"url": f"http://img.local/{stats['uploads']}.jpg"}})
+                self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats
+
+
+def one_off_upload(url, data):
+    # 与改造前 handle_image_response 相同：每张图一次独立请求，无会话无超时无重试
+    response = requests.post(url, files={"source": ("image.jpg", data, "image/jpeg")}, headers={"X-API-Key": "bench"})
+    return response.status_code == 200
+
+
+def run(label, func, images, concurrency):
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(func, images))
+    elapsed = time.perf_counter() - start
+    ok = sum(1 for r in results if r)
+    print(f"{label:<20}{elapsed:>10.2f}s{len(images) / elapsed:>12.1f} img/s{ok:>8}/{len(images)} 成功")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=50)
+    parser.add_argument("--image-kb", type=int, default=256)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--fail-rate", type=float, default=0.1)
+    parser.add_argument("--duplicate-rate", type=float, default=0.2)
+    args = parser.parse_args()
+
+    server, stats = start_stand_in_host(args.latency, args.fail_rate)
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/1/upload"
+
+    unique = [os.urandom(args.image_kb * 1024) for _ in range(args.images)]
+    images = [random.choice(unique[:i]) if i and random.random() < args.duplicate_rate else unique[i]
+              for i in range(args.images)]
+
+    run("requests.post", lambda data: one_off_upload(url, data), images, args.concurrency)
+    baseline_uploads = stats["uploads"]
+
+    uploader = image_util.ImageUploader(
+        image_util.PicgoProvider("bench", url),
+        max_concurrency=args.concurrency,
+        timeout=5,
+        max_retries=3,
+        backoff=0.05
+    )
+
+    def pooled_upload(data):
+        try:
+            return uploader.upload(data)
+        except image_util.ImageUploadError:
+            return None
+
+    run("ImageUploader", pooled_upload, images, args.concurrency)
+    print(f"替身图床收到请求: requests.post={baseline_uploads}, ImageUploader={stats['uploads'] - baseline_uploads}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+JSON 编解码基准：对比标准库 json 与 json_util（orjson 可用时）在热路径上的耗时
+
+计时前先核对 app 的 JSON provider 对 Decimal、UUID、dataclass、日期的输出与Flask默认实现一致，不一致时以非零状态退出。
+
+用法: python benchmarks/bench_json.py [--rounds 20000]
+"""
+import argparse
+import base64
+import dataclasses
+import datetime
+import decimal
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import json_util  # noqa: E402
+import stream_util  # noqa: E402
+
+NDJSON_LINE = json.dumps({
+    "result": {
+        "response": {
+            "token": "你好",
+            "isThinking": False,
+            "isSoftStop": False,
+            "responseId": str(uuid.uuid4()),
+            "messageTag": "final"
+        }
+    }
+}).encode("utf-8")
+
+SSE_ENVELOPE = {
+    "id": f"chatcmpl-{uuid.uuid4()}",
+    "created": int(time.time()),
+    "model": "grok-3",
+    "object": "chat.completion.chunk",
+    "choices": [{"index": 0, "delta": {"content": "你好，世界"}}]
+}
+
+
+def build_request_body(image_bytes):
+    image = base64.b64encode(os.urandom(image_bytes)).decode("ascii")
+    return json.dumps({
+        "model": "grok-3",
+        "stream": True,
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": [
+                {"type": "text", "text": "描述这张图片"},
+                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image}"}}
+            ]}
+        ]
+    }).encode("utf-8")
+
+
+@dataclasses.dataclass
+class SamplePoint:
+    x: int
+    y: float
+
+
+def check_provider_types():
+    """jsonify 使用的 CodecJSONProvider 应与 Flask 的 DefaultJSONProvider 得到相同的结果"""
+    from flask.json.provider import DefaultJSONProvider
+
+    import app
+
+    sample = {
+        "decimal": decimal.Decimal("1.10"),
+        "uuid": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+        "point": SamplePoint(1, 2.5),
+        "date": datetime.date(2024, 1, 2),
+        "datetime": datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    }
+    failures = 0
+    for key, value in sample.items():
+        expected = json.loads(DefaultJSONProvider(app.app).dumps({key: value}))
+        try:
+            actual = json.loads(app.app.json.dumps({key: value}))
+        except TypeError as error:
+            actual = f"TypeError: {error}"
+        if actual != expected:
+            failures += 1
+            print(f"类型 {key} 的序列化结果不一致: {actual!r} != {expected!r}")
+    print(f"JSON provider 类型检查: {len(sample) - failures}/{len(sample)} 通过")
+    return failures == 0
+
+
+def timeit(func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=20000)
+    parser.add_argument("--body-rounds", type=int, default=50)
+    parser.add_argument("--image-bytes", type=int, default=3 * 1024 * 1024)
+    args = parser.parse_args()
+
+    if not check_provider_types():
+        sys.exit(1)
+
+    body = build_request_body(args.image_bytes)
+    encoder = stream_util.SSEChunkEncoder("grok-3")
+    cases = [
+        ("NDJSON行解析", args.rounds,
+         lambda: json.loads(NDJSON_LINE.decode("utf-8").strip()),
+         lambda: json_util.loads(NDJSON_LINE.strip())),
+        ("SSE帧序列化", args.rounds,
+         lambda: f"data: {json.dumps(SSE_ENVELOPE)}\n\n",
+         lambda: f"data: {json_util.dumps(SSE_ENVELOPE)}\n\n"),
+        ("SSE帧(预渲染编码器)", args.rounds,
+         lambda: f"data: {json.dumps(SSE_ENVELOPE)}\n\n",
+         lambda: encoder.content("你好，世界")),
+        (f"请求体解析({len(body) // 1024}KB)", args.body_rounds,
+         lambda: json.loads(body),
+         lambda: json_util.loads(body)),
+    ]
+
+    print(f"json_util 后端: {json_util.BACKEND}")
+    print(f"{'场景':<24}{'json(us)':>12}{'json_util(us)':>16}{'加速比':>10}")
+    for name, rounds, baseline, candidate in cases:
+        base_us = timeit(baseline, rounds)
+        cand_us = timeit(candidate, rounds)
+        print(f"{name:<24}{base_us:>12.2f}{cand_us:>16.2f}{base_us / cand_us:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
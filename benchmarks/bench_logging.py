@@ -0,0 +1,106 @@
+"""
+日志开销基准：模拟流式响应热循环，对比旧版 Logger（每次调用都取调用栈、
+即使 DEBUG 未开启也会序列化整行JSON）与 log_util.Logger 的每秒处理块数
+
+用法: python benchmarks/bench_logging.py [--chunks 50000] [--level INFO]
+"""
+import argparse
+import inspect
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from loguru import logger as loguru_logger  # noqa: E402
+
+import json_util  # noqa: E402
+import log_util  # noqa: E402
+import stream_util  # noqa: E402
+
+FORMAT = "{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {extra[filename]}:{extra[function]}:{extra[lineno]} | {message}"
+
+NDJSON_LINE = json.dumps({
+    "result": {
+        "response": {
+            "token": "你好",
+            "isThinking": False,
+            "isSoftStop": False,
+            "responseId": str(uuid.uuid4()),
+            "messageTag": "final"
+        }
+    }
+}).encode("utf-8")
+
+
+class LegacyLogger:
+    """改造前 app.py 中 Logger 的行为"""
+
+    def __init__(self, level, sink):
+        loguru_logger.remove()
+        loguru_logger.add(sink, level=level, format=FORMAT, colorize=False, backtrace=True, diagnose=True)
+        self.logger = loguru_logger
+
+    def _get_caller_info(self):
+        frame = inspect.currentframe()
+        try:
+            caller_frame = frame.f_back.f_back
+            return {
+                'filename': os.path.basename(caller_frame.f_code.co_filename),
+                'function': caller_frame.f_code.co_name,
+                'lineno': caller_frame.f_lineno
+            }
+        finally:
+            del frame
+
+    def debug(self, message, source="API"):
+        caller_info = self._get_caller_info()
+        self.logger.bind(**caller_info).debug(f"[{source}] {message}")
+
+
+def run_legacy(chunks, level, sink):
+    log = LegacyLogger(level, sink)
+    encoder = stream_util.SSEChunkEncoder("grok-3")
+    start = time.perf_counter()
+    for chunk_count in range(1, chunks + 1):
+        log.debug(f"处理第 {chunk_count} 个数据块", "Server")
+        line_json = json.loads(NDJSON_LINE.decode("utf-8"))
+        log.debug(f"解析JSON成功: {json.dumps(line_json)}", "Server")
+        encoder.content(line_json["result"]["response"]["token"])
+    return time.perf_counter() - start
+
+
+def run_current(chunks, level, sink):
+    log = log_util.Logger(level=level, colorize=False, format=FORMAT, sink=sink)
+    encoder = stream_util.SSEChunkEncoder("grok-3")
+    start = time.perf_counter()
+    for chunk_count in range(1, chunks + 1):
+        log.debug_sampled(chunk_count, lambda: f"处理第 {chunk_count} 个数据块", "Server")
+        line_json = json_util.loads(NDJSON_LINE)
+        log.debug_sampled(chunk_count, lambda: f"解析JSON成功: {NDJSON_LINE.decode('utf-8', 'replace')}", "Server")
+        encoder.content(line_json["result"]["response"]["token"])
+    log.complete()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--level", default="INFO")
+    args = parser.parse_args()
+
+    with open(os.devnull, "w", encoding="utf-8") as sink:
+        legacy = run_legacy(args.chunks, args.level, sink)
+        current = run_current(args.chunks, args.level, sink)
+    loguru_logger.remove()
+
+    print(f"级别: {args.level}, 数据块: {args.chunks}, JSON后端: {json_util.BACKEND}")
+    print(f"{'旧版 Logger':<16}{args.chunks / legacy:>14,.0f} 块/秒")
+    print(f"{'log_util.Logger':<16}{args.chunks / current:>14,.0f} 块/秒")
+    print(f"提升: {legacy / current:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
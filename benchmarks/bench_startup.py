@@ -0,0 +1,98 @@
+"""
+冷启动基准：在新的子进程中分别测量导入 app 模块和 bootstrap 初始化的耗时
+
+每轮使用全新的解释器和空的临时数据目录，模拟容器重启。
+--top 额外用 python -X importtime 列出累计耗时最多的导入模块。
+
+用法:
+  python benchmarks/bench_startup.py --repeat 10
+  python benchmarks/bench_startup.py --tokens 1000 --top 15
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CHILD_SCRIPT = """
+import json, sys, time
+started_at = time.perf_counter()
+sys.path.insert(0, {root!r})
+import app
+imported_at = time.perf_counter()
+app.bootstrap()
+print(json.dumps({{"import": imported_at - started_at, "bootstrap": time.perf_counter() - imported_at,
+                   "modules": len(sys.modules)}}))
+"""
+
+
+def child_env(args):
+    env = dict(os.environ)
+    env.setdefault("LOG_LEVEL", "WARNING")
+    env["SSO_SUPER"] = ",".join(f"bench{index}" for index in range(args.tokens))
+    env.pop("SSO", None)
+    return env
+
+
+def run_once(args):
+    with tempfile.TemporaryDirectory(prefix="grok2api-startup-") as work_dir:
+        output = subprocess.run(
+            [sys.executable, "-c", CHILD_SCRIPT.format(root=os.path.abspath(ROOT_DIR))],
+            cwd=work_dir, env=child_env(args), capture_output=True, text=True, check=True
+        ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def import_time_top(args):
+    """解析 -X importtime 的输出，返回累计耗时最多的顶层导入"""
+    with tempfile.TemporaryDirectory(prefix="grok2api-startup-") as work_dir:
+        stderr = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {os.path.abspath(ROOT_DIR)!r}); import app"],
+            cwd=work_dir, env=child_env(args), capture_output=True, text=True, check=True
+        ).stderr
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # 名称前的缩进表示嵌套层级，只看 app 直接导入的模块
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth <= 1:
+            entries.append((int(cumulative), name.strip()))
+    return sorted(entries, reverse=True)[:args.top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="冷启动基准")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tokens", type=int, default=10, help="通过 SSO_SUPER 加载的令牌数")
+    parser.add_argument("--top", type=int, default=0, help="列出累计耗时最多的N个导入")
+    parser.add_argument("--output", help="把结果写入JSON文件")
+    args = parser.parse_args()
+
+    runs = [run_once(args) for _ in range(args.repeat)]
+    summary = {
+        "import_ms": round(statistics.median(run["import"] for run in runs) * 1000, 1),
+        "bootstrap_ms": round(statistics.median(run["bootstrap"] for run in runs) * 1000, 1),
+        "modules": runs[-1]["modules"],
+        "runs": [{key: round(value * 1000, 1) if key != "modules" else value for key, value in run.items()} for run in runs]
+    }
+    print(f"导入 app: {summary['import_ms']} ms，bootstrap（{args.tokens} 个令牌）: {summary['bootstrap_ms']} ms，"
+          f"已加载模块: {summary['modules']}（{args.repeat} 轮中位数）")
+
+    if args.top:
+        summary["top_imports"] = [{"module": name, "cumulative_ms": round(us / 1000, 1)} for us, name in import_time_top(args)]
+        for item in summary["top_imports"]:
+            print(f"  {item['module']:<40}{item['cumulative_ms']:>10.1f} ms")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+令牌健康探测的端到端检查：对进程内启动的 mock_grok 探测一批令牌，核对状态变化、并发上限和限速
+
+mock_grok 的额度查询接口对 sso 以 dead 开头的令牌返回401。检查内容:
+  0. 无法判断的探测结果（如风控403）不会把从未探测过的令牌标为 ok，仍为 unchecked
+  1. 第一轮后失效令牌为 suspect，并被移到轮换队列末尾
+  2. 连续 --fail-threshold 轮后失效令牌为 invalid，已移出所有模型的轮换，其余令牌为 ok
+  3. 上游恢复接受这些令牌后，下一轮探测把它们放回轮换
+  4. 同时进行的探测数不超过 --concurrency，每轮耗时不低于 --rate 限速所需的时间
+  5. 探测期间其他线程持续租用、移除令牌，不出现异常
+任一项不符合时以非零状态退出。
+
+用法:
+  python benchmarks/check_token_probe.py
+  python benchmarks/check_token_probe.py --tokens 500 --dead 50 --concurrency 16 --rate 0 --latency-ms 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.chdir(tempfile.mkdtemp(prefix="grok2api-probe-"))
+
+import app  # noqa: E402
+import mock_grok  # noqa: E402
+import probe_util  # noqa: E402
+
+
+class InFlightCounter:
+    """统计同时进行的探测数的峰值"""
+
+    def __init__(self, probe):
+        self._probe = probe
+        self._lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+
+    def __call__(self, sso):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            return self._probe(sso)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def start_mock_upstream(args):
+    options = argparse.Namespace(tokens=0, token_rate=0, latency_ms=args.latency_ms, rate_429=0.0, rate_403=0.0,
+                                 replay=None, dead_prefix="dead")
+    server = mock_grok.MockGrokServer(("127.0.0.1", 0), options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app.CONFIG["API"]["BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+    app.CONFIG["API"]["PROXY"] = None
+    app.CONFIG["SERVER"]["CF_CLEARANCE"] = None
+    return server
+
+
+def create_manager(args):
+    manager = app.AuthTokenManager()
+    manager.token_reset_switch = True
+    alive = [f"alive{index}" for index in range(args.tokens - args.dead)]
+    dead = [f"dead{index}" for index in range(args.dead)]
+    # 失效令牌排在前面，验证 suspect 会让出轮换位置
+    manager.add_tokens(dead + alive, "super", True)
+    return manager, set(alive), set(dead)
+
+
+def in_rotation(manager, sso):
+    token = f"sso-rw={sso};sso={sso}"
+    return any(entry["token"] == token for model_tokens in manager.token_model_map.values() for entry in model_tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="令牌健康探测检查")
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--dead", type=int, default=20, help="其中失效的令牌数")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=200, help="每秒最多探测次数，0为不限速")
+    parser.add_argument("--latency-ms", type=float, default=10, help="模拟上游的响应延迟")
+    parser.add_argument("--fail-threshold", type=int, default=2)
+    args = parser.parse_args()
+
+    server = start_mock_upstream(args)
+    manager, alive, dead = create_manager(args)
+    app.token_manager = manager
+    counter = InFlightCounter(app.probe_token)
+    prober = probe_util.TokenProber(
+        list_targets=manager.get_probe_targets,
+        probe=counter,
+        on_result=lambda sso, outcome: manager.record_probe_result(sso, outcome, args.fail_threshold),
+        concurrency=args.concurrency,
+        rate=args.rate
+    )
+    failures = []
+
+    def check(condition, message):
+        if not condition:
+            failures.append(message)
+            print(f"失败: {message}")
+
+    def run_round(label):
+        summary = prober.run_round()
+        print(f"{label}: {summary['targets']}个令牌，耗时 {summary['durationMs']} ms，"
+              f"结果 {summary['counts']}，健康状态 {manager.get_token_health_counts()}")
+        if args.rate:
+            minimum_ms = (summary["targets"] - 1) / args.rate * 1000
+            check(summary["durationMs"] >= minimum_ms * 0.9, f"{label} 耗时低于限速下限 {minimum_ms:.0f} ms")
+        return summary
+
+    inconclusive = probe_util.TokenProber(
+        list_targets=manager.get_probe_targets,
+        probe=lambda sso: {"result": probe_util.PROBE_ERROR, "httpStatus": 403},
+        on_result=lambda sso, outcome: manager.record_probe_result(sso, outcome, args.fail_threshold),
+        concurrency=args.concurrency,
+        rate=0
+    )
+    inconclusive.run_round()
+    check(manager.get_token_health_counts() == {"ok": 0, "suspect": 0, "invalid": 0, "unchecked": args.tokens},
+          f"无法判断的结果不应改变 unchecked 状态: {manager.get_token_health_counts()}")
+    check(manager.query_token_status(health="unchecked", page_size=args.tokens)["total"] == args.tokens,
+          "按 health=unchecked 查询的数量不符")
+
+    stop_churn = threading.Event()
+    churn_errors = []
+
+    def churn():
+        # 模拟请求线程：租用令牌，偶尔把令牌移出再由重置放回，与探测线程并发修改轮换队列
+        while not stop_churn.is_set():
+            try:
+                token = manager.get_next_token_for_model("grok-3")
+                if token and "sso=alive" in token:
+                    manager.reduce_token_request_count("grok-3", 1, token)
+            except Exception as error:
+                churn_errors.append(f"{type(error).__name__}: {error}")
+                return
+
+    churn_threads = [threading.Thread(target=churn, daemon=True) for _ in range(4)]
+    for thread in churn_threads:
+        thread.start()
+
+    run_round("第1轮")
+    if args.dead and args.fail_threshold > 1:
+        check(all(manager.token_health[sso]["status"] == "suspect" for sso in dead), "第1轮后失效令牌应为 suspect")
+        head = manager.get_next_token_for_model("grok-3", True)
+        check(head and "sso=alive" in head, f"suspect 令牌应排在轮换末尾，当前队首: {head}")
+
+    for round_index in range(2, args.fail_threshold + 1):
+        run_round(f"第{round_index}轮")
+    check(all(manager.token_health[sso]["status"] == "invalid" for sso in dead), "失效令牌应为 invalid")
+    check(not any(in_rotation(manager, sso) for sso in dead), "invalid 令牌应已移出轮换")
+    check(all(manager.token_health[sso]["status"] == "ok" and in_rotation(manager, sso) for sso in alive),
+          "有效令牌应为 ok 且在轮换中")
+    check(manager.query_token_status(health="invalid", page_size=args.tokens)["total"] == len(dead),
+          "按 health=invalid 查询的数量不符")
+
+    server.options.dead_prefix = "revived-never-matches"
+    run_round("恢复后")
+    check(all(manager.token_health[sso]["status"] == "ok" and in_rotation(manager, sso) for sso in dead),
+          "恢复的令牌应重新进入轮换")
+    check(not manager.quarantined_tokens, "恢复后不应再有隔离的令牌")
+
+    stop_churn.set()
+    for thread in churn_threads:
+        thread.join()
+    check(not churn_errors, f"并发租用令牌时出现异常: {churn_errors[:3]}")
+
+    check(counter.peak <= args.concurrency, f"同时探测数峰值 {counter.peak} 超过并发上限 {args.concurrency}")
+    print(f"同时探测数峰值: {counter.peak}（上限 {args.concurrency}）")
+    server.shutdown()
+
+    print(f"共 {len(failures)} 项不符合")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
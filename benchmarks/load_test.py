@@ -0,0 +1,174 @@
+"""
+端到端压测：并发调用 /v1/chat/completions，统计吞吐、首字节时间与延迟分位数
+
+流式请求的首字节时间按第一个内容帧计算，非流式按响应头到达计算。
+通常配合 mock_grok.py 使用，例如:
+
+  python benchmarks/mock_grok.py --port 9100 &
+  GROK_BASE_URL=http://127.0.0.1:9100 GROK_ASSETS_URL=http://127.0.0.1:9100/assets \\
+  SSO_SUPER=$(python -c "print(','.join(f'mock{i}' for i in range(200)))") python app.py &
+  python benchmarks/load_test.py --url http://127.0.0.1:5200 --concurrency 16 --requests 500
+
+用法: python benchmarks/load_test.py [--url URL] [--api-key KEY] [--concurrency 16]
+      [--requests 500 | --duration 30] [--stream-ratio 0.5] [--model grok-3 ...] [--output result.json]
+"""
+import argparse
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+CONTENT_MARKER = b'"delta":{"content":'
+
+
+def percentile(values, q):
+    """最近秩法求分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class LoadTester:
+    def __init__(self, args):
+        self.args = args
+        self.models = itertools.cycle(args.model)
+        self.models_lock = threading.Lock()
+        self.local = threading.local()
+        self.results = []
+        self.results_lock = threading.Lock()
+        self.prompt = ("压测消息 " * (args.prompt_chars // 5 + 1))[:args.prompt_chars]
+
+    def _session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def _next_model(self):
+        with self.models_lock:
+            return next(self.models)
+
+    def run_one(self):
+        stream = random.random() < self.args.stream_ratio
+        model = self._next_model()
+        body = {
+            "model": model,
+            "stream": stream,
+            "messages": [{"role": "user", "content": self.prompt}]
+        }
+        result = {"model": model, "stream": stream, "status": None, "ttfb": None, "latency": None, "bytes": 0}
+        started_at = time.perf_counter()
+        try:
+            with self._session().post(
+                f"{self.args.url}/v1/chat/completions",
+                json=body,
+                headers={"Authorization": f"Bearer {self.args.api_key}"},
+                stream=True,
+                timeout=self.args.timeout
+            ) as response:
+                result["status"] = response.status_code
+                if not stream or response.status_code != 200:
+                    result["ttfb"] = time.perf_counter() - started_at
+                    result["bytes"] = len(response.content)
+                else:
+                    for line in response.iter_lines():
+                        result["bytes"] += len(line)
+                        if result["ttfb"] is None and CONTENT_MARKER in line:
+                            result["ttfb"] = time.perf_counter() - started_at
+        except requests.RequestException as error:
+            result["status"] = type(error).__name__
+        result["latency"] = time.perf_counter() - started_at
+        with self.results_lock:
+            self.results.append(result)
+
+    def run(self):
+        started_at = time.perf_counter()
+        deadline = started_at + self.args.duration if self.args.duration else None
+        issued = itertools.count()
+
+        def worker():
+            while True:
+                if deadline is not None:
+                    if time.perf_counter() >= deadline:
+                        return
+                elif next(issued) >= self.args.requests:
+                    return
+                self.run_one()
+
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            for _ in range(self.args.concurrency):
+                executor.submit(worker)
+        return time.perf_counter() - started_at
+
+
+def summarize(results, elapsed):
+    def latency_summary(items):
+        ttfb = [item["ttfb"] * 1000 for item in items if item["ttfb"] is not None]
+        latency = [item["latency"] * 1000 for item in items]
+        return {
+            "count": len(items),
+            "ttfb_ms": {f"p{q}": percentile(ttfb, q) for q in (50, 90, 99)},
+            "latency_ms": {f"p{q}": percentile(latency, q) for q in (50, 90, 99)}
+        }
+
+    statuses = {}
+    for item in results:
+        statuses[str(item["status"])] = statuses.get(str(item["status"]), 0) + 1
+    ok = [item for item in results if item["status"] == 200]
+    return {
+        "requests": len(results),
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(len(results) / elapsed, 2) if elapsed else None,
+        "ok_per_second": round(len(ok) / elapsed, 2) if elapsed else None,
+        "statuses": statuses,
+        "stream": latency_summary([item for item in ok if item["stream"]]),
+        "non_stream": latency_summary([item for item in ok if not item["stream"]])
+    }
+
+
+def print_summary(summary):
+    print(f"请求数: {summary['requests']}，耗时: {summary['elapsed_seconds']}s，"
+          f"吞吐: {summary['requests_per_second']} req/s（成功 {summary['ok_per_second']} req/s）")
+    print(f"状态码: {summary['statuses']}")
+    for name in ("stream", "non_stream"):
+        part = summary[name]
+        if not part["count"]:
+            continue
+        ttfb = " / ".join(f"{value:.1f}" if value is not None else "-" for value in part["ttfb_ms"].values())
+        latency = " / ".join(f"{value:.1f}" if value is not None else "-" for value in part["latency_ms"].values())
+        print(f"{name:<11} 成功 {part['count']:>6}  首字节 p50/p90/p99: {ttfb} ms  延迟 p50/p90/p99: {latency} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="并发压测 /v1/chat/completions")
+    parser.add_argument("--url", default="http://127.0.0.1:5200")
+    parser.add_argument("--api-key", default="sk-123456")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500, help="总请求数，指定 --duration 时忽略")
+    parser.add_argument("--duration", type=float, default=0, help="按时长压测（秒）")
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="流式请求的比例")
+    parser.add_argument("--model", action="append", help="可重复指定，轮流使用；默认 grok-3")
+    parser.add_argument("--prompt-chars", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", help="把结果写入JSON文件，便于对比不同版本")
+    args = parser.parse_args()
+    args.model = args.model or ["grok-3"]
+
+    tester = LoadTester(args)
+    elapsed = tester.run()
+    summary = summarize(tester.results, elapsed)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "summary": summary}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
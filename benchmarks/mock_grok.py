@@ -0,0 +1,259 @@
+"""
+本地模拟的 Grok 上游，配合 load_test.py 做端到端压测
+
+模拟的接口:
+  POST /rest/app-chat/conversations/new  按请求体生成（或回放录制的）NDJSON 流
+  POST /rest/app-chat/upload-file        文本文件上传
+  POST /api/rpc                          图片上传
+  POST /rest/rate-limits                 额度查询（令牌健康探测），sso 以 --dead-prefix 开头的令牌返回401
+  GET  /assets/<path>                    生成图片下载
+
+用法:
+  python benchmarks/mock_grok.py --port 9100 --tokens 200 --token-rate 400 --latency-ms 50
+  python benchmarks/mock_grok.py --replay data/recordings      # 回放录制的 NDJSON 文件
+
+服务端以如下环境变量启动即可把上游指向模拟服务（模拟服务不校验Cookie，SSO可以随意填写）:
+  GROK_BASE_URL=http://127.0.0.1:9100 GROK_ASSETS_URL=http://127.0.0.1:9100/assets
+"""
+import argparse
+import itertools
+import json
+import random
+import struct
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+WORDS = ("the", "quick", "brown", "fox", "jumps", "over", "lazy", "dog", "你好", "世界", "，", "。")
+
+
+def make_png(width=512, height=512):
+    """不依赖 Pillow 生成一张渐变 PNG"""
+    rows = []
+    for y in range(height):
+        row = bytearray(b"\x00")
+        for x in range(width):
+            row += bytes((x * 255 // width, y * 255 // height, 128))
+        rows.append(bytes(row))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(b"".join(rows), 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def response_line(**response):
+    return {"result": {"response": response}}
+
+
+def search_results(count=2):
+    return {"results": [{"title": f"mock result {index}", "url": f"https://example.com/{index}",
+                         "preview": f"preview {index}"} for index in range(count)]}
+
+
+def build_stream(payload, token_count):
+    """
+    按请求体的模型特征生成上游NDJSON行：推理模型先输出思考，深度搜索带步骤（含搜索动作与结果），
+    开启联网搜索时先返回搜索结果，生图模型返回图片
+    """
+    response_id = str(uuid.uuid4())
+    words = itertools.cycle(WORDS)
+    lines = [response_line(userResponse={"message": payload.get("message", "")[:64]})]
+
+    if payload.get("toolOverrides", {}).get("imageGen"):
+        image_url = f"users/mock/generated/{uuid.uuid4()}/image.png"
+        lines.append(response_line(doImgGen=True, responseId=response_id))
+        lines.append(response_line(
+            cachedImageGenerationResponse={"imageUrl": image_url, "imageId": str(uuid.uuid4())},
+            responseId=response_id))
+        return lines
+
+    thinking_tokens = token_count // 4
+    if payload.get("isReasoning"):
+        for _ in range(thinking_tokens):
+            lines.append(response_line(token=next(words) + " ", isThinking=True, messageTag="assistant", responseId=response_id))
+    elif payload.get("deepsearchPreset"):
+        for step in range(thinking_tokens):
+            lines.append(response_line(token=next(words) + " ", messageStepId=step // 16 + 1, messageTag="assistant", responseId=response_id))
+            if step % 16 == 1:
+                lines.append(response_line(token={"action": "webSearch", "action_input": {"query": "mock query"}},
+                                           messageStepId=step // 16 + 1, messageTag="tool_usage_card", responseId=response_id))
+                lines.append(response_line(token="", webSearchResults=search_results(), messageStepId=step // 16 + 1,
+                                           messageTag="raw_function_result", responseId=response_id))
+    elif payload.get("toolOverrides", {}).get("webSearch"):
+        lines.append(response_line(token="", webSearchResults=search_results(), messageTag="raw_function_result",
+                                   responseId=response_id))
+
+    for _ in range(token_count):
+        lines.append(response_line(token=next(words) + " ", isThinking=False, messageTag="final", responseId=response_id))
+    lines.append(response_line(finalMetadata={"followUpSuggestions": []}, responseId=response_id))
+    return lines
+
+
+class MockGrokServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, MockGrokHandler)
+        self.options = options
+        self.image = make_png()
+        self.replays = self._load_replays(options.replay)
+        self._replay_index = itertools.count()
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+
+    @staticmethod
+    def _load_replays(path):
+        if not path:
+            return []
+        path = Path(path)
+        files = sorted(path.glob("*.ndjson")) if path.is_dir() else [path]
+        replays = []
+        for file in files:
+            lines = [line for line in file.read_bytes().splitlines() if line.strip()]
+            if lines:
+                replays.append(lines)
+        if not replays:
+            raise SystemExit(f"没有可回放的 NDJSON: {path}")
+        return replays
+
+    def next_replay(self):
+        return self.replays[next(self._replay_index) % len(self.replays)]
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+
+class MockGrokHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(f"{self.path.split('?')[0]} {status}")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+    def do_POST(self):
+        body = self._read_body()
+        path = self.path.split("?")[0]
+        if path == "/rest/app-chat/conversations/new":
+            self._handle_conversation(body)
+        elif path == "/rest/rate-limits":
+            self._handle_rate_limits()
+        elif path in ("/rest/app-chat/upload-file", "/api/rpc"):
+            self._send_json(200, {"fileMetadataId": str(uuid.uuid4()), "fileUri": f"users/mock/{uuid.uuid4()}/content"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_GET(self):
+        if self.path.startswith("/assets/"):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(self.server.image)))
+            self.end_headers()
+            self.wfile.write(self.server.image)
+            self.server.count("/assets 200")
+        elif self.path == "/stats":
+            self._send_json(200, self.server.stats)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def _handle_rate_limits(self):
+        options = self.server.options
+        if options.latency_ms:
+            time.sleep(options.latency_ms / 1000)
+        cookies = dict(part.strip().split("=", 1) for part in self.headers.get("Cookie", "").split(";") if "=" in part)
+        if cookies.get("sso", "").startswith(getattr(options, "dead_prefix", "dead")):
+            self._send_json(401, {"error": {"code": 16, "message": "Not authenticated"}})
+            return
+        self._send_json(200, {"windowSizeSeconds": 7200, "remainingQueries": 100, "totalQueries": 100})
+
+    def _handle_conversation(self, body):
+        options = self.server.options
+        if options.latency_ms:
+            time.sleep(options.latency_ms / 1000)
+
+        roll = random.random()
+        if roll < options.rate_403:
+            self._send_json(403, {"error": {"code": 7, "message": "Request rejected by anti-bot rules."}})
+            return
+        if roll < options.rate_403 + options.rate_429:
+            self._send_json(429, {"error": {"code": 8, "message": "Too many requests"}})
+            return
+
+        if self.server.replays:
+            lines = self.server.next_replay()
+        else:
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                payload = {}
+            lines = [json.dumps(line, ensure_ascii=False).encode("utf-8") for line in build_stream(payload, options.tokens)]
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        interval = 1 / options.token_rate if options.token_rate else 0
+        try:
+            for line in lines:
+                self._write_chunk(line + b"\n")
+                if interval:
+                    time.sleep(interval)
+            self.wfile.write(b"0\r\n\r\n")
+            self.server.count("/rest/app-chat/conversations/new 200")
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.count("/rest/app-chat/conversations/new aborted")
+            self.close_connection = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的 Grok 上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--tokens", type=int, default=200, help="每次回答的token数（不含思考）")
+    parser.add_argument("--token-rate", type=float, default=400, help="每秒输出的行数，0为不限速")
+    parser.add_argument("--latency-ms", type=float, default=50, help="返回响应头前的延迟")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="返回429的比例")
+    parser.add_argument("--rate-403", type=float, default=0.0, help="返回403的比例")
+    parser.add_argument("--replay", help="回放的 NDJSON 文件或目录（目录下的 *.ndjson 轮流使用）")
+    parser.add_argument("--dead-prefix", default="dead", help="额度查询返回401的sso前缀，模拟已失效的令牌")
+    options = parser.parse_args()
+
+    server = MockGrokServer((options.host, options.port), options)
+    print(f"模拟上游已启动: http://{options.host}:{options.port}"
+          f"（{'回放 ' + str(len(server.replays)) + ' 个录制' if server.replays else '合成数据'}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
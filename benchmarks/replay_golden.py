@@ -0,0 +1,186 @@
+"""
+录制语料的黄金回放测试：把录制的上游NDJSON重新喂给流式与非流式处理，逐字节对比输出
+
+语料目录下每个录制包含 <名称>.ndjson（上游原始行）与 <名称>.json（模型和输出配置），
+由设置了 RECORD_UPSTREAM_DIR 的服务端录制，或用 synthesize 按模型特征合成。
+record 生成 <名称>.golden.sse 与 <名称>.golden.txt，check 与之对比，有差异时以非零状态退出。
+
+仓库中的 benchmarks/golden 是默认语料，覆盖 stream_util.TRANSFORMERS 的每个分支和生图，
+修改流式处理后运行一次 check 即可确认输出没有变化：
+  python benchmarks/replay_golden.py check
+
+为保证输出可复现，completion id 和 created 固定，SSE注释帧（保活、耗时）不参与对比；
+生图录制的图片从进程内启动的 mock_grok 下载，写入临时目录下的本地图片缓存。
+有意改变输出时用 record 重新生成黄金输出，并在提交中说明差异。
+
+用法:
+  python benchmarks/replay_golden.py check
+  python benchmarks/replay_golden.py record --corpus data/recordings
+  python benchmarks/replay_golden.py synthesize --corpus benchmarks/golden --tokens 40
+"""
+import argparse
+import difflib
+import json
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+ORIGINAL_CWD = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="grok2api-golden-"))
+
+import app  # noqa: E402
+import mock_grok  # noqa: E402
+import stream_util  # noqa: E402
+
+COMPLETION_ID = "chatcmpl-golden"
+CREATED = 0
+PUBLIC_BASE_URL = "http://golden.local"
+
+DEFAULT_CORPUS = os.path.join(BENCH_DIR, "golden")
+
+# 名称 -> (mock_grok 请求体特征, 录制配置)；每个 TRANSFORMERS 分支至少一个，思考/搜索结果的显示开关各有隐藏的变体
+SYNTHETIC_CASES = {
+    "grok-3": ({}, {}),
+    "grok-3-search": ({"toolOverrides": {"webSearch": True}}, {"show_search_results": True}),
+    "grok-3-search-hidden": ({"toolOverrides": {"webSearch": True}},
+                             {"model": "grok-3-search", "show_search_results": False}),
+    "grok-3-reasoning": ({"isReasoning": True}, {"show_thinking": True}),
+    "grok-3-reasoning-hidden": ({"isReasoning": True}, {"model": "grok-3-reasoning", "show_thinking": False}),
+    "grok-3-deepsearch": ({"deepsearchPreset": "default"}, {"show_thinking": True}),
+    "grok-3-deepsearch-hidden": ({"deepsearchPreset": "default"}, {"model": "grok-3-deepsearch", "show_thinking": False}),
+    "grok-3-deepersearch": ({"deepsearchPreset": "deeper"}, {"show_thinking": True}),
+    "grok-4": ({"isReasoning": True}, {}),
+    "grok-4-reasoning": ({"isReasoning": True}, {"show_thinking": True}),
+    "grok-4-reasoning-hidden": ({"isReasoning": True}, {"model": "grok-4-reasoning", "show_thinking": False}),
+    "grok-4-deepsearch": ({"deepsearchPreset": "default", "toolOverrides": {"webSearch": True}}, {"show_thinking": True}),
+    "grok-3-imageGen": ({"toolOverrides": {"imageGen": True}}, {})
+}
+
+
+class ReplayResponse:
+    """按录制内容逐行返回的上游响应"""
+
+    status_code = 200
+
+    def __init__(self, lines):
+        self._lines = lines
+
+    def iter_lines(self):
+        return iter(self._lines)
+
+    def close(self):
+        pass
+
+
+def load_corpus(corpus):
+    cases = []
+    for data_path in sorted(Path(corpus).glob("*.ndjson")):
+        meta_path = data_path.with_suffix(".json")
+        meta = json.loads(meta_path.read_text(encoding="utf-8")) if meta_path.exists() else {}
+        lines = [line for line in data_path.read_bytes().splitlines() if line.strip()]
+        cases.append((data_path.with_suffix(""), meta, lines))
+    if not cases:
+        raise SystemExit(f"语料目录中没有录制: {corpus}")
+    return cases
+
+
+def render(meta, lines):
+    """返回 (SSE输出, 非流式输出)，SSE输出去掉注释帧"""
+    model = meta.get("model", "grok-3")
+    app.CONFIG["SHOW_THINKING"] = meta.get("show_thinking", False)
+    app.CONFIG["ISSHOW_SEARCH_RESULTS"] = meta.get("show_search_results", True)
+
+    encoder = stream_util.SSEChunkEncoder(model, completion_id=COMPLETION_ID, created=CREATED)
+    frames = app.handle_stream_response(ReplayResponse(lines), model, sse_encoder=encoder)
+    sse = b"".join(frame for frame in frames if not frame.startswith(b":"))
+    text = app.handle_non_stream_response(ReplayResponse(lines), model)
+    return sse, text.encode("utf-8")
+
+
+def start_assets_server():
+    options = argparse.Namespace(tokens=0, token_rate=0, latency_ms=0, rate_429=0.0, rate_403=0.0, replay=None)
+    server = mock_grok.MockGrokServer(("127.0.0.1", 0), options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app.CONFIG["API"]["ASSETS_URL"] = f"http://127.0.0.1:{server.server_address[1]}/assets"
+    app.CONFIG["API"]["PICGO_KEY"] = None
+    app.CONFIG["API"]["TUMY_KEY"] = None
+    app.CONFIG["IMAGE"]["PUBLIC_BASE_URL"] = PUBLIC_BASE_URL
+    return server
+
+
+def first_difference(expected, actual, name):
+    diff = difflib.unified_diff(
+        expected.decode("utf-8", "replace").splitlines(),
+        actual.decode("utf-8", "replace").splitlines(),
+        f"{name} (golden)", f"{name} (actual)", n=1, lineterm="")
+    return "\n".join(list(diff)[:20])
+
+
+def synthesize(args):
+    corpus = Path(args.corpus)
+    corpus.mkdir(parents=True, exist_ok=True)
+    for name, (payload, meta) in SYNTHETIC_CASES.items():
+        lines = mock_grok.build_stream({"message": "golden", **payload}, args.tokens)
+        data = b"".join(json.dumps(stream_util.redact(line), ensure_ascii=False).encode("utf-8") + b"\n" for line in lines)
+        (corpus / f"synthetic-{name}.ndjson").write_bytes(data)
+        meta = {"model": meta.get("model", name), "stream": True, "synthetic": True, **meta}
+        (corpus / f"synthetic-{name}.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"已合成 {len(SYNTHETIC_CASES)} 个录制: {corpus}")
+
+
+def record(args):
+    for base, meta, lines in load_corpus(args.corpus):
+        sse, text = render(meta, lines)
+        base.with_suffix(".golden.sse").write_bytes(sse)
+        base.with_suffix(".golden.txt").write_bytes(text)
+        print(f"已生成 {base.name}: SSE {len(sse)} 字节，非流式 {len(text)} 字节")
+
+
+def check(args):
+    failures = 0
+    cases = load_corpus(args.corpus)
+    for base, meta, lines in cases:
+        sse, text = render(meta, lines)
+        for suffix, actual in ((".golden.sse", sse), (".golden.txt", text)):
+            golden_path = base.with_suffix(suffix)
+            if not golden_path.exists():
+                print(f"缺少黄金输出: {golden_path.name}，请先运行 record")
+                failures += 1
+                continue
+            expected = golden_path.read_bytes()
+            if expected != actual:
+                failures += 1
+                print(f"不一致: {golden_path.name}\n{first_difference(expected, actual, golden_path.name)}")
+    print(f"共 {len(cases)} 个录制，{failures} 项不一致")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="录制语料的黄金回放测试")
+    parser.add_argument("command", choices=("synthesize", "record", "check"))
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="录制目录，默认为仓库中的 benchmarks/golden")
+    parser.add_argument("--tokens", type=int, default=200, help="synthesize 时每个回答的token数")
+    args = parser.parse_args()
+    args.corpus = os.path.join(ORIGINAL_CWD, args.corpus)
+
+    if args.command == "synthesize":
+        synthesize(args)
+        return
+    server = start_assets_server()
+    try:
+        if args.command == "record":
+            record(args)
+        elif check(args):
+            sys.exit(1)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,101 +1,303 @@
+import copy
+import heapq
+import itertools
 import json
 import os
+import threading
+import time
+
+import lifecycle_util
+
+CONFIG_FILE = "data/cf_config.json"
+COOKIES_FILE = "data/cf_cookies.json"  # 保留用于兼容性，实际数据会同时存储在CONFIG_FILE中
+
+# 默认配置
+DEFAULT_CONFIG = {
+    "url": "https://grok.com",
+    "need_update": {
+        "proxy_url_pool": [],
+        "user_agent_list": [],
+        "user_agent": None
+    },
+    "exist_data_list": []
+}
+
+# 修改后等待该秒数再写盘，期间的多次修改合并为一次写入
+FLUSH_DELAY_SECONDS = 1.0
+
+
+def is_valid_cookie_data(data):
+    """
+    检查一条Cookie数据能否安全地加入索引
+
+    需要 user_agent（字符串或None）、cookies（字典列表，cf_clearance 的值为字符串）和数字类型的 expire_time，
+    proxy_url 可省略，给出时为字符串或None
+    """
+    if not isinstance(data, dict) or "user_agent" not in data or "cookies" not in data or "expire_time" not in data:
+        return False
+    expire_time = data["expire_time"]
+    if isinstance(expire_time, bool) or not isinstance(expire_time, (int, float)):
+        return False
+    if not all(data.get(field) is None or isinstance(data.get(field), str) for field in ("user_agent", "proxy_url")):
+        return False
+    cookies = data["cookies"]
+    if not isinstance(cookies, list) or not all(isinstance(cookie, dict) for cookie in cookies):
+        return False
+    clearance = get_cf_clearance(data)
+    return clearance is None or isinstance(clearance, str)
+
+
+def get_cookie_key(data):
+    """Cookie数据按 (proxy_url, user_agent) 唯一，不使用代理时 proxy_url 为 None"""
+    return data.get("proxy_url"), data.get("user_agent")
+
+
+def get_cf_clearance(data):
+    for cookie in data.get("cookies", []):
+        if cookie.get("name") == "cf_clearance":
+            return cookie.get("value")
+    return None
+
+
+class CfCookieStore:
+    """
+    cf_config.json 的内存索引
+
+    exist_data_list 按 (proxy_url, user_agent) 建索引，另维护 cf_clearance 值到键的索引，
+    以及按过期时间排序的小顶堆：到期的Cookie出堆时从未过期集合中移除，判断某个组合是否需要更新不用逐条比较时间。
+    修改先在内存中生效，FLUSH_DELAY_SECONDS 内的多次修改合并为一次原子写入（cf_cookies.json 同步写入用于兼容）。
+    配置文件被其他进程（如 gunicorn 的其他 worker）改写后，下次访问时重新加载。
+    """
+
+    def __init__(self, config_file=CONFIG_FILE, cookies_file=COOKIES_FILE, flush_delay=FLUSH_DELAY_SECONDS):
+        self.config_file = config_file
+        self.cookies_file = cookies_file
+        self.flush_delay = flush_delay
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._loaded = False
+        self._file_stat = None
+        self._dirty = False
+        self._flush_timer = None
+        self._settings = None
+        self._entries = {}
+        self._keys_by_clearance = {}
+        self._fresh = set()
+        self._expiry_heap = []
+        self._sequence = itertools.count()
+        self._entries_list = None
+        self._clearance_values = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.config_file)
+            return stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            return None
+
+    def _ensure_loaded(self):
+        if self._loaded and (self._dirty or self._stat() == self._file_stat):
+            return
+        self._load()
+
+    def _load(self):
+        self._file_stat = self._stat()
+        config = copy.deepcopy(DEFAULT_CONFIG)
+        if self._file_stat is None:
+            print(f"配置文件 {self.config_file} 不存在")
+        else:
+            try:
+                with open(self.config_file, "r") as f:
+                    config = json.load(f)
+            except Exception as e:
+                print(f"加载配置文件失败: {str(e)}")
+
+        self._settings = {key: value for key, value in config.items() if key != "exist_data_list"}
+        self._settings.setdefault("url", DEFAULT_CONFIG["url"])
+        self._settings["need_update"] = {**DEFAULT_CONFIG["need_update"], **(self._settings.get("need_update") or {})}
+        self._entries = {}
+        self._keys_by_clearance = {}
+        self._fresh = set()
+        self._expiry_heap = []
+        self._entries_list = None
+        self._clearance_values = None
+        invalid_count = 0
+        now = int(time.time())
+        exist_data_list = config.get("exist_data_list")
+        if not isinstance(exist_data_list, list):
+            exist_data_list = []
+        for data in exist_data_list:
+            if is_valid_cookie_data(data):
+                self._put(data, now)
+            else:
+                invalid_count += 1
+        self._loaded = True
+        if invalid_count:
+            print(f"发现{invalid_count}条无效的cookie格式，已忽略")
+            self._mark_dirty()
+
+    def _put(self, data, now):
+        """data 需已通过 is_valid_cookie_data 校验，否则可能在修改索引的中途失败"""
+        key = get_cookie_key(data)
+        clearance = get_cf_clearance(data)
+        expire_time = data["expire_time"]
+        previous = self._entries.get(key)
+        if previous is not None:
+            self._unindex_clearance(key, previous)
+        self._entries[key] = data
+        if clearance is not None:
+            self._keys_by_clearance.setdefault(clearance, set()).add(key)
+
+        if now < expire_time:
+            self._fresh.add(key)
+            heapq.heappush(self._expiry_heap, (expire_time, next(self._sequence), key))
+            # 同一组合反复更新会在堆中留下旧记录，过多时重建
+            if len(self._expiry_heap) > 2 * len(self._entries) + 64:
+                self._expiry_heap = [(entry.get("expire_time", 0), next(self._sequence), entry_key)
+                                     for entry_key, entry in self._entries.items() if entry_key in self._fresh]
+                heapq.heapify(self._expiry_heap)
+        else:
+            self._fresh.discard(key)
+        self._entries_list = None
+        self._clearance_values = None
+
+    def _unindex_clearance(self, key, data):
+        clearance = get_cf_clearance(data)
+        keys = self._keys_by_clearance.get(clearance)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_clearance[clearance]
+
+    def _expire(self, now):
+        """弹出已到期的堆顶记录；记录与当前数据的过期时间一致时才说明该组合已过期"""
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expire_time, _, key = heapq.heappop(heap)
+            entry = self._entries.get(key)
+            if entry is not None and entry.get("expire_time", 0) == expire_time:
+                self._fresh.discard(key)
+
+    def _mark_dirty(self):
+        self._dirty = True
+        if self._flush_timer is None:
+            timer = threading.Timer(self.flush_delay, self.flush)
+            timer.daemon = True
+            self._flush_timer = timer
+            timer.start()
+
+    def flush(self):
+        """立即写入尚未保存的修改，退出前调用"""
+        with self._write_lock:
+            with self._lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                if not self._dirty:
+                    return
+                entries = self.get_entries()
+                config_data = json.dumps({**self._settings, "exist_data_list": entries}, indent=4)
+                cookies_data = json.dumps(entries, indent=4)
+                self._dirty = False
+            try:
+                lifecycle_util.atomic_write(self.config_file, config_data)
+                lifecycle_util.atomic_write(self.cookies_file, cookies_data)
+            except Exception as e:
+                print(f"保存cf配置失败: {str(e)}")
+                with self._lock:
+                    self._mark_dirty()
+                return
+            with self._lock:
+                if not self._dirty:
+                    self._file_stat = self._stat()
+
+    def get_entries(self):
+        """exist_data_list，修改前返回同一个列表对象"""
+        with self._lock:
+            self._ensure_loaded()
+            if self._entries_list is None:
+                self._entries_list = list(self._entries.values())
+            return self._entries_list
+
+    def get_settings(self):
+        """除 exist_data_list 外的配置（url、need_update）的副本"""
+        with self._lock:
+            self._ensure_loaded()
+            return copy.deepcopy(self._settings)
+
+    def update_settings(self, url=None, need_update=None):
+        """更新 url 和 need_update 中给出的字段，内容没有变化时不写盘"""
+        with self._lock:
+            self._ensure_loaded()
+            settings = copy.deepcopy(self._settings)
+            if url is not None:
+                settings["url"] = url
+            if need_update:
+                settings["need_update"].update(need_update)
+            if settings != self._settings:
+                self._settings = settings
+                self._mark_dirty()
+
+    def set_cookie(self, data):
+        """新增或替换同一 (proxy_url, user_agent) 的Cookie数据，数据格式不合法时抛出 ValueError"""
+        if not is_valid_cookie_data(data):
+            raise ValueError("Cookie数据需要包含字符串或null的 user_agent、cookies 列表和数字类型的 expire_time")
+        with self._lock:
+            self._ensure_loaded()
+            self._put(data, int(time.time()))
+            self._mark_dirty()
+
+    def get_fresh_keys(self):
+        """当前未过期的 (proxy_url, user_agent) 集合的副本"""
+        with self._lock:
+            self._ensure_loaded()
+            self._expire(int(time.time()))
+            return set(self._fresh)
+
+    def get_cf_clearance_values(self):
+        with self._lock:
+            self._ensure_loaded()
+            if self._clearance_values is None:
+                values = (get_cf_clearance(data) for data in self._entries.values())
+                self._clearance_values = [value for value in values if value is not None]
+            return list(self._clearance_values)
+
+    def delete_by_cf_clearance(self, cf_clearance_value):
+        with self._lock:
+            self._ensure_loaded()
+            keys = self._keys_by_clearance.pop(cf_clearance_value, None)
+            if not keys:
+                return False
+            for key in keys:
+                del self._entries[key]
+                self._fresh.discard(key)
+            self._entries_list = None
+            self._clearance_values = None
+            self._mark_dirty()
+            return True
+
+
+COOKIE_STORE = CfCookieStore()
+
 
 def get_cf_clearance_value():
     """
     从cf_config.json文件中获取exist_data_list中的cf_clearance的value值
-    
+
     Returns:
         list: 包含所有找到的cf_clearance值的列表
     """
-    config_file = "data/cf_config.json"
-    cf_clearance_values = []
-    
-    # 检查文件是否存在
-    if not os.path.exists(config_file):
-        print(f"配置文件 {config_file} 不存在")
-        return cf_clearance_values
-    
-    try:
-        # 读取配置文件
-        with open(config_file, "r") as f:
-            config = json.load(f)
-        
-        # 遍历exist_data_list中的每条数据
-        for data in config.get("exist_data_list", []):
-            # 遍历该数据中的cookies
-            for cookie in data.get("cookies", []):
-                # 如果找到cf_clearance
-                if cookie.get("name") == "cf_clearance":
-                    cf_clearance_values.append(cookie.get("value"))
-                    break
-                    
-        return cf_clearance_values
-    
-    except Exception as e:
-        print(f"获取cf_clearance失败: {str(e)}")
-        return cf_clearance_values
+    return COOKIE_STORE.get_cf_clearance_values()
 
 
 def delete_data_by_cf_clearance(cf_clearance_value):
     """
     根据cf_clearance的值删除exist_data_list中匹配的数据
-    
+
     Args:
         cf_clearance_value (str): 要匹配的cf_clearance值
-        
+
     Returns:
         bool: 如果成功删除则返回True，否则返回False
     """
-    config_file = "data/cf_config.json"
-    cookies_file = "data/cf_cookies.json"  # 兼容性考虑
-    
-    # 检查文件是否存在
-    if not os.path.exists(config_file):
-        print(f"配置文件 {config_file} 不存在")
-        return False
-    
-    try:
-        # 读取配置文件
-        with open(config_file, "r") as f:
-            config = json.load(f)
-        
-        original_length = len(config.get("exist_data_list", []))
-        new_data_list = []
-        
-        # 遍历exist_data_list，保留不匹配的数据
-        for data in config.get("exist_data_list", []):
-            should_keep = True
-            
-            # 遍历该数据中的cookies
-            for cookie in data.get("cookies", []):
-                # 如果找到匹配的cf_clearance，标记为不保留
-                if cookie.get("name") == "cf_clearance" and cookie.get("value") == cf_clearance_value:
-                    should_keep = False
-                    break
-            
-            # 如果没有匹配到，保留该数据
-            if should_keep:
-                new_data_list.append(data)
-        
-        # 用过滤后的列表替换原来的exist_data_list
-        config["exist_data_list"] = new_data_list
-        
-        # 保存回配置文件
-        with open(config_file, "w") as f:
-            json.dump(config, f, indent=4)
-        
-        # 为了兼容性，也更新cookies文件
-        if os.path.exists(cookies_file):
-            try:
-                with open(cookies_file, "w") as f:
-                    json.dump(new_data_list, f, indent=4)
-            except Exception as e:
-                print(f"更新cookies文件失败: {str(e)}")
-        
-        # 检查是否有数据被删除
-        return len(new_data_list) < original_length
-    
-    except Exception as e:
-        print(f"删除匹配的cf_clearance数据失败: {str(e)}")
-        return False
+    return COOKIE_STORE.delete_by_cf_clearance(cf_clearance_value)
@@ -0,0 +1,270 @@
+import os
+import queue
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from collections import Counter, deque
+
+# 栈顶为这些函数的线程通常在等锁、等队列或等网络，统计CPU时默认跳过
+IDLE_FUNCTIONS = frozenset({
+    "wait", "select", "poll", "epoll", "accept", "sleep",
+    "_worker", "serve_forever", "readinto", "recv", "_recv", "recv_into", "_wait_for_tstate_lock"
+})
+# get 这类常见函数名只按代码对象匹配，避免把 ImageCache.get 等业务热点当作空闲跳过
+IDLE_CODES = frozenset({queue.Queue.get.__code__})
+
+
+def is_idle_frame(frame):
+    code = frame.f_code
+    return code in IDLE_CODES or code.co_name in IDLE_FUNCTIONS
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+class SamplingProfiler:
+    """
+    按固定间隔采样所有线程调用栈的性能分析器
+
+    只在 profile 调用期间由调用线程轮询 sys._current_frames()，不安装任何 trace/profile 钩子，
+    空闲时没有开销。异步框架中协程的帧同样挂在事件循环线程的栈上，因此也能采到。
+    同一时间只允许一次采样。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filenames = {}
+
+    def _frame_label(self, code):
+        filename = self._filenames.get(code.co_filename)
+        if filename is None:
+            filename = self._filenames[code.co_filename] = os.path.basename(code.co_filename)
+        # 折叠栈格式用 ; 分隔帧，按函数而不是行号聚合
+        return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+    def profile(self, seconds, interval=0.005, include_idle=False):
+        """
+        采样指定时长
+
+        Args:
+            seconds: 采样时长（秒）
+            interval: 采样间隔（秒）
+            include_idle: 是否包含处于等待状态的线程
+
+        Returns:
+            dict: {"stacks": Counter(折叠栈 -> 次数), "samples": 采样轮数, "seconds": 实际时长}
+
+        Raises:
+            ProfilerBusyError: 已有采样在进行
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError("已有性能采样在进行中")
+        try:
+            stacks = Counter()
+            own_ident = threading.get_ident()
+            started_at = time.monotonic()
+            deadline = started_at + seconds
+            rounds = 0
+
+            while time.monotonic() < deadline:
+                thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    if not include_idle and is_idle_frame(frame):
+                        continue
+                    labels = []
+                    while frame is not None:
+                        labels.append(self._frame_label(frame.f_code))
+                        frame = frame.f_back
+                    labels.append(thread_names.get(ident, f"thread-{ident}").replace(";", ":"))
+                    stacks[";".join(reversed(labels))] += 1
+                frame = None
+                rounds += 1
+                time.sleep(interval)
+
+            return {
+                "stacks": stacks,
+                "samples": rounds,
+                "seconds": round(time.monotonic() - started_at, 3)
+            }
+        finally:
+            self._lock.release()
+
+
+def format_collapsed(stacks):
+    """输出 flamegraph.pl / speedscope 可直接读取的折叠栈文本"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def summarize_stacks(stacks, limit=20):
+    """
+    按栈顶函数汇总采样次数
+
+    Returns:
+        list: [{"function": 栈顶函数, "samples": 次数}, ...]，按次数降序
+    """
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+    return [{"function": function, "samples": count} for function, count in leaves.most_common(limit)]
+
+
+# 模块、类、函数属于共享的程序结构，统计数据结构大小时不计入
+_SKIP_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType, types.CodeType, types.FrameType)
+
+
+def deep_sizeof(*objects, max_objects=1000000):
+    """
+    估算对象及其引用的容器、属性所占内存，同一对象只计一次
+
+    Args:
+        objects: 要统计的对象
+        max_objects: 最多遍历的对象数，超过后停止并标记 truncated
+
+    Returns:
+        dict: {"bytes": 字节数, "objects": 对象数, "truncated": 是否提前停止}
+    """
+    seen = set()
+    stack = list(objects)
+    total = 0
+    truncated = False
+
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SKIP_TYPES):
+            continue
+        if len(seen) >= max_objects:
+            truncated = True
+            break
+        seen.add(id(obj))
+        total += sys.getsizeof(obj, 0)
+
+        try:
+            # 其他线程可能正在修改这些容器，出错时只统计容器本身
+            if isinstance(obj, dict):
+                for key, value in list(obj.items()):
+                    stack.append(key)
+                    stack.append(value)
+            elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+                stack.extend(list(obj))
+            elif not isinstance(obj, (str, bytes, bytearray, int, float, bool)):
+                attributes = getattr(obj, "__dict__", None)
+                if attributes is not None:
+                    stack.append(attributes)
+                for slot in getattr(type(obj), "__slots__", ()):
+                    if hasattr(obj, slot):
+                        stack.append(getattr(obj, slot))
+        except RuntimeError:
+            continue
+
+    return {"bytes": total, "objects": len(seen), "truncated": truncated}
+
+
+def get_process_memory():
+    """
+    读取进程内存占用
+
+    Returns:
+        dict: rss_bytes 为当前常驻内存（仅Linux），max_rss_bytes 为峰值
+    """
+    result = {"rss_bytes": None, "max_rss_bytes": None}
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    result["rss_bytes"] = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 单位为字节，Linux 为KB
+        result["max_rss_bytes"] = max_rss if sys.platform == "darwin" else max_rss * 1024
+    except ImportError:
+        pass
+    return result
+
+
+class MemoryTracker:
+    """
+    tracemalloc 的开关、基线快照与对比
+
+    tracemalloc 开启后每次分配都有额外开销，排查完应及时关闭。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._baseline = None
+
+    def _take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, "<unknown>")
+        ))
+
+    def status(self):
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        return {
+            "tracing": tracing,
+            "frames": tracemalloc.get_traceback_limit() if tracing else 0,
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "has_baseline": self._baseline is not None
+        }
+
+    def start(self, frames=1):
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(max(1, frames))
+                self._baseline = None
+        return self.status()
+
+    def stop(self):
+        with self._lock:
+            tracemalloc.stop()
+            self._baseline = None
+        return self.status()
+
+    def snapshot(self):
+        """记录基线快照，之后的 diff 与它对比"""
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                raise RuntimeError("tracemalloc 未开启")
+            self._baseline = self._take_snapshot()
+        return self.status()
+
+    def top(self, limit=20, key_type="lineno"):
+        """当前分配量最大的位置"""
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc 未开启")
+        stats = self._take_snapshot().statistics(key_type)
+        return [_format_stat(stat) for stat in stats[:limit]]
+
+    def diff(self, limit=20, key_type="lineno"):
+        """与基线相比增长最多的位置"""
+        with self._lock:
+            baseline = self._baseline
+        if baseline is None:
+            raise RuntimeError("尚未记录基线快照")
+        stats = self._take_snapshot().compare_to(baseline, key_type)
+        return [_format_stat(stat) for stat in stats[:limit]]
+
+
+def _format_stat(stat):
+    result = {
+        "location": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+        "size_bytes": stat.size,
+        "count": stat.count
+    }
+    if isinstance(stat, tracemalloc.StatisticDiff):
+        result["size_diff_bytes"] = stat.size_diff
+        result["count_diff"] = stat.count_diff
+    return result
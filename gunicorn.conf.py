@@ -0,0 +1,58 @@
+"""
+gunicorn 配置，所有参数都可通过环境变量调整
+
+令牌池、使用记录和图片缓存索引都保存在进程内存中，多个 worker 之间不共享，
+会各自轮询令牌并在持久化时互相覆盖，因此默认只开 1 个 worker，用线程数提高并发。
+"""
+import os
+import signal
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5200)}"
+
+# gthread：每个连接占用一个线程，流式响应期间线程一直被占用，线程数即最大并发流数
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 64))
+# 单个 worker 同时保持的连接上限（含空闲的 keep-alive 连接）
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+backlog = int(os.environ.get("GUNICORN_BACKLOG", 2048))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+# gthread 的 timeout 是 worker 心跳超时而不是请求超时，长时间的流式输出不受影响
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+# 收到 SIGTERM 后等待在途请求的最长秒数，应大于应用的 SHUTDOWN_DRAIN_SECONDS，留出保存状态的时间
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+
+# 处理指定请求数后重启 worker，默认关闭；重启会从 data 目录重新加载令牌状态
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 0))
+
+# 初始化会启动后台线程，必须在每个 worker 内执行
+preload_app = False
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG") or None
+errorlog = "-"
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "warning")
+
+
+def post_worker_init(worker):
+    """在 worker 原有的 SIGTERM 处理之前先进入排空状态：拒绝新请求，到期后流式响应主动收尾"""
+    import app as server
+
+    previous_handler = signal.getsignal(signal.SIGTERM)
+
+    def handle_term(signum, frame):
+        server.SHUTDOWN.begin()
+        if callable(previous_handler):
+            previous_handler(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_term)
+    signal.siginterrupt(signal.SIGTERM, False)
+
+
+def worker_exit(server, worker):
+    """worker 等待在途连接结束后退出，退出前保存令牌状态"""
+    import app
+
+    app.SHUTDOWN.begin(0)
+    app.flush_state()
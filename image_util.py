@@ -0,0 +1,396 @@
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+CONTENT_TYPE_EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/jpg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/gif": "gif"
+}
+EXTENSION_CONTENT_TYPES = {
+    "jpg": "image/jpeg",
+    "png": "image/png",
+    "webp": "image/webp",
+    "gif": "image/gif"
+}
+IMAGE_ID_PATTERN = re.compile(r"^[0-9a-f]{64}\.(jpg|png|webp|gif)$")
+
+
+class ImageCache:
+    """
+    内容寻址的本地图片缓存
+
+    文件名为 sha256 + 扩展名，相同图片只存一份；总大小超过 max_bytes 时
+    按最近访问时间淘汰最旧的文件。目录在首次使用时才扫描。
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory).absolute()
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # image_id -> 文件大小，最久未访问的在前
+        self._total_bytes = 0
+        self._loaded = False
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = []
+        for path in self.directory.iterdir():
+            if IMAGE_ID_PATTERN.match(path.name):
+                stat = path.stat()
+                files.append((stat.st_mtime, path.name, stat.st_size))
+        for _, image_id, size in sorted(files):
+            self._entries[image_id] = size
+            self._total_bytes += size
+        self._loaded = True
+
+    def put(self, data, content_type="image/jpeg"):
+        """
+        写入图片
+
+        Args:
+            data: 图片bytes
+            content_type: 图片MIME类型
+
+        Returns:
+            str: 图片ID（sha256.扩展名）
+        """
+        extension = CONTENT_TYPE_EXTENSIONS.get((content_type or "").split(";")[0].strip().lower(), "jpg")
+        image_id = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+
+        with self._lock:
+            self._ensure_loaded()
+            if image_id in self._entries:
+                self._entries.move_to_end(image_id)
+                return image_id
+
+            path = self.directory / image_id
+            tmp_path = path.with_name(f".{image_id}.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+            self._entries[image_id] = len(data)
+            self._total_bytes += len(data)
+            self._evict()
+        return image_id
+
+    def get(self, image_id):
+        """
+        查找图片
+
+        Returns:
+            tuple: (文件路径, MIME类型)，不存在时返回None
+        """
+        if not IMAGE_ID_PATTERN.match(image_id):
+            return None
+
+        with self._lock:
+            self._ensure_loaded()
+            if image_id not in self._entries:
+                return None
+            self._entries.move_to_end(image_id)
+
+        path = self.directory / image_id
+        try:
+            # 更新修改时间，重启后仍能按访问顺序淘汰
+            os.utime(path)
+        except OSError:
+            return None
+        return path, EXTENSION_CONTENT_TYPES[image_id.rsplit(".", 1)[1]]
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            image_id, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                (self.directory / image_id).unlink()
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "count": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+
+class ImageUploadError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ImageHostProvider:
+    """图床适配器基类，子类声明上传地址、表单字段并从响应中取出图片链接"""
+
+    name = ""
+    default_upload_url = ""
+    file_field = "file"
+
+    def __init__(self, api_key, upload_url=None):
+        self.api_key = api_key
+        self.upload_url = upload_url or self.default_upload_url
+
+    def build_headers(self):
+        return {}
+
+    def parse_url(self, result):
+        raise NotImplementedError
+
+    def upload(self, session, data, content_type, timeout):
+        files = {self.file_field: (f"image.{CONTENT_TYPE_EXTENSIONS.get(content_type, 'jpg')}", data, content_type)}
+        response = session.post(self.upload_url, files=files, headers=self.build_headers(), timeout=timeout)
+        if response.status_code != 200:
+            raise ImageUploadError(f"{self.name}图床上传失败,状态码:{response.status_code}", response.status_code)
+        try:
+            return self.parse_url(response.json())
+        except (ValueError, KeyError, TypeError) as error:
+            raise ImageUploadError(f"{self.name}图床响应解析失败: {str(error)}")
+
+
+class PicgoProvider(ImageHostProvider):
+    name = "PICGO"
+    default_upload_url = "https://www.picgo.net/api/1/upload"
+    file_field = "source"
+
+    def build_headers(self):
+        return {"X-API-Key": self.api_key}
+
+    def parse_url(self, result):
+        return result["image"]["url"]
+
+
+class TumyProvider(ImageHostProvider):
+    name = "TUMY"
+    default_upload_url = "https://tu.my/api/v1/upload"
+
+    def build_headers(self):
+        return {
+            "Accept": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+
+    def parse_url(self, result):
+        return result["data"]["links"]["url"]
+
+
+IMAGE_HOST_PROVIDERS = {
+    "picgo": PicgoProvider,
+    "tumy": TumyProvider
+}
+
+
+class ImageUploader:
+    """
+    图床上传器
+
+    复用同一个 requests.Session（连接池大小与并发上限一致），用信号量限制并发，
+    请求带超时，网络错误、429 和 5xx 按指数退避重试；按图片哈希缓存已上传的链接。
+    """
+
+    RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, provider, max_concurrency=4, timeout=30, max_retries=3, backoff=0.5, cache_size=1024):
+        self.provider = provider
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cache_size = cache_size
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _get_session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def upload(self, data, content_type="image/jpeg"):
+        """
+        上传图片并返回链接，相同内容直接返回缓存的链接
+
+        Raises:
+            ImageUploadError: 重试耗尽后仍上传失败
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        with self._cache_lock:
+            if digest in self._cache:
+                self._cache.move_to_end(digest)
+                return self._cache[digest]
+
+        url = self._upload_with_retry(data, content_type)
+
+        with self._cache_lock:
+            self._cache[digest] = url
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return url
+
+    def _upload_with_retry(self, data, content_type):
+        import requests
+
+        session = self._get_session()
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * (2 ** (attempt - 1)))
+            try:
+                with self._semaphore:
+                    return self.provider.upload(session, data, content_type, self.timeout)
+            except requests.RequestException as error:
+                last_error = ImageUploadError(f"{self.provider.name}图床请求异常: {str(error)}")
+            except ImageUploadError as error:
+                if error.status_code not in self.RETRYABLE_STATUS:
+                    raise
+                last_error = error
+        raise last_error
+
+
+def create_image_uploader(picgo_key=None, tumy_key=None, picgo_url=None, tumy_url=None, **options):
+    """按已配置的密钥选择图床，PICGO优先；都未配置时返回None"""
+    if picgo_key:
+        return ImageUploader(IMAGE_HOST_PROVIDERS["picgo"](picgo_key, picgo_url), **options)
+    if tumy_key:
+        return ImageUploader(IMAGE_HOST_PROVIDERS["tumy"](tumy_key, tumy_url), **options)
+    return None
+
+
+TRANSCODE_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+    "png": ("PNG", "image/png")
+}
+
+
+def transcode_image(data, max_dimension=0, image_format="webp", quality=85):
+    """
+    缩放并转码图片，在进程池中执行
+
+    Args:
+        data: 原始图片bytes
+        max_dimension: 最长边上限，0表示不缩放
+        image_format: 目标格式 webp / jpeg / png，空值表示保持原格式
+        quality: 有损格式的压缩质量
+
+    Returns:
+        tuple: (图片bytes, MIME类型)，结果不比原图小且未缩放时返回None
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        if getattr(image, "is_animated", False):
+            return None
+        image.load()
+        source_format = (image.format or "").lower()
+        pil_format, content_type = TRANSCODE_FORMATS.get(
+            (image_format or source_format).lower(), TRANSCODE_FORMATS["jpeg"])
+
+        resized = False
+        if max_dimension and max(image.size) > max_dimension:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            resized = True
+
+        if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        output = io.BytesIO()
+        if pil_format == "PNG":
+            image.save(output, format=pil_format, optimize=True)
+        else:
+            image.save(output, format=pil_format, quality=quality)
+
+    result = output.getvalue()
+    if len(result) >= len(data) and not resized:
+        return None
+    return result, content_type
+
+
+class ImageTranscoder:
+    """
+    图片转码器，Pillow 为可选依赖，未安装时原样返回
+
+    转码在进程池中执行，不占用 Web 进程的 GIL；进程池在首次使用时才创建。
+    """
+
+    def __init__(self, max_workers=2, timeout=30):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        try:
+            import PIL  # noqa: F401
+            self.available = True
+        except ImportError:
+            self.available = False
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    import multiprocessing
+                    from concurrent.futures import ProcessPoolExecutor
+
+                    # Web进程是多线程的，使用spawn避免fork时继承其他线程持有的锁
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.max_workers,
+                        mp_context=multiprocessing.get_context("spawn")
+                    )
+        return self._pool
+
+    def transcode(self, data, content_type, options):
+        """
+        按选项转码图片，未启用、不可用、失败或没有收益时返回原图
+
+        Args:
+            data: 图片bytes
+            content_type: 原图MIME类型
+            options: 包含 ENABLED / MAX_DIMENSION / FORMAT / QUALITY 的配置
+
+        Returns:
+            tuple: (图片bytes, MIME类型)
+        """
+        if not self.available or not options or not options.get("ENABLED"):
+            return data, content_type
+        if (content_type or "").split(";")[0].strip().lower() == "image/gif":
+            return data, content_type
+        try:
+            future = self._get_pool().submit(
+                transcode_image,
+                data,
+                int(options.get("MAX_DIMENSION") or 0),
+                options.get("FORMAT") or "",
+                int(options.get("QUALITY") or 85)
+            )
+            result = future.result(timeout=self.timeout)
+        except Exception:
+            return data, content_type
+        return result or (data, content_type)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
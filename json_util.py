@@ -0,0 +1,80 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，未安装时回退到标准库
+    orjson = None
+
+BACKEND = "orjson" if orjson else "json"
+
+# orjson.JSONDecodeError 是 json.JSONDecodeError 的子类，调用方统一捕获这个即可
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(data):
+    """
+    解析JSON，支持 str / bytes / bytearray / memoryview
+
+    Args:
+        data: 待解析的JSON数据
+
+    Returns:
+        解析后的Python对象
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data).decode("utf-8")
+    return json.loads(data)
+
+
+def dumps_bytes(obj, indent=False, sort_keys=False, default=None):
+    """
+    序列化为UTF-8编码的bytes，适合直接写入网络或文件
+
+    Args:
+        obj: 待序列化的对象
+        indent: 是否使用两个空格缩进
+        sort_keys: 是否按键排序
+        default: 无法直接序列化的对象交给它转换；给出时日期时间也交给它处理，与标准库 json 一致
+
+    Returns:
+        bytes: UTF-8编码的JSON
+    """
+    if orjson is not None:
+        option = 0
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if default is not None:
+            option |= orjson.OPT_PASSTHROUGH_DATETIME
+        try:
+            return orjson.dumps(obj, default=default, option=option)
+        except TypeError:
+            # orjson 不支持的类型（如非字符串的字典键、超大整数）交给标准库处理
+            pass
+    return json.dumps(
+        obj,
+        ensure_ascii=False,
+        indent=2 if indent else None,
+        sort_keys=sort_keys,
+        separators=None if indent else (",", ":"),
+        default=default
+    ).encode("utf-8")
+
+
+def dumps(obj, indent=False, sort_keys=False, default=None):
+    """
+    序列化为str
+
+    Args:
+        obj: 待序列化的对象
+        indent: 是否使用两个空格缩进
+        sort_keys: 是否按键排序
+        default: 同 dumps_bytes
+
+    Returns:
+        str: JSON字符串
+    """
+    return dumps_bytes(obj, indent=indent, sort_keys=sort_keys, default=default).decode("utf-8")
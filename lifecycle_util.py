@@ -0,0 +1,124 @@
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from werkzeug.wsgi import ClosingIterator
+
+
+def atomic_write(path, data):
+    """
+    原子写文件：先写同目录下的临时文件并落盘，再用 os.replace 替换
+
+    进程在写入过程中被杀掉时，原文件保持完整，不会留下截断的JSON或pickle。
+
+    Args:
+        path: 目标文件路径
+        data: bytes 或 str（str 按 UTF-8 编码）
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    try:
+        mode = path.stat().st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp 创建的文件权限为 0600，保持与原文件一致
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class GracefulShutdown:
+    """
+    优雅退出的状态：开始排空后拒绝新请求，等待在途请求结束，超过期限后让流式响应主动收尾
+
+    wrap 返回的 WSGI 中间件统计在途请求，响应体被服务器关闭（流式输出结束或客户端断开）时才算结束。
+    """
+
+    def __init__(self, drain_seconds=20, exempt_paths=()):
+        self.drain_seconds = drain_seconds
+        self.exempt_paths = frozenset(exempt_paths)
+        self._condition = threading.Condition()
+        self._active = 0
+        self._deadline = None
+
+    @property
+    def draining(self):
+        return self._deadline is not None
+
+    @property
+    def active(self):
+        return self._active
+
+    def begin(self, drain_seconds=None):
+        """开始排空，重复调用不会推迟期限"""
+        with self._condition:
+            if self._deadline is None:
+                seconds = self.drain_seconds if drain_seconds is None else drain_seconds
+                self._deadline = time.monotonic() + seconds
+            self._condition.notify_all()
+
+    def deadline_passed(self):
+        deadline = self._deadline
+        return deadline is not None and time.monotonic() >= deadline
+
+    def wait_idle(self, timeout=None):
+        """
+        等待在途请求全部结束
+
+        Returns:
+            bool: 是否已全部结束
+        """
+        end = time.monotonic() + (self.drain_seconds if timeout is None else timeout)
+        with self._condition:
+            while self._active:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def _enter(self):
+        with self._condition:
+            self._active += 1
+
+    def _leave(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def wrap(self, wsgi_app):
+        def middleware(environ, start_response):
+            if environ.get("PATH_INFO") in self.exempt_paths:
+                return wsgi_app(environ, start_response)
+            if self.draining:
+                body = b'{"error":"server is shutting down"}'
+                start_response("503 Service Unavailable", [
+                    ("Content-Type", "application/json"),
+                    ("Content-Length", str(len(body))),
+                    ("Retry-After", "5"),
+                    ("Connection", "close")
+                ])
+                return [body]
+            self._enter()
+            try:
+                app_iter = wsgi_app(environ, start_response)
+            except BaseException:
+                self._leave()
+                raise
+            return ClosingIterator(app_iter, self._leave)
+        return middleware
@@ -0,0 +1,105 @@
+import os
+import sys
+
+from loguru import logger
+
+LEVELS = {
+    "TRACE": 5,
+    "DEBUG": 10,
+    "INFO": 20,
+    "SUCCESS": 25,
+    "WARNING": 30,
+    "ERROR": 40,
+    "CRITICAL": 50
+}
+
+
+class Logger:
+    """
+    对 loguru 的轻量封装
+
+    - 低于当前级别的调用直接返回，不取调用方信息也不格式化
+    - message 可以是无参函数，只有真正输出时才求值，适合热循环中的调试日志
+    - 调用方信息通过 sys._getframe 获取，文件名按代码对象缓存
+    - 默认通过 enqueue 交给后台线程写出，请求线程不等待 I/O
+    """
+
+    def __init__(self, level="INFO", colorize=True, format=None, enqueue=True, sample_every=100, sink=None):
+        logger.remove()
+
+        if format is None:
+            format = (
+                "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | "
+                "<level>{level: <8}</level> | "
+                "<cyan>{extra[filename]}</cyan>:<cyan>{extra[function]}</cyan>:<cyan>{extra[lineno]}</cyan> | "
+                "<level>{message}</level>"
+            )
+
+        level = level.upper() if level.upper() in LEVELS else "INFO"
+        logger.add(
+            sink or sys.stderr,
+            level=level,
+            format=format,
+            colorize=colorize,
+            backtrace=True,
+            diagnose=True,
+            enqueue=enqueue
+        )
+
+        self.logger = logger
+        self.level_no = LEVELS[level]
+        self.sample_every = max(1, sample_every)
+        self._filenames = {}
+
+    def is_enabled(self, level):
+        return LEVELS[level] >= self.level_no
+
+    def _get_caller_info(self, depth):
+        frame = sys._getframe(depth + 1)
+        code = frame.f_code
+        filename = self._filenames.get(code.co_filename)
+        if filename is None:
+            filename = self._filenames[code.co_filename] = os.path.basename(code.co_filename)
+        return {
+            'filename': filename,
+            'function': code.co_name,
+            'lineno': frame.f_lineno
+        }
+
+    def _log(self, level, message, source, depth=2):
+        if LEVELS[level] < self.level_no:
+            return
+        if callable(message):
+            message = message()
+        caller_info = self._get_caller_info(depth)
+
+        if level == "ERROR" and isinstance(message, Exception):
+            self.logger.bind(**caller_info).exception(f"[{source}] {str(message)}")
+        else:
+            self.logger.bind(**caller_info).log(level, f"[{source}] {message}")
+
+    def info(self, message, source="API"):
+        self._log("INFO", message, source)
+
+    def error(self, message, source="API"):
+        self._log("ERROR", message, source)
+
+    def warning(self, message, source="API"):
+        self._log("WARNING", message, source)
+
+    def debug(self, message, source="API"):
+        self._log("DEBUG", message, source)
+
+    def debug_sampled(self, count, message, source="API"):
+        """热循环中的调试日志采样：只输出第1条及此后每 sample_every 条"""
+        if self.level_no > LEVELS["DEBUG"] or count % self.sample_every != 1 % self.sample_every:
+            return
+        self._log("DEBUG", message, source)
+
+    async def request_logger(self, request):
+        caller_info = self._get_caller_info(1)
+        self.logger.bind(**caller_info).info(f"[Request] 请求: {request.method} {request.path}")
+
+    def complete(self):
+        """等待后台队列中的日志写完，退出前调用"""
+        self.logger.complete()
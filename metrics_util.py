@@ -0,0 +1,221 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# 覆盖从首包到长时间流式输出的延迟范围（秒）
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(labelnames, key)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._render_samples())
+        return "\n".join(lines)
+
+    def _render_samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    仪表盘指标
+
+    传入 collect 时在抓取时调用它取值，返回 [(标签dict, 值), ...]，
+    适合令牌池大小这类已有数据结构的统计，热路径上不需要维护任何计数。
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def track(self, **labels):
+        """
+        计数加一并返回释放函数，释放函数可重复调用但只生效一次
+
+        Returns:
+            callable: 调用后计数减一
+        """
+        self.inc(1, **labels)
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self.dec(1, **labels)
+        return release
+
+    def _render_samples(self):
+        if self.collect is None:
+            return super()._render_samples()
+        return [
+            f"{self.name}{_format_labels(self.labelnames, self._key(labels))} {_format_value(value)}"
+            for labels, value in self.collect()
+        ]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # 每个桶只记录落在该区间的次数，输出时再累加
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _render_samples(self):
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """进程内指标注册表，render 输出 Prometheus 文本格式"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), collect=None):
+        return self._register(Gauge(name, documentation, labelnames, collect))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+class RequestTimer:
+    """
+    单个请求的阶段计时
+
+    同名阶段累加（如多次重试取令牌、多张图片并发处理），mark 记录从请求开始到某个时刻的耗时。
+    结果按记录顺序输出为 Server-Timing 格式，时间单位为毫秒。
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self.started_at = clock()
+        self._lock = threading.Lock()
+        self._phases = {}
+
+    def elapsed(self):
+        return self._clock() - self.started_at
+
+    def add(self, name, seconds):
+        with self._lock:
+            self._phases[name] = self._phases.get(name, 0.0) + seconds
+
+    def mark(self, name):
+        """只记录第一次到达的时刻"""
+        with self._lock:
+            if name not in self._phases:
+                self._phases[name] = self.elapsed()
+
+    @contextmanager
+    def span(self, name):
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.add(name, self._clock() - start)
+
+    def call(self, name, func, *args, **kwargs):
+        """在计时中调用函数，可直接交给线程池执行"""
+        with self.span(name):
+            return func(*args, **kwargs)
+
+    def as_dict(self, total=True):
+        with self._lock:
+            phases = {name: round(seconds * 1000, 1) for name, seconds in self._phases.items()}
+        if total:
+            phases["total"] = round(self.elapsed() * 1000, 1)
+        return phases
+
+    def server_timing(self, total=True):
+        return ", ".join(f"{name};dur={duration}" for name, duration in self.as_dict(total).items())
@@ -0,0 +1,145 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 单次探测的结果：令牌可用 / 上游明确拒绝了该令牌（如已退出登录）/ 无法判断（网络错误、风控、5xx）
+PROBE_OK = "ok"
+PROBE_UNAUTHORIZED = "unauthorized"
+PROBE_ERROR = "error"
+
+
+class RateLimiter:
+    """令牌桶限速，rate 为每秒允许的次数，0 表示不限速"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._allowance = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, stop_event=None):
+        """
+        取得一次许可，额度不足时等待
+
+        Returns:
+            bool: stop_event 在等待期间被设置时返回 False
+        """
+        if not self.rate:
+            return True
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._allowance = min(self.burst, self._allowance + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._allowance >= 1:
+                    self._allowance -= 1
+                    return True
+                wait = (1 - self._allowance) / self.rate
+            if stop_event is None:
+                time.sleep(wait)
+            elif stop_event.wait(wait):
+                return False
+
+
+class TokenProber:
+    """
+    后台令牌健康探测
+
+    每隔 interval 秒对 list_targets() 返回的令牌执行一轮 probe(target)，同时最多 concurrency 个探测，
+    整体速率不超过 rate 次/秒。probe 返回 {"result": PROBE_*, ...}，抛出异常按 PROBE_ERROR 处理；
+    结果依次交给 on_result(target, outcome)（串行调用，无需额外加锁），一轮结束后调用 on_round_end(summary)。
+    """
+
+    def __init__(self, list_targets, probe, on_result, on_round_end=None,
+                 interval=1800, concurrency=4, rate=2, initial_delay=60):
+        self.list_targets = list_targets
+        self.probe = probe
+        self.on_result = on_result
+        self.on_round_end = on_round_end
+        self.interval = interval
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.initial_delay = initial_delay
+        self.running = False
+        self.last_round = None
+        self.next_run_at = None
+        self._stop = threading.Event()
+        self._round_lock = threading.Lock()
+        self._result_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="token-prober", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """停止定时探测，进行中的一轮不再发起新的探测"""
+        self._stop.set()
+
+    def _loop(self):
+        delay = self.initial_delay
+        while not self._stop.is_set():
+            self.next_run_at = time.time() + delay
+            if self._stop.wait(delay):
+                break
+            self.next_run_at = None
+            self.run_round()
+            delay = self.interval
+
+    def _probe_one(self, target, limiter, counts):
+        if self._stop.is_set() or not limiter.acquire(self._stop):
+            return
+        try:
+            outcome = self.probe(target)
+        except Exception as error:
+            outcome = {"result": PROBE_ERROR, "detail": f"{type(error).__name__}: {error}"}
+        with self._result_lock:
+            counts[outcome["result"]] = counts.get(outcome["result"], 0) + 1
+            self.on_result(target, outcome)
+
+    def run_round(self):
+        """
+        执行一轮探测并返回汇总，另一轮正在进行时返回 None
+
+        Returns:
+            dict: {"startedAt", "finishedAt", "durationMs", "targets", "counts", "stopped"}
+        """
+        if not self._round_lock.acquire(blocking=False):
+            return None
+        try:
+            self.running = True
+            started_at = time.time()
+            targets = list(self.list_targets())
+            counts = {}
+            limiter = RateLimiter(self.rate)
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="token-probe") as executor:
+                for target in targets:
+                    executor.submit(self._probe_one, target, limiter, counts)
+            finished_at = time.time()
+            summary = {
+                "startedAt": int(started_at * 1000),
+                "finishedAt": int(finished_at * 1000),
+                "durationMs": int((finished_at - started_at) * 1000),
+                "targets": len(targets),
+                "counts": counts,
+                "stopped": self._stop.is_set()
+            }
+            self.last_round = summary
+            if self.on_round_end:
+                self.on_round_end(summary)
+            return summary
+        finally:
+            self.running = False
+            self._round_lock.release()
+
+    def status(self):
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "concurrency": self.concurrency,
+            "rate": self.rate,
+            "nextRunAt": int(self.next_run_at * 1000) if self.next_run_at else None,
+            "lastRound": self.last_round
+        }
@@ -0,0 +1,61 @@
+import gzip
+import hashlib
+import threading
+
+import json_util
+
+# 小于该字节数的响应不压缩，压缩收益抵不过开销
+GZIP_MIN_BYTES = 1024
+
+
+def gzip_bytes(data):
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+
+class Snapshot:
+    """某个版本下序列化好的JSON响应体，ETag 由内容计算，进程重启后仍然有效"""
+
+    def __init__(self, version, body):
+        self.version = version
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        self._gzip_body = None
+
+    def gzip_body(self):
+        if self._gzip_body is None:
+            self._gzip_body = gzip_bytes(self.body)
+        return self._gzip_body
+
+    def matches(self, if_none_match):
+        """If-None-Match 是否命中当前 ETag（忽略弱校验前缀）"""
+        if not if_none_match:
+            return False
+        for candidate in if_none_match.split(","):
+            candidate = candidate.strip()
+            if candidate == "*" or candidate.removeprefix("W/") == self.etag:
+                return True
+        return False
+
+
+class VersionedSnapshot:
+    """
+    按版本号缓存的JSON快照
+
+    build 返回要序列化的对象。版本号不变时直接复用上次的bytes、ETag 和 gzip 结果，
+    版本号在构建前读取，构建期间发生的修改会让下一次 get 重新构建。
+    """
+
+    def __init__(self, build):
+        self._build = build
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def get(self, version):
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.version != version:
+                snapshot = self._snapshot = Snapshot(version, json_util.dumps_bytes(self._build()))
+        return snapshot
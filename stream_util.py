@@ -0,0 +1,418 @@
+import queue
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import json_util
+
+
+def organize_search_results(search_results):
+    if not search_results or 'results' not in search_results:
+        return ''
+
+    results = search_results['results']
+    formatted_results = []
+
+    for index, result in enumerate(results):
+        title = result.get('title', '未知标题')
+        url = result.get('url', '#')
+        preview = result.get('preview', '无预览内容')
+
+        formatted_result = f"\r\n<details><summary>资料[{index}]: {title}</summary>\r\n{preview}\r\n\n[Link]({url})\r\n</details>"
+        formatted_results.append(formatted_result)
+
+    return '\n\n'.join(formatted_results)
+
+
+class ResponseTransformer:
+    """
+    单次响应的状态机：把上游NDJSON中的response对象转换为要输出的文本或图片
+
+    每个请求各自持有一个实例，<think> 框定和生图检测的状态都在实例上，
+    多个流之间互不影响。子类只需实现 transform_token。
+    """
+
+    def __init__(self, model, show_thinking=False, show_search_results=True):
+        self.model = model
+        self.show_thinking = show_thinking
+        self.show_search_results = show_search_results
+        self.is_thinking = False
+        self.is_img_gen = False
+        self.image_urls = set()
+
+    def process(self, response):
+        result = {"token": None, "imageUrl": None}
+
+        if response.get("doImgGen") or response.get("imageAttachmentInfo"):
+            self.is_img_gen = True
+
+        if self.is_img_gen:
+            cached = response.get("cachedImageGenerationResponse")
+            # 同一张图可能被重复推送，每个地址只输出一次
+            if cached and cached["imageUrl"] not in self.image_urls:
+                result["imageUrl"] = cached["imageUrl"]
+                self.image_urls.add(cached["imageUrl"])
+            return result
+
+        result["token"] = self.transform_token(response)
+        return result
+
+    def transform_token(self, response):
+        # 生图模型等未登记的模型只输出图片
+        return None
+
+
+class PlainTransformer(ResponseTransformer):
+    def transform_token(self, response):
+        return response.get("token")
+
+
+class SearchTransformer(ResponseTransformer):
+    def transform_token(self, response):
+        if response.get("webSearchResults") and self.show_search_results:
+            return f"\r\n<think>{organize_search_results(response['webSearchResults'])}</think>\r\n"
+        return response.get("token")
+
+
+class DeepSearchTransformer(ResponseTransformer):
+    def transform_token(self, response):
+        step_id = response.get("messageStepId")
+        tag = response.get("messageTag")
+        token = response.get("token", "")
+
+        if step_id and not self.show_thinking:
+            return None
+        if step_id and not self.is_thinking:
+            self.is_thinking = True
+            return "<think>" + token
+        if not step_id and self.is_thinking and tag == "final":
+            self.is_thinking = False
+            return "</think>" + token
+        if (step_id and self.is_thinking and tag == "assistant") or tag == "final":
+            return token
+        if self.is_thinking and isinstance(token, dict) and token.get("action", "") == "webSearch":
+            return token.get("action_input", {}).get("query", "")
+        if self.is_thinking and response.get("webSearchResults"):
+            return organize_search_results(response['webSearchResults'])
+        return None
+
+
+class ReasoningTransformer(ResponseTransformer):
+    def transform_token(self, response):
+        thinking = response.get("isThinking")
+
+        if thinking and not self.show_thinking:
+            return None
+        if thinking and not self.is_thinking:
+            self.is_thinking = True
+            return "<think>" + response.get("token", "")
+        if not thinking and self.is_thinking:
+            self.is_thinking = False
+            return "</think>" + response.get("token", "")
+        return response.get("token")
+
+
+class Grok4Transformer(ResponseTransformer):
+    def transform_token(self, response):
+        if response.get("isThinking"):
+            return None
+        return response.get("token")
+
+
+class Grok4ReasoningTransformer(ResponseTransformer):
+    def transform_token(self, response):
+        thinking = response.get("isThinking")
+        tag = response.get("messageTag")
+
+        if thinking and not self.show_thinking:
+            return None
+        if thinking and not self.is_thinking and tag == "assistant":
+            self.is_thinking = True
+            return "<think>" + response.get("token", "")
+        if not thinking and self.is_thinking and tag == "final":
+            self.is_thinking = False
+            return "</think>" + response.get("token", "")
+        return response.get("token")
+
+
+TRANSFORMERS = {
+    "grok-3": PlainTransformer,
+    "grok-3-search": SearchTransformer,
+    "grok-3-deepsearch": DeepSearchTransformer,
+    "grok-3-deepersearch": DeepSearchTransformer,
+    "grok-3-reasoning": ReasoningTransformer,
+    "grok-4": Grok4Transformer,
+    "grok-4-reasoning": Grok4ReasoningTransformer,
+    "grok-4-deepsearch": DeepSearchTransformer,
+}
+
+
+def create_response_transformer(model, show_thinking=False, show_search_results=True):
+    """
+    按模型从分发表中选择转换器，未登记的模型（如生图模型）使用基类
+
+    Args:
+        model: 请求的模型名
+        show_thinking: 是否输出思考过程
+        show_search_results: 是否输出搜索结果
+
+    Returns:
+        ResponseTransformer: 新的转换器实例
+    """
+    transformer_cls = TRANSFORMERS.get(model, ResponseTransformer)
+    return transformer_cls(model, show_thinking, show_search_results)
+
+
+class SSEChunkEncoder:
+    """
+    单个流式响应的SSE帧编码器
+
+    id、created、model 在构造时固定，整个流共用同一个 completion id；
+    内容帧的前后缀预先渲染成bytes，每个分片只需转义 delta 文本。
+    """
+
+    DONE = b"data: [DONE]\n\n"
+    KEEPALIVE = b": keep-alive\n\n"
+
+    def __init__(self, model, completion_id=None, created=None):
+        self.model = model
+        self.completion_id = completion_id or f"chatcmpl-{uuid.uuid4()}"
+        self.created = int(time.time()) if created is None else created
+        self._base = {
+            "id": self.completion_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": model
+        }
+        head = json_util.dumps_bytes(self._base)[:-1]
+        self._content_prefix = b"data: " + head + b',"choices":[{"index":0,"delta":{"content":'
+        self._content_suffix = b'},"finish_reason":null}]}\n\n'
+
+    def event(self, payload):
+        return b"data: " + json_util.dumps_bytes(payload) + b"\n\n"
+
+    def role(self):
+        return self.event({
+            **self._base,
+            "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]
+        })
+
+    def content(self, text):
+        return self._content_prefix + json_util.dumps_bytes(text) + self._content_suffix
+
+    def comment(self, text):
+        """SSE注释帧，客户端会忽略，可用于附带诊断信息"""
+        return b": " + text.encode("utf-8") + b"\n\n"
+
+    def finish(self, reason="stop"):
+        return self.event({
+            **self._base,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": reason}]
+        })
+
+
+class ChunkCoalescer:
+    """
+    把上游细碎的token合并后再编码成SSE帧，减少帧数与写入次数
+
+    距本批第一个分片超过 flush_interval_ms 毫秒或累计超过 max_bytes 字节时输出，
+    两个阈值都为0时不合并。包含 <think> / </think> 的分片是思考与回答的边界，
+    会立即连同此前积压的内容一起输出。超时检查发生在 add 与 flush_due 调用时。
+    """
+
+    BOUNDARY_MARKERS = ("<think>", "</think>")
+
+    def __init__(self, flush_interval_ms=0, max_bytes=0, clock=time.monotonic):
+        self.flush_interval = max(0, flush_interval_ms) / 1000
+        self.max_bytes = max(0, max_bytes)
+        self.enabled = bool(self.flush_interval or self.max_bytes)
+        self._clock = clock
+        self._parts = []
+        self._size = 0
+        self._first_at = None
+
+    def add(self, text):
+        """
+        加入一个分片
+
+        Returns:
+            list: 需要立即输出的文本，可能为空
+        """
+        if not self.enabled:
+            return [text]
+
+        if any(marker in text for marker in self.BOUNDARY_MARKERS):
+            pending = self.flush()
+            return [pending, text] if pending else [text]
+
+        if not self._parts:
+            self._first_at = self._clock()
+        self._parts.append(text)
+        self._size += len(text.encode("utf-8"))
+
+        if self.max_bytes and self._size >= self.max_bytes:
+            return [self.flush()]
+        if self.flush_interval and self._clock() - self._first_at >= self.flush_interval:
+            return [self.flush()]
+        return []
+
+    def flush_due(self):
+        """积压内容已超过时间阈值时取出，否则返回None"""
+        if self._parts and self.flush_interval and self._clock() - self._first_at >= self.flush_interval:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """取出全部积压内容，没有时返回None"""
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        self._first_at = None
+        return text
+
+
+class UpstreamLineReader:
+    """
+    在后台线程中读取上游 iter_lines，使流式生成器可以按固定间隔醒来
+
+    生成器因此能在上游静默时发送保活帧、输出已处理完的图片和到期的合并分片。
+    关闭上游响应会让读取线程随之退出。
+    """
+
+    _END = object()
+
+    def __init__(self, response):
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, args=(response,), daemon=True)
+        self._thread.start()
+
+    def _run(self, response):
+        try:
+            for line in response.iter_lines():
+                if self._closed:
+                    return
+                self._queue.put(line)
+        except Exception as error:
+            if not self._closed:
+                self._queue.put(error)
+        finally:
+            self._queue.put(self._END)
+
+    def iter_lines(self, idle_timeout):
+        """
+        逐行返回上游数据，超过 idle_timeout 秒没有新数据时返回一次None
+
+        上游读取出错时在调用方线程中重新抛出该异常。
+        """
+        while True:
+            try:
+                item = self._queue.get(timeout=idle_timeout)
+            except queue.Empty:
+                yield None
+                continue
+            if item is self._END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self._closed = True
+
+
+# 录制时替换为占位符的字段：会话与用户标识、用户输入和附件
+REDACTED_KEYS = frozenset({
+    "conversationId", "userId", "xaiUserId", "userResponse", "fileAttachments", "imageAttachments"
+})
+USER_PATH_PATTERN = re.compile(r"users/[^/]+/")
+
+
+def redact(value):
+    """递归脱敏上游响应对象，不影响转换器用到的字段"""
+    if isinstance(value, dict):
+        return {key: "[REDACTED]" if key in REDACTED_KEYS else redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    if isinstance(value, str) and "users/" in value:
+        return USER_PATH_PATTERN.sub("users/redacted/", value)
+    return value
+
+
+class UpstreamRecorder:
+    """
+    把一次上游响应的原始NDJSON脱敏后写入磁盘，供回放与黄金输出对比
+
+    请求线程只把原始行追加到列表，脱敏和写文件在关闭后交给单独的后台线程完成。
+    每次录制生成 <名称>.ndjson 与记录模型和输出配置的 <名称>.json。
+    """
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, directory, model, stream, **meta):
+        self.directory = Path(directory)
+        self.name = f"{time.strftime('%Y%m%d-%H%M%S')}-{model}-{uuid.uuid4().hex[:8]}"
+        self.meta = {"model": model, "stream": stream, "created": int(time.time()), **meta}
+        self._lines = []
+        self._closed = False
+
+    @classmethod
+    def _get_executor(cls):
+        if cls._executor is None:
+            with cls._executor_lock:
+                if cls._executor is None:
+                    cls._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="upstream-recorder")
+        return cls._executor
+
+    def write(self, line):
+        self._lines.append(line)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._lines:
+            self._get_executor().submit(self._flush, self._lines)
+
+    def _flush(self, lines):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        redacted = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                redacted.append(json_util.dumps_bytes(redact(json_util.loads(line))))
+            except json_util.JSONDecodeError:
+                redacted.append(line)
+        data_path = self.directory / f"{self.name}.ndjson"
+        tmp_path = data_path.with_name(f".{data_path.name}.tmp")
+        tmp_path.write_bytes(b"\n".join(redacted) + b"\n")
+        (self.directory / f"{self.name}.json").write_bytes(json_util.dumps_bytes(self.meta, indent=True))
+        tmp_path.replace(data_path)
+
+
+class RecordingResponse:
+    """包装上游响应，iter_lines 的每一行同时交给录制器，关闭时结束录制"""
+
+    def __init__(self, response, recorder):
+        self._response = response
+        self._recorder = recorder
+
+    def iter_lines(self, *args, **kwargs):
+        for line in self._response.iter_lines(*args, **kwargs):
+            self._recorder.write(line)
+            yield line
+
+    def close(self):
+        self._recorder.close()
+        self._response.close()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
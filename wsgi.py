@@ -0,0 +1,10 @@
+"""
+生产环境入口: gunicorn -c gunicorn.conf.py wsgi:app
+
+每个 worker 导入本模块时各自完成一次初始化。
+"""
+import app as server
+
+server.bootstrap()
+
+app = server.app